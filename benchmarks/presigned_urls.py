@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""Compare creating presigned S3 URLs with botocore against the batch signer"""
+import argparse
+import time
+
+import boto3
+from botocore.config import Config
+
+from prominence.backend import ProminenceBackend
+
+CONFIG = {'DEFAULT_STORAGE': 's3',
+          'S3_URL': 'https://s3.example.org',
+          'S3_BUCKET': 'prominence',
+          'S3_ACCESS_KEY_ID': 'access-key-id',
+          'S3_SECRET_ACCESS_KEY': 'secret-access-key'}
+
+def botocore_urls(requests):
+    """
+    Create presigned URLs one at a time using botocore
+    """
+    s3_client = boto3.client('s3',
+                             endpoint_url=CONFIG['S3_URL'],
+                             aws_access_key_id=CONFIG['S3_ACCESS_KEY_ID'],
+                             aws_secret_access_key=CONFIG['S3_SECRET_ACCESS_KEY'],
+                             config=Config(signature_version=CONFIG['S3_SIGNATURE_VERSION']))
+    urls = []
+    for (method, object_name, duration_in_seconds) in requests:
+        if method == 'get':
+            urls.append(s3_client.generate_presigned_url('get_object',
+                                                         Params={'Bucket': CONFIG['S3_BUCKET'], 'Key': object_name},
+                                                         ExpiresIn=duration_in_seconds))
+        else:
+            urls.append(s3_client.generate_presigned_url('put_object',
+                                                         Params={'Bucket': CONFIG['S3_BUCKET'], 'Key': object_name},
+                                                         ExpiresIn=duration_in_seconds,
+                                                         HttpMethod='PUT'))
+    return urls
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Presigned URL benchmark')
+    parser.add_argument('--urls', type=int, default=30000, help='Number of URLs to create')
+    parser.add_argument('--signature-version', default='s3', choices=['s3', 's3v4'], help='Signature version')
+    args = parser.parse_args()
+
+    CONFIG['S3_SIGNATURE_VERSION'] = args.signature_version
+    requests = [('get' if i % 3 == 0 else 'put', 'scratch/uid/job/%d/output.tgz' % i, 864000) for i in range(args.urls)]
+
+    start = time.time()
+    botocore_urls(requests)
+    time_botocore = time.time() - start
+
+    start = time.time()
+    ProminenceBackend(CONFIG).create_presigned_urls(requests)
+    time_batch = time.time() - start
+
+    print('URLs:     %d' % args.urls)
+    print('botocore: %.3f s' % time_botocore)
+    print('batch:    %.3f s (%.1fx faster)' % (time_batch, time_botocore/time_batch))
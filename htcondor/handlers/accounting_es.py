@@ -8,12 +8,23 @@ import time
 import logging
 import classad
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan, streaming_bulk
 
 logger = logging.getLogger('process_completed_jobs.accounting_es')
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read('/etc/prominence/prominence.ini')
 
+# Number of records in each bulk request and number of times to retry records which failed
+BULK_CHUNK_SIZE = 500
+BULK_MAX_RETRIES = 3
+BULK_BACKOFF = 2
+
+ES_CLIENT = None
+
+# Id of the document in the rollup index recording the earliest date it covers
+ROLLUP_COVERAGE_ID = 'coverage'
+
 def datetime_format(epoch):
     """
     Convert a unix epoch in a formatted date/time string
@@ -151,13 +162,214 @@ def process_record(ad):
 
     return job
 
+def get_job_usage(job):
+    """
+    Return the wall time (multiplied by the number of CPUs) and CPU time used by a job
+    """
+    if job['type'] != 'job' or 'tasks' not in job['execution']:
+        return None
+
+    cpus = 1
+    if 'resources' in job and 'cpus' in job['resources']:
+        cpus = job['resources']['cpus']
+    if 'provisionedResources' in job['execution']:
+        if 'cpus' in job['execution']['provisionedResources']:
+            cpus = job['execution']['provisionedResources']['cpus']
+
+    wall_time = 0
+    cpu_time = 0
+    for task in job['execution']['tasks']:
+        if 'wallTimeUsage' in task:
+            wall_time += task['wallTimeUsage']*cpus
+        if 'cpuTimeUsage' in task:
+            cpu_time += task['cpuTimeUsage']
+
+    return wall_time, cpu_time
+
+def get_client():
+    """
+    Return the Elasticsearch client, creating it if necessary
+    """
+    global ES_CLIENT
+    if ES_CLIENT is None:
+        ES_CLIENT = Elasticsearch([{'host':CONFIG.get('elasticsearch', 'host'),
+                                    'port':CONFIG.get('elasticsearch', 'port')}])
+    return ES_CLIENT
+
+def rollup_key(job):
+    """
+    Return the day, group and username whose usage in the rollup index includes the given job, or
+    None if the job's usage is not recorded
+    """
+    if not get_job_usage(job):
+        return None
+    return (job['date'][:10], job['group'], job['username'])
+
+def rollup_id(key):
+    """
+    Return the id of the rollup document for the given day, group and username
+    """
+    return '%s|%s|%s' % key
+
+def summarize_usage(jobs, keys=None):
+    """
+    Sum the usage of the given jobs by day, group and username, optionally only for the given keys
+    """
+    totals = {}
+    for key in keys or []:
+        totals[key] = [0, 0, 0]
+    for job in jobs:
+        key = rollup_key(job)
+        if not key or (keys is not None and key not in keys):
+            continue
+        (wall_time, cpu_time) = get_job_usage(job)
+        total = totals.setdefault(key, [0, 0, 0])
+        total[0] += wall_time
+        total[1] += cpu_time
+        total[2] += 1
+    return totals
+
+def rollup_actions(totals, version):
+    """
+    Create the actions which write the usage of each day, group and username to the rollup index.
+    The external version is the time at which the usage was read from the job index, so that a
+    total calculated earlier never replaces one calculated later
+    """
+    return [{'_op_type': 'index',
+             '_index': CONFIG.get('elasticsearch', 'rollup-index'),
+             '_type': '_doc',
+             '_id': rollup_id(key),
+             '_version': version,
+             '_version_type': 'external',
+             '_source': {'type': 'usage',
+                         'date': '%sT00:00:00Z' % key[0],
+                         'group': key[1],
+                         'username': key[2],
+                         'wallTime': total[0],
+                         'cpuTime': total[1],
+                         'numberOfJobs': total[2]}} for key, total in totals.items()]
+
+def update_rollup(es, keys):
+    """
+    Recalculate the usage of the given days, groups and usernames from the job index and write it to
+    the rollup index. Returns the keys which were successfully updated
+    """
+    if not keys:
+        return set()
+
+    # Make sure jobs which have just been indexed are included
+    index = CONFIG.get('elasticsearch', 'index')
+    es.indices.refresh(index=index)
+    version = int(time.time()*1000000)
+
+    totals = {}
+    for day in set(key[0] for key in keys):
+        day_keys = set(key for key in keys if key[0] == day)
+        query = {'query': {'bool': {'filter': [{'match': {'type': 'job'}},
+                                               {'exists': {'field': 'execution.tasks'}},
+                                               {'terms': {'username.keyword': sorted(set(key[2] for key in day_keys))}},
+                                               {'range': {'date': {'gte': '%sT00:00:00Z' % day,
+                                                                   'lte': '%sT23:59:59Z' % day}}}]}}}
+        try:
+            jobs = [hit['_source'] for hit in scan(es, index=index, query=query)]
+        except Exception as err:
+            logger.error('Unable to read usage for %s from elasticsearch: %s', day, err)
+            continue
+        totals.update(summarize_usage(jobs, day_keys))
+
+    succeeded = run_bulk(es, rollup_actions(totals, version))
+    return set(key for key in totals if rollup_id(key) in succeeded)
+
+def run_bulk(es, actions):
+    """
+    Send actions using the bulk API, retrying any which fail, and return the responses of those
+    which succeeded keyed by id. A version conflict means that a newer version of the document has
+    already been written, so is not a failure
+    """
+    succeeded = {}
+    for attempt in range(BULK_MAX_RETRIES + 1):
+        failed = []
+        try:
+            for ok, item in streaming_bulk(es,
+                                           actions,
+                                           chunk_size=BULK_CHUNK_SIZE,
+                                           max_retries=BULK_MAX_RETRIES,
+                                           initial_backoff=BULK_BACKOFF,
+                                           raise_on_error=False,
+                                           raise_on_exception=False):
+                response = list(item.values())[0]
+                if ok or response.get('status') == 409:
+                    succeeded[str(response['_id'])] = response
+                else:
+                    logger.error('Error sending %s to elasticsearch: %s', response.get('_id'), response.get('error'))
+                    failed.append(str(response.get('_id')))
+        except Exception as err:
+            logger.error('Error sending records to elasticsearch: %s', err)
+            failed = [str(action['_id']) for action in actions if str(action['_id']) not in succeeded]
+
+        actions = [action for action in actions if str(action['_id']) in failed]
+        if not actions:
+            break
+        if attempt < BULK_MAX_RETRIES:
+            logger.info('Retrying %d records which could not be sent to elasticsearch', len(actions))
+            time.sleep(BULK_BACKOFF*2**attempt)
+
+    return succeeded
+
+def accounting_bulk(ads):
+    """
+    Send records for multiple jobs to Elasticsearch using the bulk API. Returns the cluster ids of the
+    jobs which were successfully indexed, or which do not require a record
+    """
+    done = set()
+    jobs = {}
+    for ad in ads:
+        try:
+            job = process_record(ad)
+        except Exception as err:
+            logger.error('Unable to create record for job %s: %s', ad.get('ClusterId'), err)
+            continue
+        if job is None:
+            done.add(int(ad['ClusterId']))
+        else:
+            jobs[str(job['id'])] = job
+
+    if not jobs:
+        return done
+
+    es = get_client()
+    actions = [{'_op_type': 'index',
+                '_index': CONFIG.get('elasticsearch', 'index'),
+                '_type': 'job',
+                '_id': job_id,
+                '_source': job} for job_id, job in jobs.items()]
+    succeeded = run_bulk(es, actions)
+    logger.info('Added %d of %d jobs to ElasticSearch', len(succeeded), len(actions))
+
+    # Jobs are only done once their usage is included in the rollup index too, as otherwise it would
+    # be missing from the usage reported for dates covered by the rollup index
+    if CONFIG.get('elasticsearch', 'rollup-index', fallback=''):
+        keys = dict((job_id, rollup_key(jobs[job_id])) for job_id in succeeded)
+        to_update = set(key for key in keys.values() if key)
+        try:
+            updated = update_rollup(es, to_update)
+        except Exception as err:
+            logger.error('Unable to update usage rollup in elasticsearch: %s', err)
+            updated = set()
+        if len(updated) < len(to_update):
+            logger.error('Unable to update usage rollup for all jobs')
+        succeeded = [job_id for job_id in succeeded if not keys[job_id] or keys[job_id] in updated]
+
+    done.update(int(job_id) for job_id in succeeded)
+
+    return done
+
 def accounting(ad):
     # Create record from job ClassAd
     job = process_record(ad)
 
     # Send record to ElasticSearch
-    es = Elasticsearch([{'host':CONFIG.get('elasticsearch', 'host'),
-                         'port':CONFIG.get('elasticsearch', 'port')}])
+    es = get_client()
     try:
         result = es.index(index=CONFIG.get('elasticsearch', 'index'),
                           doc_type='job',
@@ -168,6 +380,14 @@ def accounting(ad):
         return None
 
     if 'result' in result:
+        if result['result'] in ('created', 'updated'):
+            key = rollup_key(job)
+            if key and CONFIG.get('elasticsearch', 'rollup-index', fallback=''):
+                try:
+                    if not update_rollup(es, set([key])):
+                        logger.error('Unable to update usage rollup for job')
+                except Exception as err:
+                    logger.error('Error updating usage rollup in elasticsearch: %s', err)
         if result['result'] == 'created':
             logger.info('Added job to ElasticSearch')
             return True
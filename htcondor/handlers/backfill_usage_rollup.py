@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+"""Fill the usage rollup index from the job records already in Elasticsearch"""
+import argparse
+import logging
+import time
+
+from elasticsearch.helpers import scan
+
+import accounting_es
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fill the usage rollup index from existing job records')
+    parser.add_argument('--since',
+                        dest='since',
+                        default='1970-01-01',
+                        help='Only include jobs submitted on or after this date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    logger = logging.getLogger('process_completed_jobs')
+
+    rollup_index = accounting_es.CONFIG.get('elasticsearch', 'rollup-index', fallback='')
+    if not rollup_index:
+        logger.error('No rollup index is configured')
+        exit(1)
+
+    es = accounting_es.get_client()
+    query = {'query': {'bool': {'filter': [{'match': {'type': 'job'}},
+                                           {'exists': {'field': 'execution.tasks'}},
+                                           {'range': {'date': {'gte': args.since}}}]}}}
+
+    # The usage of each day, group and username is recalculated from all of its jobs, so this can
+    # safely be re-run and can overlap with jobs being added as they complete
+    version = int(time.time()*1000000)
+    jobs = (hit['_source'] for hit in scan(es, index=accounting_es.CONFIG.get('elasticsearch', 'index'), query=query))
+    actions = accounting_es.rollup_actions(accounting_es.summarize_usage(jobs), version)
+    total = len(actions)
+    added = len(accounting_es.run_bulk(es, actions))
+    logger.info('Added usage of %d of %d users and days to the rollup index', added, total)
+
+    if added < total:
+        logger.error('Not all usage was added to the rollup index, re-run to try again')
+        exit(1)
+
+    # Record the earliest date covered by the rollup index, so that usage for earlier dates is
+    # taken from the job index
+    es.index(index=rollup_index,
+             doc_type='_doc',
+             id=accounting_es.ROLLUP_COVERAGE_ID,
+             body={'type': 'coverage', 'date': '%sT00:00:00Z' % args.since})
+    logger.info('Rollup index now covers jobs submitted since %s', args.since)
@@ -3,9 +3,11 @@ import configparser
 import glob
 import json
 import logging
+import os
 from logging.handlers import RotatingFileHandler
 import re
 import shutil
+import threading
 import time
 
 import classad
@@ -16,6 +18,15 @@ import completed_jobs_db
 
 logger = logging.getLogger('process_completed_jobs.process_completed_jobs')
 
+# Jobs are processed by several threads at once, so access to the completed jobs database is serialized
+DB_LOCK = threading.Lock()
+
+# Number of times a job's record can fail to be indexed before its history file is moved aside, the
+# directory it is moved to, and the file recording the number of failures for each history file
+MAX_ATTEMPTS = 10
+FAILED_DIR = '/var/spool/prominence/completed_jobs_failed'
+ATTEMPTS_FILE = '/var/spool/prominence/completed_jobs_attempts.json'
+
 def format_duration(tis):
     """
     Format a duration nicely
@@ -104,6 +115,20 @@ def handle_notifications(ad, iwd, job_id_original, job_id_routed, identity, emai
                     send_completed_email('jobFinished', job_id_original, job_id_routed, identity, email, job_name, site, promlet_json)
 
 
+def is_done(cluster_id):
+    """
+    Check if a job has already been processed
+    """
+    with DB_LOCK:
+        return completed_jobs_db.is_done(cluster_id)
+
+def add_job(cluster_id):
+    """
+    Record that a job has been processed
+    """
+    with DB_LOCK:
+        completed_jobs_db.add_job(cluster_id)
+
 def move(filename):
     """
     Move history file to the processed directory
@@ -113,11 +138,57 @@ def move(filename):
     except Exception as err:
         logger.error('Unable to move file %s due to: %s', filename, err)
 
-def process(ad, filename=None):
+def record_failures(filenames):
+    """
+    Record that the jobs in the given history files could not be indexed. History files which have
+    failed too many times are moved to the failed directory so that they are not retried forever
+    """
+    try:
+        with open(ATTEMPTS_FILE) as attempts_fd:
+            attempts = json.load(attempts_fd)
+    except Exception:
+        attempts = {}
+
+    # Forget about history files which have since been processed
+    attempts = {filename: count for filename, count in attempts.items() if os.path.exists(filename)}
+
+    for filename in filenames:
+        attempts[filename] = attempts.get(filename, 0) + 1
+        if attempts[filename] >= MAX_ATTEMPTS:
+            logger.error('Record for history file %s could not be indexed after %d attempts, moving it to %s',
+                         filename, attempts[filename], FAILED_DIR)
+            try:
+                os.makedirs(FAILED_DIR, exist_ok=True)
+                shutil.move(filename, os.path.join(FAILED_DIR, os.path.basename(filename)))
+                del attempts[filename]
+            except Exception as err:
+                logger.error('Unable to move file %s due to: %s', filename, err)
+
+    try:
+        with open('%s.tmp' % ATTEMPTS_FILE, 'w') as attempts_fd:
+            json.dump(attempts, attempts_fd)
+        os.replace('%s.tmp' % ATTEMPTS_FILE, ATTEMPTS_FILE)
+    except Exception as err:
+        logger.error('Unable to write file %s due to: %s', ATTEMPTS_FILE, err)
+
+def requires_accounting(ad):
+    """
+    Check if a record needs to be sent to ElasticSearch for a completed job
+    """
+    if is_done(int(ad['ClusterId'])):
+        return False
+    if 'ProminenceType' not in ad:
+        return False
+    if 'RouteName' in ad:
+        if ad['RouteName'] == 'cloud':
+            return False
+    return True
+
+def process(ad, filename=None, accounting=True):
     """
-    Handle completed jobs
+    Handle completed jobs. If accounting is False the record must already have been sent to ElasticSearch
     """
-    processed = completed_jobs_db.is_done(int(ad['ClusterId']))
+    processed = is_done(int(ad['ClusterId']))
     if processed:
         logger.info('Job has been processing, no more to do')
         if filename:
@@ -168,13 +239,14 @@ def process(ad, filename=None):
         status = int(ad['JobStatus'])
 
     # Send record to ElasticSearch
-    accounting_es.accounting(ad)
+    if accounting:
+        accounting_es.accounting(ad)
 
     # Handle notifications if necessary
     if status == 4 and email:
         handle_notifications(ad, iwd, job_id_original, job_id_routed, identity, email, site)
 
-    completed_jobs_db.add_job(int(ad['ClusterId']))
+    add_job(int(ad['ClusterId']))
     if filename:
         move(filename)
 
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+"""Long-running processor for completed jobs, replacing the per-minute cron jobs"""
+import argparse
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import glob
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import sys
+import threading
+import time
+
+import htcondor
+import classad
+
+import accounting_es
+import completed_jobs_db
+import process_completed_jobs
+
+# Directory containing per-job history files
+HISTORY_DIR = '/var/spool/prominence/completed_jobs'
+
+# Defaults for the [completed] section of the config file
+POLL_INTERVAL = 5
+WORKERS = 8
+BATCH_SIZE = 5000
+LOCK_FILE = '/var/spool/prominence/process_completed_jobs.lock'
+STATUS_FILE = '/var/spool/prominence/process_completed_jobs.json'
+
+# Time window used to find completed jobs still in the queue when there is no saved position
+QUEUE_INITIAL_WINDOW = 120
+
+# Time after which the list of schedds is refreshed
+SCHEDD_REFRESH_INTERVAL = 600
+
+logger = logging.getLogger('process_completed_jobs')
+
+class CompletedJobsProcessor(object):
+    """
+    Find completed jobs and process them using a pool of worker threads
+    """
+    def __init__(self, config):
+        self._poll_interval = config.getfloat('completed', 'poll-interval', fallback=POLL_INTERVAL)
+        self._batch_size = config.getint('completed', 'batch-size', fallback=BATCH_SIZE)
+        self._status_file = config.get('completed', 'status-file', fallback=STATUS_FILE)
+        self._pool = ThreadPoolExecutor(max_workers=config.getint('completed', 'workers', fallback=WORKERS))
+
+        # Jobs submitted to the pool which have not yet finished, keyed by cluster id
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        self._schedds = []
+        self._schedds_time = 0
+
+        self._queue_since = None
+        self._processed = 0
+        self._failed = 0
+        self._completions = []
+        self._lag = 0
+        self._backlog = 0
+        self._started = time.time()
+
+        self._load_status()
+
+    def _load_status(self):
+        """
+        Restore the position in the queue from the status file
+        """
+        try:
+            with open(self._status_file) as status_fd:
+                self._queue_since = json.load(status_fd).get('queueSince')
+        except Exception:
+            pass
+
+    def _write_status(self):
+        """
+        Write lag and throughput metrics to the status file
+        """
+        now = time.time()
+        with self._lock:
+            self._completions = [item for item in self._completions if now - item < 60]
+            status = {'timestamp': int(now),
+                      'uptime': int(now - self._started),
+                      'processed': self._processed,
+                      'failed': self._failed,
+                      'processedLastMinute': len(self._completions),
+                      'inFlight': len(self._in_flight),
+                      'backlogFiles': self._backlog,
+                      'lagSeconds': int(self._lag),
+                      'queueSince': self._queue_since}
+
+        try:
+            with open('%s.tmp' % self._status_file, 'w') as status_fd:
+                json.dump(status, status_fd)
+            os.replace('%s.tmp' % self._status_file, self._status_file)
+        except Exception as err:
+            logger.error('Unable to write status file due to: %s', err)
+
+        return status
+
+    def _submit(self, cluster_id, ad, filename=None, accounting=True):
+        """
+        Process a job in the worker pool unless it is already being processed
+        """
+        with self._lock:
+            if cluster_id in self._in_flight:
+                return
+            self._in_flight[cluster_id] = time.time()
+
+        self._pool.submit(self._process, cluster_id, ad, filename, accounting)
+
+    def _process(self, cluster_id, ad, filename, accounting):
+        """
+        Process a single job
+        """
+        try:
+            process_completed_jobs.process(ad, filename, accounting=accounting)
+            success = True
+        except Exception as err:
+            logger.error('Unable to process job %d due to: %s', cluster_id, err)
+            success = False
+
+        with self._lock:
+            del self._in_flight[cluster_id]
+            if success:
+                self._processed += 1
+                self._completions.append(time.time())
+            else:
+                self._failed += 1
+
+    def _get_schedds(self):
+        """
+        Return the schedds, locating them again if necessary
+        """
+        if not self._schedds or time.time() - self._schedds_time > SCHEDD_REFRESH_INTERVAL:
+            coll = htcondor.Collector()
+            self._schedds = [htcondor.Schedd(coll.locate(htcondor.DaemonTypes.Schedd, result["Name"]))
+                             for result in coll.query(htcondor.AdTypes.Schedd, "true", ["Name"])]
+            self._schedds_time = time.time()
+        return self._schedds
+
+    def check_queue(self):
+        """
+        Find jobs which have completed since the last check but are still in the queue
+        """
+        now = int(time.time())
+        since = self._queue_since
+        if since is None:
+            since = now - QUEUE_INITIAL_WINDOW
+
+        try:
+            for schedd in self._get_schedds():
+                jobs = schedd.query('JobStatus == 4 && EnteredCurrentStatus >= %d && isUndefined(RoutedBy)' % since)
+                for job in jobs:
+                    cluster_id = int(job['ClusterId'])
+                    if not process_completed_jobs.is_done(cluster_id):
+                        logger.info('Working on completed job in queue %d', cluster_id)
+                        self._submit(cluster_id, job)
+        except Exception as err:
+            logger.error('Unable to query schedds due to: %s', err)
+            self._schedds = []
+            return
+
+        # Allow for jobs whose status changed during the query
+        self._queue_since = now - int(self._poll_interval) - 1
+
+    def check_history(self):
+        """
+        Find history files for jobs which have left the queue
+        """
+        filenames = glob.glob('%s/history.*' % HISTORY_DIR)
+        self._backlog = len(filenames)
+
+        # The lag is the age of the oldest history file, including those beyond this batch
+        lag = 0
+        for filename in filenames:
+            try:
+                lag = max(lag, time.time() - os.stat(filename).st_mtime)
+            except OSError:
+                pass
+        self._lag = lag
+
+        ads = {}
+        for filename in filenames:
+            if len(ads) >= self._batch_size:
+                break
+            try:
+                with open(filename, 'r') as fd:
+                    ad = classad.parseOne(fd, parser=classad.Parser.Old)
+            except Exception as err:
+                logger.error('Unable to read file %s due to: %s', filename, err)
+                continue
+            with self._lock:
+                if int(ad['ClusterId']) in self._in_flight:
+                    continue
+            ads[filename] = ad
+
+        if not ads:
+            return
+
+        # Send records for all jobs which need them to ElasticSearch in bulk
+        to_index = [ad for ad in ads.values() if process_completed_jobs.requires_accounting(ad)]
+        indexed = accounting_es.accounting_bulk(to_index)
+        to_index = set(int(ad['ClusterId']) for ad in to_index)
+
+        # History files are only moved once the job's record has been successfully indexed
+        failed = []
+        for filename, ad in ads.items():
+            cluster_id = int(ad['ClusterId'])
+            if cluster_id in to_index and cluster_id not in indexed:
+                logger.info('Record for job %d not indexed, will retry later', cluster_id)
+                failed.append(filename)
+                continue
+            self._submit(cluster_id, ad, filename, accounting=False)
+
+        if failed:
+            process_completed_jobs.record_failures(failed)
+
+    def run(self):
+        """
+        Check for completed jobs until interrupted
+        """
+        while True:
+            start_time = time.time()
+            self.check_queue()
+            self.check_history()
+            status = self._write_status()
+            logger.info('Processed %d jobs in the last minute, %d in flight, %d history files, lag %d s',
+                        status['processedLastMinute'], status['inFlight'], status['backlogFiles'], status['lagSeconds'])
+            time.sleep(max(0, self._poll_interval - (time.time() - start_time)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Process completed jobs')
+    parser.add_argument('--status', action='store_true', help='Print the lag and throughput metrics and exit')
+    args = parser.parse_args()
+
+    # Read config file
+    CONFIG = configparser.ConfigParser()
+    CONFIG.read('/etc/prominence/prominence.ini')
+
+    if args.status:
+        with open(CONFIG.get('completed', 'status-file', fallback=STATUS_FILE)) as status_fd:
+            print(json.dumps(json.load(status_fd), indent=2))
+        sys.exit(0)
+
+    # Only a single instance can run, so this can be started from cron as a watchdog
+    lock_fd = open(CONFIG.get('completed', 'lock-file', fallback=LOCK_FILE), 'w')
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        sys.exit(0)
+
+    # Logging
+    handler = RotatingFileHandler(CONFIG.get('logs', 'completed'),
+                                  maxBytes=int(CONFIG.get('logs', 'max_bytes')),
+                                  backupCount=int(CONFIG.get('logs', 'num')))
+    formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    completed_jobs_db.init_db()
+    CompletedJobsProcessor(CONFIG).run()
@@ -15,6 +15,9 @@ import accounting_es
 import completed_jobs_db
 import process_completed_jobs
 
+# Maximum number of history files handled at once
+BATCH_SIZE = 5000
+
 if __name__ == "__main__":
     # Read config file
     CONFIG = configparser.ConfigParser()
@@ -32,9 +35,32 @@ if __name__ == "__main__":
 
     completed_jobs_db.init_db()
 
-    for filename in glob.glob('/var/spool/prominence/completed_jobs/history.*'):
-        logger.info('Working on file %s', filename)
+    filenames = glob.glob('/var/spool/prominence/completed_jobs/history.*')
+    logger.info('Found %d history files', len(filenames))
+
+    for index in range(0, len(filenames), BATCH_SIZE):
+        ads = {}
+        for filename in filenames[index:index + BATCH_SIZE]:
+            logger.info('Working on file %s', filename)
+            try:
+                with open(filename, 'r') as fd:
+                    ads[filename] = classad.parseOne(fd, parser=classad.Parser.Old)
+            except Exception as err:
+                logger.error('Unable to read file %s due to: %s', filename, err)
+
+        # Send records for all jobs which need them to ElasticSearch in bulk
+        to_index = [ad for ad in ads.values() if process_completed_jobs.requires_accounting(ad)]
+        indexed = accounting_es.accounting_bulk(to_index)
+        to_index = set(int(ad['ClusterId']) for ad in to_index)
+
+        # History files are only moved once the job's record has been successfully indexed
+        failed = []
+        for filename, ad in ads.items():
+            if int(ad['ClusterId']) in to_index and int(ad['ClusterId']) not in indexed:
+                logger.info('Record for job %d not indexed, will retry later', int(ad['ClusterId']))
+                failed.append(filename)
+                continue
+            process_completed_jobs.process(ad, filename, accounting=False)
 
-        with open(filename, 'r') as fd:
-            ad = classad.parseOne(fd, parser=classad.Parser.Old)
-            process_completed_jobs.process(ad, filename)
+        if failed:
+            process_completed_jobs.record_failures(failed)
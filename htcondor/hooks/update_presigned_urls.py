@@ -1,4 +1,5 @@
 import boto3
+import calendar
 import configparser
 import json
 import logging
@@ -18,12 +19,32 @@ CONFIG.read('/etc/prominence/prominence.ini')
 
 THRESHOLD = 5*24*60*60
 
+# S3 client, created when first needed and re-used for all URLs
+S3_CLIENT = None
+
+def _get_s3_client():
+    """
+    Return the S3 client, creating it if necessary
+    """
+    global S3_CLIENT
+    if S3_CLIENT is None:
+        S3_CLIENT = boto3.client('s3',
+                                 endpoint_url=CONFIG.get('s3', 'url'),
+                                 aws_access_key_id=CONFIG.get('s3', 'access_key_id'),
+                                 aws_secret_access_key=CONFIG.get('s3', 'secret_access_key'))
+    return S3_CLIENT
+
 def _get_expiry(url):
     """
-    Return the expiry time of a presigned URL
+    Return the expiry time of a presigned URL. Version 4 signatures give the signing time and the
+    duration, while version 2 signatures give the expiry time directly
     """
     expires = 0
-    match = re.search('Expires=(\d\d\d\d\d\d\d\d\d\d)', url)
+    date = re.search(r'[?&]X-Amz-Date=(\d{8}T\d{6}Z)', url)
+    duration = re.search(r'[?&]X-Amz-Expires=(\d+)', url)
+    if date and duration:
+        return calendar.timegm(time.strptime(date.group(1), '%Y%m%dT%H%M%SZ')) + int(duration.group(1))
+    match = re.search(r'[?&]Expires=(\d\d\d\d\d\d\d\d\d\d)', url)
     if match:
         expires = int(match.group(1))
     return expires
@@ -32,10 +53,7 @@ def _create_presigned_url(method, object_name, duration_in_seconds=600):
     """
     Create presigned S3 URL
     """
-    s3_client = boto3.client('s3',
-                             endpoint_url=CONFIG.get('s3', 'url'),
-                             aws_access_key_id=CONFIG.get('s3', 'access_key_id'),
-                             aws_secret_access_key=CONFIG.get('s3', 'secret_access_key'))
+    s3_client = _get_s3_client()
     if method == 'get':
         try:
             response = s3_client.generate_presigned_url('get_object',
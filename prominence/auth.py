@@ -1,15 +1,41 @@
 """Authorisation functions"""
 from __future__ import print_function
+from collections import OrderedDict
 from functools import wraps
+import hashlib
+import json
+import threading
 import time
 import requests
 import jwt
 from flask import jsonify, request
 from flask import current_app as app
 
+from .backend.metrics import increment, observe
 from .errors import auth_failure, oidc_error
+from . import kv_client
 from .utilities import get_remote_addr
 
+# Cache of user details from the identity provider, keyed by the SHA256 hash of the token
+USERINFO_CACHE = OrderedDict()
+USERINFO_CACHE_LOCK = threading.Lock()
+
+# Client for fetching the signing keys of the identity provider
+JWKS_CLIENT = None
+JWKS_CLIENT_LOCK = threading.Lock()
+JWKS_ISSUER = None
+
+# Time after which discovery of the signing keys is retried following a failure, and the current
+# backoff, which doubles after each consecutive failure up to a maximum
+JWKS_RETRY_TIME = 0
+JWKS_BACKOFF = 0
+JWKS_BACKOFF_MIN = 10
+JWKS_BACKOFF_MAX = 600
+
+# Prefix for keys in the optional cache shared by all API processes. Keys of users in the key-value
+# store always begin with /<username>/, so keys without a leading slash can never be accessed by users
+USERINFO_SHARED_PREFIX = '_cache_/userinfo/'
+
 def validate_token(token):
     """
     Try to decode the token using the job token secret and return the username and groups if the token is valid
@@ -52,46 +78,36 @@ def get_user_details_with_retries(token):
         time.sleep(count*0.2)
     return (success, username, group, email, allowed)
 
-def get_user_details(token):
+def get_user_details_from_claims(claims):
     """
-    Get the username and group from a token
+    Get the username, groups, email and whether the user is allowed access from a set of claims
     """
-    if not app.config['OIDC_URL']:
-        return (False, None, None, False)
-
-    headers = {'Authorization':'Bearer %s' % token}
-    try:
-        response = requests.get(app.config['OIDC_URL']+'/userinfo', timeout=app.config['OIDC_TIMEOUT'], headers=headers)
-    except requests.exceptions.RequestException as err:
-        app.logger.warning('%s AuthenticationFailure no response from identity provider: %s' % (get_remote_addr(request), err))
-        return (False, None, None, False)
-
     username = None
     if 'USERNAME_FROM' in app.config:
-        if app.config['USERNAME_FROM'] in response.json():
-            username = str(response.json()[app.config['USERNAME_FROM']])
-    elif 'sub' in response.json():
-        username = str(response.json()['sub'])
-    elif 'preferred_username' in response.json():
-        username = str(response.json()['preferred_username'])
+        if app.config['USERNAME_FROM'] in claims:
+            username = str(claims[app.config['USERNAME_FROM']])
+    elif 'sub' in claims:
+        username = str(claims['sub'])
+    elif 'preferred_username' in claims:
+        username = str(claims['preferred_username'])
 
     email = None
-    if 'email' in response.json():
-        email = response.json()['email']
+    if 'email' in claims:
+        email = claims['email']
 
     groups = None
-    if 'groups' in response.json():
-        if len(response.json()['groups']) > 0:
-            groups = ','.join(str(group) for group in response.json()['groups'])
+    if 'groups' in claims:
+        if len(claims['groups']) > 0:
+            groups = ','.join(str(group) for group in claims['groups'])
 
     allowed = False
     if app.config['REQUIRED_ENTITLEMENTS'] != '':
-        if 'edu_person_entitlements' in response.json():
+        if 'edu_person_entitlements' in claims:
             for vo in app.config['REQUIRED_ENTITLEMENTS']:
                 num_required = len(app.config['REQUIRED_ENTITLEMENTS'][vo])
                 num_have = 0
                 for entitlement in app.config['REQUIRED_ENTITLEMENTS'][vo]:
-                    if entitlement in response.json()['edu_person_entitlements']:
+                    if entitlement in claims['edu_person_entitlements']:
                         if 'role=member' in entitlement and not groups:
                             groups = vo
                         num_have += 1
@@ -101,8 +117,156 @@ def get_user_details(token):
     else:
         allowed = True
 
+    return (username, groups, email, allowed)
+
+def get_jwks_client():
+    """
+    Return the client used to fetch the signing keys of the identity provider, which caches the keys.
+    Failures of the discovery request are cached with a backoff so that the identity provider is not
+    contacted on every request while it is unavailable
+    """
+    global JWKS_CLIENT, JWKS_ISSUER, JWKS_RETRY_TIME, JWKS_BACKOFF
+    with JWKS_CLIENT_LOCK:
+        if JWKS_CLIENT is None:
+            if time.time() < JWKS_RETRY_TIME:
+                raise Exception('discovery failed recently, retrying in %d seconds' % (JWKS_RETRY_TIME - time.time()))
+            try:
+                response = requests.get('%s/.well-known/openid-configuration' % app.config['OIDC_URL'],
+                                        timeout=app.config['OIDC_TIMEOUT'])
+                response.raise_for_status()
+                configuration = response.json()
+                issuer = configuration['issuer']
+                client = jwt.PyJWKClient(app.config.get('OIDC_JWKS_URL') or configuration['jwks_uri'], cache_keys=True)
+            except Exception:
+                JWKS_BACKOFF = min(max(2*JWKS_BACKOFF, JWKS_BACKOFF_MIN), JWKS_BACKOFF_MAX)
+                JWKS_RETRY_TIME = time.time() + JWKS_BACKOFF
+                increment('jwks_discovery_failures')
+                raise
+            JWKS_ISSUER = issuer
+            JWKS_CLIENT = client
+            JWKS_BACKOFF = 0
+        return JWKS_CLIENT
+
+def get_user_details_local(token):
+    """
+    Verify the signature of a token locally and get the user details from its claims. Returns whether the
+    token is valid and the user details, which are None if they must instead be obtained from the identity
+    provider
+    """
+    start_time = time.time()
+    try:
+        signing_key = get_jwks_client().get_signing_key_from_jwt(token)
+    except Exception as err:
+        # The token may not be a JWT, or we are unable to get the keys
+        app.logger.warning('%s Unable to get signing key for token: %s' % (get_remote_addr(request), err))
+        return (True, None)
+
+    # Tokens issued to the API are expected to be intended for it unless a different audience is configured
+    audience = app.config.get('OIDC_AUDIENCE') or app.config.get('OIDC_CLIENT_ID')
+    try:
+        claims = jwt.decode(token,
+                            signing_key.key,
+                            algorithms=['RS256', 'ES256'],
+                            audience=audience if audience else None,
+                            issuer=JWKS_ISSUER,
+                            options={'verify_aud': bool(audience)})
+    except jwt.exceptions.InvalidTokenError as err:
+        app.logger.warning('%s AuthenticationFailure token verification failed: %s' % (get_remote_addr(request), err))
+        return (False, None)
+    observe('jwt_verify_seconds', time.time() - start_time)
+
+    (username, groups, email, allowed) = get_user_details_from_claims(claims)
+
+    # Fall back to the userinfo endpoint if the claims we need are not in the token. Identity providers
+    # often only return groups from userinfo, so it is needed unless the entitlements supplied a group
+    if not username or \
+       (app.config['REQUIRED_ENTITLEMENTS'] != '' and 'edu_person_entitlements' not in claims) or \
+       ('groups' not in claims and not groups):
+        increment('jwt_claims_missing')
+        return (True, None)
+
+    increment('jwt_verified')
+    return (True, (True, username, groups, email, allowed))
+
+def get_user_details(token):
+    """
+    Get the username and group from a token
+    """
+    if not app.config['OIDC_URL']:
+        return (False, None, None, None, False)
+
+    headers = {'Authorization':'Bearer %s' % token}
+    try:
+        response = requests.get(app.config['OIDC_URL']+'/userinfo', timeout=app.config['OIDC_TIMEOUT'], headers=headers)
+        userinfo = response.json()
+    except (requests.exceptions.RequestException, ValueError) as err:
+        app.logger.warning('%s AuthenticationFailure no response from identity provider: %s' % (get_remote_addr(request), err))
+        return (False, None, None, None, False)
+
+    (username, groups, email, allowed) = get_user_details_from_claims(userinfo)
+
     return (True, username, groups, email, allowed)
 
+def _store_user_details(key, expiry, details):
+    """
+    Add user details to the in-process cache, evicting the least recently used entries if necessary
+    """
+    with USERINFO_CACHE_LOCK:
+        USERINFO_CACHE[key] = (expiry, details)
+        USERINFO_CACHE.move_to_end(key)
+        while len(USERINFO_CACHE) > int(app.config.get('USERINFO_CACHE_SIZE', 10000)):
+            USERINFO_CACHE.popitem(last=False)
+
+def get_user_details_cached(token):
+    """
+    Get the username and group from a token, using the cache if possible
+    """
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    now = time.time()
+    shared = app.config.get('USERINFO_CACHE_SHARED') == 'True'
+
+    with USERINFO_CACHE_LOCK:
+        if key in USERINFO_CACHE:
+            (expiry, details) = USERINFO_CACHE[key]
+            if expiry > now:
+                USERINFO_CACHE.move_to_end(key)
+                increment('userinfo_cache_hits')
+                return details
+            del USERINFO_CACHE[key]
+
+    if shared:
+        try:
+            (value, _) = kv_client.get_client(app.config).get('%s%s' % (USERINFO_SHARED_PREFIX, key))
+            if value:
+                (expiry, details) = json.loads(value)
+                if expiry > now:
+                    increment('userinfo_cache_shared_hits')
+                    details = tuple(details)
+                    _store_user_details(key, expiry, details)
+                    return details
+        except Exception as err:
+            app.logger.warning('Unable to read from shared user details cache: %s', err)
+
+    increment('userinfo_cache_misses')
+    start_time = time.time()
+    details = get_user_details(token)
+    observe('userinfo_idp_seconds', time.time() - start_time)
+
+    # Only cache successful lookups, and never beyond the expiry time of the token
+    (success, username, _, _, _) = details
+    if success and username:
+        expiry = min(get_expiry(token), now + int(app.config.get('USERINFO_CACHE_TTL', 300)))
+        _store_user_details(key, expiry, details)
+        if shared and expiry > now:
+            try:
+                client = kv_client.get_client(app.config)
+                lease = client.lease(int(expiry - now) + 1)
+                client.put('%s%s' % (USERINFO_SHARED_PREFIX, key), json.dumps([expiry, details]), lease=lease)
+            except Exception as err:
+                app.logger.warning('Unable to write to shared user details cache: %s', err)
+
+    return details
+
 def authenticate():
     """
     Sends a 401 response
@@ -136,9 +300,17 @@ def requires_auth_check():
         success = True
         allowed = True
 
+    # Verify the token locally if enabled
+    if not success and app.config.get('OIDC_VERIFY_LOCALLY') == 'True':
+        (valid, details) = get_user_details_local(token)
+        if not valid:
+            raise ValueError()
+        if details:
+            (success, username, group, email, allowed) = details
+
     # Query OIDC server if necessary
     if not success:
-       (success, username, group, email, allowed) = get_user_details(token)
+       (success, username, group, email, allowed) = get_user_details_cached(token)
 
     if not success:
         raise ValueError('OIDC')
@@ -10,6 +10,7 @@ class ProminenceBackend(object):
 
     from .create_job import create_job
     from .list_jobs import list_jobs
+    from .job_index import update_job_index, query_job_index
     from .delete_job import delete_job
     from .remove_job import remove_job
     from .remove_workflow import remove_workflow
@@ -17,12 +18,12 @@ class ProminenceBackend(object):
     from .list_workflows import list_workflows
     from .delete_workflow import delete_workflow
     from .rerun_workflow import rerun_workflow
-    from .get_stdout import get_stdout
-    from .get_stderr import get_stderr
+    from .get_stdout import get_stdout_filename
+    from .get_stderr import get_stderr_filename
     from .execute_command import execute_command, _execute_command
     from .snapshots import create_snapshot, get_snapshot_url, validate_snapshot_path, _create_and_upload
-    from .data import create_presigned_url, list_objects, delete_object, get_object
-    from .get_job_unique_id import get_job_unique_id
+    from .data import create_presigned_url, create_presigned_urls, create_multipart_upload, create_multipart_urls, complete_multipart_upload, abort_multipart_upload, list_objects, delete_object, get_object
+    from .get_job_unique_id import get_job_unique_id, is_job_active
     from .create_htcondor_job import _create_htcondor_job
     from .health import get_health
     from .resources import get_existing_resources
@@ -3,7 +3,7 @@ import json
 import os
 import math
 
-from .utilities import condor_str, retry, validate_presigned_url
+from .utilities import condor_str, output_dir_extension, retry, validate_presigned_url
 from .create_job_token import create_job_token
 
 def _create_htcondor_job(self, username, groups, email, uid, jjob, job_path, workflow=False, jobfactory=False, workflowuid=None, joblabel=None):
@@ -321,19 +321,20 @@ def _create_htcondor_job(self, username, groups, email, uid, jjob, job_path, wor
         output_dirs_new = []
         output_locations_put = []
 
+        extension = output_dir_extension(jjob)
         for dirname in jjob['outputDirs']:
             if not jobfactory:
                 if not joblabel:
                     url_put = self.create_presigned_url('put',
-                                                        'scratch/%s/%s.tgz' % (uid, os.path.basename(dirname)),
+                                                        'scratch/%s/%s.%s' % (uid, os.path.basename(dirname), extension),
                                                         864000)
                 else:
                     url_put = self.create_presigned_url('put',
-                                                        'scratch/%s/%s/%s.tgz' % (workflowuid, joblabel, os.path.basename(dirname)),
+                                                        'scratch/%s/%s/%s.%s' % (workflowuid, joblabel, os.path.basename(dirname), extension),
                                                         864000)
             elif joblabel:
                 url_put = self.create_presigned_url('put',
-                                                    'scratch/%s/%s/%s.tgz' % (workflowuid, joblabel, os.path.basename(dirname)),
+                                                    'scratch/%s/%s/%s.%s' % (workflowuid, joblabel, os.path.basename(dirname), extension),
                                                     864000)
             else:
                 url_put = dirname
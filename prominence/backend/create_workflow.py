@@ -45,13 +45,16 @@ def _create_mapped_json(self, path, job_index, mapping, job_name):
         return None, None
     new_job_json = job_json.copy()
 
-    # Update artifact URLs
+    # Object names requiring presigned URLs, which are all signed together below
+    requests = []
+
+    # Artifacts
+    artifacts = []
     if 'artifacts' in job_json:
-        new_artifacts = []
         for artifact in job_json['artifacts']:
             if 'url' in artifact:
                 # Exctract object name from presigned URL
-                name = unquote(artifact['url'].split(self._config['S3_BUCKET'])[1].split('?AWSAccessKeyId')[0][1:])
+                name = unquote(artifact['url'].split(self._config['S3_BUCKET'])[1].split('?')[0][1:])
 
                 # Check if a parameter is in the artifact
                 template_needed = False
@@ -63,69 +66,57 @@ def _create_mapped_json(self, path, job_index, mapping, job_name):
                     value = mapping[key]
                     name = Template(name).safe_substitute({key:value})
 
-                # Create new presigned URL
-                new_url = self.create_presigned_url('get',
-                                                    name,
-                                                    864000)
-
-                # Validate
-                if template_needed:
-                    url_exists = validate_presigned_url(new_url)
-                    if not url_exists:
-                        pieces = name.split('/')
-                        artifact_name = pieces[len(pieces)-1]
-                        return False, {"error":"Artifact %s does not exist" % artifact_name}
-
-                new_artifact = {'url': new_url}
-                if 'mountpoint' in artifact:
-                    new_artifact['mountpoint'] = artifact['mountpoint']
+                artifacts.append((artifact, name, template_needed, len(requests)))
+                requests.append(('get', name, 864000))
 
-                new_artifacts.append(new_artifact)
-        new_job_json['artifacts'] = new_artifacts
+    # Output files and directories
+    outputs = {}
+    for output_type in ('outputFiles', 'outputDirs'):
+        outputs[output_type] = []
+        if output_type in job_json:
+            for output in job_json[output_type]:
+                if 'url' in output:
+                    # Exctract object name from presigned URL
+                    name = unquote(output['url'].split(self._config['S3_BUCKET'])[1].split('?')[0][1:])
+                    name_pieces = name.split(job_name, 1)
+                    name = '%s%s/%d%s' % (name_pieces[0], job_name, job_index, name_pieces[1])
 
-    # Update output file URLs
-    if 'outputFiles' in job_json:
-        new_outputs = []
-        for output in job_json['outputFiles']:
-            if 'url' in output:
-                # Exctract object name from presigned URL
-                name = unquote(output['url'].split(self._config['S3_BUCKET'])[1].split('?AWSAccessKeyId')[0][1:])
-                name_pieces = name.split(job_name, 1)
-                name = '%s%s/%d%s' % (name_pieces[0], job_name, job_index, name_pieces[1])
+                    # Apply template
+                    for key in mapping:
+                        value = mapping[key]
+                        name = Template(name).safe_substitute({key:value})
 
-                # Apply template
-                for key in mapping:
-                    value = mapping[key]
-                    name = Template(name).safe_substitute({key:value})
+                    outputs[output_type].append((output, len(requests)))
+                    requests.append(('put', name, 864000))
 
-                # Create new presigned URL
-                new_url = self.create_presigned_url('put',
-                                                    name,
-                                                    864000)
-                new_outputs.append({'url': new_url, 'name': output['name']})
-        new_job_json['outputFiles'] = new_outputs
-
-    # Update output file URLs
-    if 'outputDirs' in job_json:
-        new_outputs = []
-        for output in job_json['outputDirs']:
-            if 'url' in output:
-                # Exctract object name from presigned URL
-                name = unquote(output['url'].split(self._config['S3_BUCKET'])[1].split('?AWSAccessKeyId')[0][1:])
-                name_pieces = name.split(job_name, 1)
-                name = '%s%s/%d%s' % (name_pieces[0], job_name, job_index, name_pieces[1])
+    # Create new presigned URLs
+    urls = self.create_presigned_urls(requests)
 
-                # Apply template
-                for key in mapping:
-                    value = mapping[key]
-                    name = Template(name).safe_substitute({key:value})
+    # Update artifact URLs
+    if 'artifacts' in job_json:
+        new_artifacts = []
+        for (artifact, name, template_needed, index) in artifacts:
+            new_url = urls[index]
+
+            # Validate
+            if template_needed:
+                url_exists = validate_presigned_url(new_url)
+                if not url_exists:
+                    pieces = name.split('/')
+                    artifact_name = pieces[len(pieces)-1]
+                    return False, {"error":"Artifact %s does not exist" % artifact_name}
+
+            new_artifact = {'url': new_url}
+            if 'mountpoint' in artifact:
+                new_artifact['mountpoint'] = artifact['mountpoint']
+
+            new_artifacts.append(new_artifact)
+        new_job_json['artifacts'] = new_artifacts
 
-                # Create new presigned URL
-                new_url = self.create_presigned_url('put',
-                                                    name,
-                                                    864000)
-                new_outputs.append({'url': new_url, 'name': output['name']})
-        new_job_json['outputDirs'] = new_outputs
+    # Update output file & directory URLs
+    for output_type in ('outputFiles', 'outputDirs'):
+        if output_type in job_json:
+            new_job_json[output_type] = [{'url': urls[index], 'name': output['name']} for (output, index) in outputs[output_type]]
 
     # Write new mapped JSON file
     try:
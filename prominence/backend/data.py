@@ -1,12 +1,12 @@
 try:
-    from prominence.backend.data_s3 import get_object as s3_get_object, create_presigned_url as s3_create_presigned_url, list_objects as s3_list_objects, delete_object as s3_delete_object
+    from prominence.backend.data_s3 import get_object as s3_get_object, create_presigned_url as s3_create_presigned_url, create_presigned_urls as s3_create_presigned_urls, create_multipart_upload as s3_create_multipart_upload, create_multipart_urls as s3_create_multipart_urls, complete_multipart_upload as s3_complete_multipart_upload, abort_multipart_upload as s3_abort_multipart_upload, list_objects as s3_list_objects, delete_object as s3_delete_object
 except:
-    from .data_s3 import get_object as s3_get_object, create_presigned_url as s3_create_presigned_url, list_objects as s3_list_objects, delete_object as s3_delete_object
+    from .data_s3 import get_object as s3_get_object, create_presigned_url as s3_create_presigned_url, create_presigned_urls as s3_create_presigned_urls, create_multipart_upload as s3_create_multipart_upload, create_multipart_urls as s3_create_multipart_urls, complete_multipart_upload as s3_complete_multipart_upload, abort_multipart_upload as s3_abort_multipart_upload, list_objects as s3_list_objects, delete_object as s3_delete_object
 
 try:
-    from prominence.backend.data_azure import get_object as azure_get_object, create_presigned_url as azure_create_presigned_url, list_objects as azure_list_objects, delete_object as azure_delete_object
+    from prominence.backend.data_azure import get_object as azure_get_object, create_presigned_url as azure_create_presigned_url, create_presigned_urls as azure_create_presigned_urls, create_multipart_upload as azure_create_multipart_upload, create_multipart_urls as azure_create_multipart_urls, complete_multipart_upload as azure_complete_multipart_upload, abort_multipart_upload as azure_abort_multipart_upload, list_objects as azure_list_objects, delete_object as azure_delete_object
 except:
-    from .data_azure import get_object as azure_get_object, create_presigned_url as azure_create_presigned_url, list_objects as azure_list_objects, delete_object as azure_delete_object
+    from .data_azure import get_object as azure_get_object, create_presigned_url as azure_create_presigned_url, create_presigned_urls as azure_create_presigned_urls, create_multipart_upload as azure_create_multipart_upload, create_multipart_urls as azure_create_multipart_urls, complete_multipart_upload as azure_complete_multipart_upload, abort_multipart_upload as azure_abort_multipart_upload, list_objects as azure_list_objects, delete_object as azure_delete_object
 
 def get_object(self, object_name):
     """
@@ -30,6 +30,61 @@ def create_presigned_url(self, method, object_name, duration_in_seconds=600, che
 
     return None
 
+def create_presigned_urls(self, requests):
+    """
+    Create presigned URLs for a list of (method, object name, duration) tuples
+    """
+    if self._config['DEFAULT_STORAGE'] == 's3':
+        return s3_create_presigned_urls(self, requests)
+    elif self._config['DEFAULT_STORAGE'] == 'azure':
+        return azure_create_presigned_urls(self, requests)
+
+    return [None]*len(requests)
+
+def create_multipart_upload(self, object_name, num_parts, duration_in_seconds=7200):
+    """
+    Start a multipart upload, returning the upload id and a URL for each part
+    """
+    if self._config['DEFAULT_STORAGE'] == 's3':
+        return s3_create_multipart_upload(self, object_name, num_parts, duration_in_seconds)
+    elif self._config['DEFAULT_STORAGE'] == 'azure':
+        return azure_create_multipart_upload(self, object_name, num_parts, duration_in_seconds)
+
+    return None, None
+
+def create_multipart_urls(self, object_name, upload_id, first_part, num_parts, duration_in_seconds=7200):
+    """
+    Create URLs for uploading further parts of a multipart upload
+    """
+    if self._config['DEFAULT_STORAGE'] == 's3':
+        return s3_create_multipart_urls(self, object_name, upload_id, first_part, num_parts, duration_in_seconds)
+    elif self._config['DEFAULT_STORAGE'] == 'azure':
+        return azure_create_multipart_urls(self, object_name, upload_id, first_part, num_parts, duration_in_seconds)
+
+    return None
+
+def complete_multipart_upload(self, object_name, upload_id, parts):
+    """
+    Complete a multipart upload given a list of (part number, ETag) tuples
+    """
+    if self._config['DEFAULT_STORAGE'] == 's3':
+        return s3_complete_multipart_upload(self, object_name, upload_id, parts)
+    elif self._config['DEFAULT_STORAGE'] == 'azure':
+        return azure_complete_multipart_upload(self, object_name, upload_id, parts)
+
+    return False
+
+def abort_multipart_upload(self, object_name, upload_id):
+    """
+    Abort a multipart upload
+    """
+    if self._config['DEFAULT_STORAGE'] == 's3':
+        return s3_abort_multipart_upload(self, object_name, upload_id)
+    elif self._config['DEFAULT_STORAGE'] == 'azure':
+        return azure_abort_multipart_upload(self, object_name, upload_id)
+
+    return False
+
 def list_objects(self, user, groups, path=None):
     """
     List objects in S3 storage
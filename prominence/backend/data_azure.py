@@ -1,18 +1,44 @@
+import base64
 from datetime import datetime, timedelta
+import threading
 import time
-from azure.storage.blob import ContainerClient, generate_blob_sas, BlobSasPermissions, BlobServiceClient
+from urllib.parse import quote
+import uuid
+from azure.storage.blob import ContainerClient, generate_blob_sas, BlobSasPermissions
+
+from .metrics import increment
+
+# Clients are thread safe and are shared by all threads in the process, re-using
+# their underlying connection pools
+AZURE_CLIENTS = {}
+AZURE_CLIENTS_LOCK = threading.Lock()
+
+def get_container_client(self):
+    """
+    Return a client for the container, creating it only if one does not already exist
+    """
+    key = (self._config['AZURE_ACCOUNT_NAME'],
+           self._config['AZURE_CREDENTIAL'],
+           self._config['AZURE_CONTAINER_NAME'])
+    with AZURE_CLIENTS_LOCK:
+        if key in AZURE_CLIENTS:
+            increment('azure_clients_reused')
+            return AZURE_CLIENTS[key]
+
+        container = ContainerClient(account_url="https://%s.blob.core.windows.net" % self._config['AZURE_ACCOUNT_NAME'],
+                                    credential=self._config['AZURE_CREDENTIAL'],
+                                    container_name=self._config['AZURE_CONTAINER_NAME'])
+        AZURE_CLIENTS[key] = container
+        increment('azure_clients_created')
+
+    return container
 
 def get_object(self, object_name):
     """
     Get the size & checksum of an object
     """
     try:
-        blob_service_client = BlobServiceClient(account_url=self._config['AZURE_ACCOUNT_NAME'],
-                                                credential=self._config['AZURE_CREDENTIAL'])
-
-        blob_client = blob_service_client.get_blob_client(container=self._config['AZURE_CONTAINER_NAME'],
-                                                          blob=object_name)
-
+        blob_client = get_container_client(self).get_blob_client(object_name)
         properties = blob_client.get_blob_properties()
     except:
         return None, None
@@ -44,6 +70,79 @@ def create_presigned_url(self, method, object_name, duration_in_seconds=600, che
                                                           object_name,
                                                           sas_blob)
 
+def create_presigned_urls(self, requests):
+    """
+    Create presigned URLs for a list of (method, object name, duration) tuples
+    """
+    now = datetime.utcnow()
+    read = BlobSasPermissions(read=True)
+    write = BlobSasPermissions(read=True, write=True, create=True)
+
+    urls = []
+    for (method, object_name, duration_in_seconds) in requests:
+        try:
+            sas_blob = generate_blob_sas(account_name=self._config['AZURE_ACCOUNT_NAME'],
+                                         container_name=self._config['AZURE_CONTAINER_NAME'],
+                                         blob_name=object_name,
+                                         account_key=self._config['AZURE_CREDENTIAL'],
+                                         permission=read if method == 'get' else write,
+                                         expiry=now + timedelta(seconds=duration_in_seconds))
+        except Exception:
+            urls.append(None)
+            continue
+
+        urls.append('https://%s.blob.core.windows.net/%s/%s?%s' % (self._config['AZURE_ACCOUNT_NAME'],
+                                                                   self._config['AZURE_CONTAINER_NAME'],
+                                                                   object_name,
+                                                                   sas_blob))
+
+    return urls
+
+def _block_id(part):
+    """
+    Return the block id used for a part. All block ids in a blob must have the same length
+    """
+    return '%06d' % part
+
+def create_multipart_urls(self, object_name, upload_id, first_part, num_parts, duration_in_seconds=7200):
+    """
+    Create URLs for uploading parts of a blob as blocks
+    """
+    url = create_presigned_url(self, 'put', object_name, duration_in_seconds)
+    if not url:
+        return None
+
+    return ['%s&comp=block&blockid=%s' % (url, quote(base64.b64encode(_block_id(part).encode('utf-8')).decode('utf-8'), safe=''))
+            for part in range(first_part, first_part + num_parts)]
+
+def create_multipart_upload(self, object_name, num_parts, duration_in_seconds=7200):
+    """
+    Create URLs for uploading each part of a blob as a block. Uncommitted blocks are removed
+    automatically by Azure, so there is no upload to start
+    """
+    urls = create_multipart_urls(self, object_name, None, 1, num_parts, duration_in_seconds)
+    if not urls:
+        return None, None
+
+    return str(uuid.uuid4()), urls
+
+def complete_multipart_upload(self, object_name, upload_id, parts):
+    """
+    Commit the blocks uploaded for a blob given a list of (part number, ETag) tuples
+    """
+    try:
+        get_container_client(self).get_blob_client(object_name).commit_block_list([_block_id(part) for (part, _) in parts])
+    except Exception:
+        return False
+
+    return True
+
+def abort_multipart_upload(self, object_name, upload_id):
+    """
+    Abort a multipart upload. Nothing needs to be done as uncommitted blocks expire
+    """
+    return True
+
 def list_objects(self, user, groups, path=None):
     """
     List objects in S3 storage
@@ -55,9 +154,7 @@ def list_objects(self, user, groups, path=None):
         prefix = 'uploads/%s' % path
         prefix_to_remove = ['uploads']
 
-    container = ContainerClient(account_url="https://%s.blob.core.windows.net" % self._config['AZURE_ACCOUNT_NAME'],
-                                credential=self._config['AZURE_CREDENTIAL'],
-                                container_name=self._config['AZURE_CONTAINER_NAME'])
+    container = get_container_client(self)
 
     objects = []
     for blob in container.list_blobs(name_starts_with=prefix):
@@ -81,11 +178,7 @@ def delete_object(self, username, group, obj):
         key = 'uploads/%s/%s' % (username, obj)
 
     try:
-        container = ContainerClient(account_url="https://%s.blob.core.windows.net" % self._config['AZURE_ACCOUNT_NAME'],
-                                    credential=self._config['AZURE_CREDENTIAL'],
-                                    container_name=self._config['AZURE_CONTAINER_NAME'])
-
-        container.delete_blob(key)
+        get_container_client(self).delete_blob(key)
     except:
         return False
 
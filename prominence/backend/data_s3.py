@@ -1,14 +1,57 @@
+import base64
+import hashlib
+import hmac
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
 import boto3
+from botocore.config import Config
+
+from .metrics import increment
+
+# Maximum number of connections kept open by each client
+S3_MAX_POOL_CONNECTIONS = 50
+
+# Clients are thread safe and are shared by all threads in the process
+S3_CLIENTS = {}
+S3_CLIENTS_LOCK = threading.Lock()
+
+# SigV4 signing keys, which only change daily
+S3_SIGNING_KEYS = {}
+S3_SIGNING_KEYS_LOCK = threading.Lock()
+
+# Maximum lifetime of a URL presigned using signature version 4, which S3 rejects if exceeded
+S3_V4_MAX_EXPIRES = 604800
+
+def get_s3_client(url, access_key_id, secret_access_key):
+    """
+    Return an S3 client, creating it only if one does not already exist for the given credentials
+    """
+    key = (url, access_key_id, secret_access_key)
+    with S3_CLIENTS_LOCK:
+        if key in S3_CLIENTS:
+            increment('s3_clients_reused')
+            return S3_CLIENTS[key]
+
+        s3_client = boto3.client('s3',
+                                 verify=False,
+                                 endpoint_url=url,
+                                 aws_access_key_id=access_key_id,
+                                 aws_secret_access_key=secret_access_key,
+                                 config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+        S3_CLIENTS[key] = s3_client
+        increment('s3_clients_created')
+
+    return s3_client
 
 def get_object(self, object_name):
     """
     Get the size & checksum of an object
     """
-    s3_client = boto3.client('s3',
-                             verify=False,
-                             endpoint_url=self._config['S3_URL'],
-                             aws_access_key_id=self._config['S3_ACCESS_KEY_ID'],
-                             aws_secret_access_key=self._config['S3_SECRET_ACCESS_KEY'])
+    s3_client = get_s3_client(self._config['S3_URL'],
+                              self._config['S3_ACCESS_KEY_ID'],
+                              self._config['S3_SECRET_ACCESS_KEY'])
 
     try:
         response = s3_client.head_object(Bucket=self._config['S3_BUCKET'], Key=object_name)
@@ -26,54 +69,189 @@ def get_object(self, object_name):
 
     return content_length, checksum
 
+def _get_signing_key(secret_access_key, datestamp, region):
+    """
+    Return the SigV4 signing key for the given day, deriving it only once per day
+    """
+    key = (secret_access_key, datestamp, region)
+    with S3_SIGNING_KEYS_LOCK:
+        if key not in S3_SIGNING_KEYS:
+            signing_key = ('AWS4%s' % secret_access_key).encode('utf-8')
+            for item in (datestamp, region, 's3', 'aws4_request'):
+                signing_key = hmac.new(signing_key, item.encode('utf-8'), hashlib.sha256).digest()
+            S3_SIGNING_KEYS.clear()
+            S3_SIGNING_KEYS[key] = signing_key
+        return S3_SIGNING_KEYS[key]
+
+def _presign_v2(url, bucket, access_key_id, secret_access_key, requests):
+    """
+    Create presigned URLs using query string authentication (signature version 2)
+    """
+    split = urlsplit(url)
+    resource = '%s/%s/' % (split.path.rstrip('/'), bucket)
+    base = '%s://%s%s' % (split.scheme, split.netloc, resource)
+    access_key = quote(access_key_id, safe='-_.~')
+    mac = hmac.new(secret_access_key.encode('utf-8'), digestmod=hashlib.sha1)
+    now = time.time()
+
+    urls = []
+    for (method, object_name, duration_in_seconds) in requests:
+        key = quote(object_name, safe='/~')
+        expires = int(now + duration_in_seconds)
+        signer = mac.copy()
+        signer.update(('%s\n\n\n%d\n%s%s' % (method.upper(), expires, resource, key)).encode('utf-8'))
+        signature = quote(base64.b64encode(signer.digest()).decode('utf-8'), safe='-_.~')
+        urls.append('%s%s?AWSAccessKeyId=%s&Signature=%s&Expires=%d' % (base, key, access_key, signature, expires))
+
+    return urls
+
+def _presign_v4(url, bucket, region, access_key_id, secret_access_key, requests):
+    """
+    Create presigned URLs using query string authentication (signature version 4). Durations are
+    limited to the maximum allowed, longer-lived URLs being refreshed before they expire
+    """
+    split = urlsplit(url)
+    resource = '%s/%s/' % (split.path.rstrip('/'), bucket)
+    base = '%s://%s%s' % (split.scheme, split.netloc, resource)
+    amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    scope = '%s/%s/s3/aws4_request' % (amz_date[:8], region)
+    credential = quote('%s/%s' % (access_key_id, scope), safe='-_.~')
+    mac = hmac.new(_get_signing_key(secret_access_key, amz_date[:8], region), digestmod=hashlib.sha256)
+
+    urls = []
+    for (method, object_name, duration_in_seconds) in requests:
+        key = quote(object_name, safe='/~')
+        duration_in_seconds = min(int(duration_in_seconds), S3_V4_MAX_EXPIRES)
+        query = 'X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Credential=%s&X-Amz-Date=%s&X-Amz-Expires=%d&X-Amz-SignedHeaders=host' % (credential, amz_date, duration_in_seconds)
+        canonical_request = '%s\n%s%s\n%s\nhost:%s\n\nhost\nUNSIGNED-PAYLOAD' % (method.upper(), resource, key, query, split.netloc)
+        string_to_sign = 'AWS4-HMAC-SHA256\n%s\n%s\n%s' % (amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest())
+        signer = mac.copy()
+        signer.update(string_to_sign.encode('utf-8'))
+        urls.append('%s%s?%s&X-Amz-Signature=%s' % (base, key, query, signer.hexdigest()))
+
+    return urls
+
+def create_presigned_urls(self, requests):
+    """
+    Create presigned S3 URLs for a list of (method, object name, duration) tuples
+    """
+    try:
+        if self._config.get('S3_SIGNATURE_VERSION', 's3') == 's3v4':
+            return _presign_v4(self._config['S3_URL'],
+                               self._config['S3_BUCKET'],
+                               self._config.get('S3_REGION', 'us-east-1'),
+                               self._config['S3_ACCESS_KEY_ID'],
+                               self._config['S3_SECRET_ACCESS_KEY'],
+                               requests)
+        return _presign_v2(self._config['S3_URL'],
+                           self._config['S3_BUCKET'],
+                           self._config['S3_ACCESS_KEY_ID'],
+                           self._config['S3_SECRET_ACCESS_KEY'],
+                           requests)
+    except Exception:
+        return [None]*len(requests)
+
 def create_presigned_url(self, method, object_name, duration_in_seconds=600, checksum=None):
     """
     Create presigned S3 URL
     """
-    s3_client = boto3.client('s3',
-                             verify=False,
-                             endpoint_url=self._config['S3_URL'],
-                             aws_access_key_id=self._config['S3_ACCESS_KEY_ID'],
-                             aws_secret_access_key=self._config['S3_SECRET_ACCESS_KEY'])
-    if method == 'get':
-        try:
-            response = s3_client.generate_presigned_url('get_object',
-                                                        Params={'Bucket': self._config['S3_BUCKET'], 'Key': object_name},
-                                                        ExpiresIn=duration_in_seconds)
-        except Exception:
-            return None
-    elif not checksum:
-        try:
-            response = s3_client.generate_presigned_url('put_object',
-                                                        Params={'Bucket': self._config['S3_BUCKET'], 'Key':object_name},
-                                                        ExpiresIn=duration_in_seconds,
-                                                        HttpMethod='PUT')
-        except Exception:
-            return None
-    else:
-        fields = {'x-amz-meta-prominence_sha256': checksum}
-        conditions = [{'x-amz-meta-prominence_sha256': checksum}]
- 
-        try:
-           response = s3_client.generate_presigned_post(self._config['S3_BUCKET'],
-                                                        object_name,
-                                                        Fields=fields,
-                                                        Conditions=conditions,
-                                                        ExpiresIn=duration_in_seconds) 
-        except Exception:
-            return None
+    if not checksum:
+        return create_presigned_urls(self, [(method, object_name, duration_in_seconds)])[0]
+
+    s3_client = get_s3_client(self._config['S3_URL'],
+                              self._config['S3_ACCESS_KEY_ID'],
+                              self._config['S3_SECRET_ACCESS_KEY'])
+
+    fields = {'x-amz-meta-prominence_sha256': checksum}
+    conditions = [{'x-amz-meta-prominence_sha256': checksum}]
+
+    try:
+        response = s3_client.generate_presigned_post(self._config['S3_BUCKET'],
+                                                     object_name,
+                                                     Fields=fields,
+                                                     Conditions=conditions,
+                                                     ExpiresIn=duration_in_seconds)
+    except Exception:
+        return None
 
     return response
 
+def create_multipart_urls(self, object_name, upload_id, first_part, num_parts, duration_in_seconds=7200):
+    """
+    Create presigned URLs for uploading parts of a multipart upload
+    """
+    s3_client = get_s3_client(self._config['S3_URL'],
+                              self._config['S3_ACCESS_KEY_ID'],
+                              self._config['S3_SECRET_ACCESS_KEY'])
+
+    try:
+        return [s3_client.generate_presigned_url('upload_part',
+                                                 Params={'Bucket': self._config['S3_BUCKET'],
+                                                         'Key': object_name,
+                                                         'UploadId': upload_id,
+                                                         'PartNumber': part},
+                                                 ExpiresIn=duration_in_seconds,
+                                                 HttpMethod='PUT') for part in range(first_part, first_part + num_parts)]
+    except Exception:
+        return None
+
+def create_multipart_upload(self, object_name, num_parts, duration_in_seconds=7200):
+    """
+    Start a multipart upload and create presigned URLs for uploading each part
+    """
+    s3_client = get_s3_client(self._config['S3_URL'],
+                              self._config['S3_ACCESS_KEY_ID'],
+                              self._config['S3_SECRET_ACCESS_KEY'])
+
+    try:
+        upload_id = s3_client.create_multipart_upload(Bucket=self._config['S3_BUCKET'], Key=object_name)['UploadId']
+    except Exception:
+        return None, None
+
+    urls = create_multipart_urls(self, object_name, upload_id, 1, num_parts, duration_in_seconds)
+    if not urls:
+        return None, None
+
+    return upload_id, urls
+
+def complete_multipart_upload(self, object_name, upload_id, parts):
+    """
+    Complete a multipart upload given a list of (part number, ETag) tuples
+    """
+    s3_client = get_s3_client(self._config['S3_URL'],
+                              self._config['S3_ACCESS_KEY_ID'],
+                              self._config['S3_SECRET_ACCESS_KEY'])
+
+    try:
+        s3_client.complete_multipart_upload(Bucket=self._config['S3_BUCKET'],
+                                            Key=object_name,
+                                            UploadId=upload_id,
+                                            MultipartUpload={'Parts': [{'PartNumber': part, 'ETag': etag} for (part, etag) in parts]})
+    except Exception:
+        return False
+
+    return True
+
+def abort_multipart_upload(self, object_name, upload_id):
+    """
+    Abort a multipart upload, deleting any parts already uploaded
+    """
+    s3_client = get_s3_client(self._config['S3_URL'],
+                              self._config['S3_ACCESS_KEY_ID'],
+                              self._config['S3_SECRET_ACCESS_KEY'])
+
+    try:
+        s3_client.abort_multipart_upload(Bucket=self._config['S3_BUCKET'], Key=object_name, UploadId=upload_id)
+    except Exception:
+        return False
+
+    return True
+
 def get_matching_s3_objects(url, access_key_id, secret_access_key, bucket, prefix="", suffix=""):
     """
     Generate objects in an S3 bucket filtered by a prefix and/or suffix
     """
-    s3 = boto3.client('s3',
-                      verify=False,
-                      endpoint_url=url,
-                      aws_access_key_id=access_key_id,
-                      aws_secret_access_key=secret_access_key)
+    s3 = get_s3_client(url, access_key_id, secret_access_key)
 
     paginator = s3.get_paginator("list_objects_v2")
 
@@ -146,11 +324,9 @@ def delete_object(self, username, group, obj):
         key = 'uploads/%s/%s' % (username, obj)
 
     try:
-        s3_client = boto3.client('s3',
-                                 verify=False,
-                                 endpoint_url=self._config['S3_URL'],
-                                 aws_access_key_id=self._config['S3_ACCESS_KEY_ID'],
-                                 aws_secret_access_key=self._config['S3_SECRET_ACCESS_KEY'])
+        s3_client = get_s3_client(self._config['S3_URL'],
+                                  self._config['S3_ACCESS_KEY_ID'],
+                                  self._config['S3_SECRET_ACCESS_KEY'])
         response = s3_client.delete_object(Bucket=self._config['S3_BUCKET'], Key=key)
     except Exception:
         return False
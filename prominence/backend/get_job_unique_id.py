@@ -52,3 +52,13 @@ def get_job_unique_id(self, job_id, return_qdate=False):
         return (uid, identity, iwd, out, err, name, status)
 
     return (uid, identity, iwd, out, err, name, status, qdate)
+
+def is_job_active(self, job_id):
+    """
+    Check if the specified job is idle or running
+    """
+    schedd = htcondor.Schedd()
+    jobs_condor = schedd.xquery('RoutedBy =?= undefined && ClusterId =?= %d && (JobStatus == 1 || JobStatus == 2)' % int(job_id), ['ClusterId'], 1)
+    for _ in jobs_condor:
+        return True
+    return False
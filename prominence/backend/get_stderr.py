@@ -1,24 +1,23 @@
 import os
-from .utilities import readfile
 
-def get_stderr(self, uid, iwd, out, err, job_id, job_name=None, instance_id=-1, node=0, offset=0):
+def get_stderr_filename(self, uid, iwd, out, err, job_id, job_name=None, instance_id=-1, node=0):
     """
-    Return the stdout from the specified job
+    Return the name of the file containing the stderr from the specified job
     """
-    if '#pArAlLeLnOdE#' in err:
+    if err and '#pArAlLeLnOdE#' in err:
         err = err.replace('#pArAlLeLnOdE#', '%d' % node)
 
     if instance_id > -1:
         if os.path.isfile('%s/job.%d.err' % (iwd, instance_id)):
-            return readfile('%s/job.%d.err' % (iwd, instance_id), offset)
+            return '%s/job.%d.err' % (iwd, instance_id)
         if os.path.isfile('%s/job.%d.err.%d' % (iwd, instance_id, node)):
-            return readfile('%s/job.%d.err.%d' % (iwd, instance_id, node), offset)
+            return '%s/job.%d.err.%d' % (iwd, instance_id, node)
     elif os.path.isfile('%s/%s' % (iwd, err)):
-        return readfile('%s/%s' % (iwd, err), offset)
+        return '%s/%s' % (iwd, err)
     elif os.path.isfile('%s/%s/job.0.err' % (iwd, job_name)):
-        return readfile('%s/%s/job.0.err' % (iwd, job_name), offset)
+        return '%s/%s/job.0.err' % (iwd, job_name)
     elif os.path.isfile('%s/%s/job.0.err.%d' % (iwd, job_name, node)):
-        return readfile('%s/%s/job.0.err.%d' % (iwd, job_name, node), offset)
-    elif os.path.isfile(err):
-        return readfile(err, offset)
+        return '%s/%s/job.0.err.%d' % (iwd, job_name, node)
+    elif err and os.path.isfile(err):
+        return err
     return None
@@ -0,0 +1,223 @@
+"""Local index of completed job ClassAds, updated incrementally from the history"""
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import classad
+import htcondor
+
+from .list_jobs import REQUIRED_ATTRS
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+INDEX_ATTRS = REQUIRED_ATTRS + ['ProminenceIdentity']
+
+INDEX_CONSTRAINT = 'RoutedBy =?= undefined && ProminenceType == "job" && ProminenceName =!= undefined'
+
+# Prefix of the attributes containing the labels of a job
+LABEL_PREFIX = 'ProminenceUserMetadata_'
+
+# Version of the schema; an index with a different version is rebuilt
+SCHEMA_VERSION = '2'
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS jobs (cluster_id INTEGER PRIMARY KEY, identity TEXT, name TEXT, '
+          'dag_id INTEGER, status INTEGER, seq INTEGER, ad TEXT)',
+          'CREATE INDEX IF NOT EXISTS jobs_identity ON jobs (identity, seq)',
+          'CREATE TABLE IF NOT EXISTS labels (cluster_id INTEGER, key TEXT COLLATE NOCASE, value TEXT, '
+          'PRIMARY KEY (cluster_id, key))',
+          'CREATE INDEX IF NOT EXISTS labels_key ON labels (key, value)',
+          'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)']
+
+# Thread building the index for the first time
+BUILD_THREAD = None
+BUILD_THREAD_LOCK = threading.Lock()
+
+def _connect(path):
+    """
+    Open the index database, creating the schema if necessary
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    if _get_meta(conn, 'version') != SCHEMA_VERSION:
+        with conn:
+            for table in ('jobs', 'labels', 'meta'):
+                conn.execute('DROP TABLE IF EXISTS %s' % table)
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.execute('INSERT INTO meta VALUES (?, ?)', ('version', SCHEMA_VERSION))
+    return conn
+
+def _ad_to_dict(ad):
+    """
+    Convert a ClassAd into a dict containing only plain values
+    """
+    job = {}
+    for attr in INDEX_ATTRS:
+        if attr not in ad:
+            continue
+        value = ad[attr]
+        if isinstance(value, classad.ExprTree):
+            value = value.eval()
+        if isinstance(value, classad.Value):
+            continue
+        job[attr] = value
+    return job
+
+def _ad_to_labels(ad):
+    """
+    Return the labels of a job from its ProminenceUserMetadata_<key> attributes
+    """
+    labels = []
+    for attr in ad.keys():
+        if not attr.startswith(LABEL_PREFIX):
+            continue
+        value = ad[attr]
+        if isinstance(value, classad.ExprTree):
+            value = value.eval()
+        if isinstance(value, classad.Value):
+            continue
+        labels.append((int(ad['ClusterId']), attr[len(LABEL_PREFIX):], str(value)))
+    return labels
+
+def _row(job, seq):
+    """
+    Generate a row of the jobs table from a job dict
+    """
+    return (int(job['ClusterId']),
+            job.get('ProminenceIdentity'),
+            job.get('ProminenceName'),
+            int(job['DAGManJobId']) if 'DAGManJobId' in job else None,
+            int(job['JobStatus']),
+            seq,
+            json.dumps(job))
+
+def _get_meta(conn, key, default=None):
+    """
+    Get a value from the meta table
+    """
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return default
+    return row[0]
+
+def update_job_index(self, force=False):
+    """
+    Update the job index from any new history records
+    """
+    path = self._config['JOB_INDEX_PATH']
+
+    # Only one process updates the index at a time; others use the existing contents
+    lock = open('%s.lock' % path, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return False
+
+    try:
+        conn = _connect(path)
+        try:
+            updated = float(_get_meta(conn, 'updated', 0))
+            if not force and time.time() - updated < int(self._config.get('JOB_INDEX_REFRESH', 10)):
+                return True
+
+            schedd = htcondor.Schedd()
+
+            # The history is returned newest first, so only records written since the most recent
+            # one seen previously need to be read. Complete ads are read as the names of the label
+            # attributes are not known in advance
+            since = _get_meta(conn, 'history_since')
+            if since:
+                history = schedd.history(INDEX_CONSTRAINT, [], -1, since=since)
+            else:
+                history = schedd.history(INDEX_CONSTRAINT, [], -1)
+            completed = [(_ad_to_dict(ad), _ad_to_labels(ad)) for ad in history]
+
+            seq = int(_get_meta(conn, 'seq', 0))
+            with conn:
+                for (job, labels) in reversed(completed):
+                    seq += 1
+                    conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)', _row(job, seq))
+                    conn.execute('DELETE FROM labels WHERE cluster_id = ?', (int(job['ClusterId']),))
+                    conn.executemany('INSERT INTO labels VALUES (?, ?, ?)', labels)
+                if completed:
+                    conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                 ('history_since', '%d.%d' % (completed[0][0]['ClusterId'], completed[0][0]['ProcId'])))
+                conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('seq', str(seq)))
+                conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('updated', str(time.time())))
+        finally:
+            conn.close()
+    except Exception as err:
+        logger.critical('Unable to update job index due to: %s', err)
+        return False
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    return True
+
+def _build_job_index(self):
+    """
+    Start building the job index in the background, if this is not already happening
+    """
+    global BUILD_THREAD
+    with BUILD_THREAD_LOCK:
+        if BUILD_THREAD is None or not BUILD_THREAD.is_alive():
+            logger.info('Building job index in the background')
+            BUILD_THREAD = threading.Thread(target=self.update_job_index, args=(True,), daemon=True)
+            BUILD_THREAD.start()
+
+def query_job_index(self, job_ids, identity, workflow, num, constraint, name_constraint):
+    """
+    Return completed jobs matching the specified constraints from the job index, or None if the
+    index has not yet been built
+    """
+    conn = _connect(self._config['JOB_INDEX_PATH'])
+    try:
+        built = _get_meta(conn, 'updated') is not None
+    finally:
+        conn.close()
+
+    # Building the index requires reading the entire history, which is too slow to do
+    # while handling a request
+    if not built:
+        _build_job_index(self)
+        return None
+
+    self.update_job_index()
+
+    where = ['identity = ?']
+    params = [identity]
+
+    if constraint[0] is not None and constraint[1] is not None:
+        where.append('cluster_id IN (SELECT cluster_id FROM labels WHERE key = ? AND value = ?)')
+        params.extend([constraint[0], constraint[1]])
+
+    if len(job_ids) > 0 and not workflow:
+        where.append('cluster_id IN (%s)' % ','.join(['?']*len(job_ids)))
+        params.extend([int(job_id) for job_id in job_ids])
+        num = len(job_ids)
+
+    if workflow and len(job_ids) > 0:
+        where.append('dag_id = ?')
+        params.append(int(job_ids[0]))
+
+    if name_constraint is not None:
+        where.append('name = ?')
+        params.append(str(name_constraint))
+
+    jobs = []
+    conn = _connect(self._config['JOB_INDEX_PATH'])
+    try:
+        sql = 'SELECT ad FROM jobs WHERE %s ORDER BY seq DESC LIMIT ?' % ' AND '.join(where)
+        for row in conn.execute(sql, params + [int(num)]):
+            jobs.append(json.loads(row[0]))
+    finally:
+        conn.close()
+
+    return jobs
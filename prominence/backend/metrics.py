@@ -0,0 +1,49 @@
+"""In-process counters and latency histograms"""
+import threading
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0]
+
+_LOCK = threading.Lock()
+_COUNTERS = {}
+_HISTOGRAMS = {}
+
+def increment(name, value=1):
+    """
+    Increment a counter
+    """
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+def observe(name, value):
+    """
+    Add a measurement to a histogram
+    """
+    with _LOCK:
+        if name not in _HISTOGRAMS:
+            _HISTOGRAMS[name] = {'count': 0, 'sum': 0.0, 'buckets': [0]*(len(BUCKETS) + 1)}
+        histogram = _HISTOGRAMS[name]
+        histogram['count'] += 1
+        histogram['sum'] += value
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+                break
+        else:
+            histogram['buckets'][len(BUCKETS)] += 1
+
+def get_metrics():
+    """
+    Return a copy of all counters and histograms
+    """
+    with _LOCK:
+        histograms = {}
+        for name, histogram in _HISTOGRAMS.items():
+            buckets = {}
+            for index, bound in enumerate(BUCKETS):
+                buckets[str(bound)] = histogram['buckets'][index]
+            buckets['+Inf'] = histogram['buckets'][len(BUCKETS)]
+            histograms[name] = {'count': histogram['count'],
+                                'sum': histogram['sum'],
+                                'buckets': buckets}
+        return {'counters': dict(_COUNTERS), 'histograms': histograms}
@@ -46,6 +46,18 @@ def redact_storage_creds(storage):
             storage['webdav']['password'] = '***'
     return storage
 
+# File extensions of output directory archives for each compression mode
+OUTPUT_DIR_EXTENSIONS = {'none': 'tar',
+                         'gzip': 'tgz',
+                         'zstd': 'tar.zst',
+                         'lz4': 'tar.lz4'}
+
+def output_dir_extension(job):
+    """
+    Return the file extension used for output directory archives of a job
+    """
+    return OUTPUT_DIR_EXTENSIONS[job.get('outputDirsCompression', 'gzip')]
+
 def condor_str(str_in):
     """
     Returns a double-quoted string
@@ -100,10 +112,31 @@ def validate_presigned_url(url):
         return False
     return True
 
-def readfile(filename, offset=0):
+def readfile_chunks(filename, offset=0, limit=None, follow=None, timeout=0, chunk_size=65536):
     """
-    Read lines from a file
+    Generate bounded chunks from a file. If follow is specified, keep reading as the file grows until
+    follow() returns False or the timeout is reached
     """
+    start_time = time.time()
+    last_check = start_time
     with open(filename, 'rb') as fd:
         fd.seek(offset)
-        return fd.read()
+        while limit is None or limit > 0:
+            data = fd.read(chunk_size if limit is None else min(chunk_size, limit))
+            if data:
+                if limit is not None:
+                    limit -= len(data)
+                yield data
+                continue
+
+            if follow is None or time.time() - start_time > timeout:
+                break
+
+            # Stop following once the job has finished, after reading anything written in the meantime
+            if time.time() - last_check > 5:
+                last_check = time.time()
+                if not follow():
+                    follow = None
+                    continue
+
+            time.sleep(1)
@@ -11,6 +11,9 @@ from .auth import requires_auth
 
 data = Blueprint('data', __name__)
 
+# Maximum number of parts in a multipart upload
+MULTIPART_MAX_PARTS = 10000
+
 @data.route("/prominence/v1/data", methods=['GET'])
 @data.route("/prominence/v1/data/<path:path>", methods=['GET'])
 @requires_auth
@@ -105,6 +108,28 @@ def upload_file(username, group, email):
     return jsonify({'url':data}), 201
 
 
+def get_job_uuid():
+    """
+    Return the job unique identifier from the job token used for the request
+    """
+    token = None
+    if 'Authorization' in request.headers:
+        auth = request.headers['Authorization']
+        try:
+            token = auth.split(' ')[1]
+        except:
+            return None
+
+    try:
+        decoded = jwt.decode(token, app.config['JOB_TOKEN_SECRET'], algorithms=["HS256"])
+    except Exception:
+        return None
+
+    if decoded and 'job' in decoded:
+        return str(decoded['job'])
+
+    return None
+
 @data.route("/prominence/v1/data/output", methods=['POST'])
 @requires_auth
 def get_url(username, group, email):
@@ -123,25 +148,127 @@ def get_url(username, group, email):
     else:
         return jsonify({'error':'Name not specified'})
 
-    if 'Authorization' in request.headers:
-        auth = request.headers['Authorization']
-        try:
-            token = auth.split(' ')[1]
-        except:
-            return jsonify({'error':'A JWT token is required'}), 400
+    job_uuid = get_job_uuid()
+    if not job_uuid:
+        return jsonify({'error':'A JWT token is required'}), 400
+
+    url = backend.create_presigned_url('put', 'scratch/%s/%s' % (job_uuid, name), 7200)
+    return jsonify({'url': url}), 201
+
+@data.route("/prominence/v1/data/output/multipart", methods=['POST'])
+@requires_auth
+def create_multipart_upload(username, group, email):
+    """
+    Start a multipart upload of job output data, returning a presigned URL for each part
+    """
+    app.logger.info('%s CreateMultipartUpload user:%s group:%s' % (get_remote_addr(request), username, group))
+
+    if app.config['ENABLE_DATA'] != 'True':
+        return func_disabled()
+
+    data = request.get_json(silent=True) or {}
+    if 'name' not in data:
+        return jsonify({'error':'Name not specified'}), 400
+    if not str(data.get('parts')).isdigit() or not 1 <= int(data['parts']) <= MULTIPART_MAX_PARTS:
+        return jsonify({'error':'The number of parts must be between 1 and %d' % MULTIPART_MAX_PARTS}), 400
+
+    job_uuid = get_job_uuid()
+    if not job_uuid:
+        return jsonify({'error':'A JWT token is required'}), 400
+
+    backend = ProminenceBackend(app.config)
+    (upload_id, urls) = backend.create_multipart_upload('scratch/%s/%s' % (job_uuid, data['name']), int(data['parts']), 7200)
+    if not upload_id:
+        return jsonify({'error':'Unable to create multipart upload'}), 400
+
+    return jsonify({'uploadId': upload_id, 'urls': urls}), 201
+
+@data.route("/prominence/v1/data/output/multipart/urls", methods=['POST'])
+@requires_auth
+def create_multipart_urls(username, group, email):
+    """
+    Create presigned URLs for further parts of a multipart upload of job output data, for
+    uploads where the number of parts is not known in advance
+    """
+    app.logger.info('%s CreateMultipartURLs user:%s group:%s' % (get_remote_addr(request), username, group))
+
+    if app.config['ENABLE_DATA'] != 'True':
+        return func_disabled()
+
+    data = request.get_json(silent=True) or {}
+    if 'name' not in data or 'uploadId' not in data:
+        return jsonify({'error':'Name and upload id must be specified'}), 400
+    if not str(data.get('firstPart')).isdigit() or not str(data.get('parts')).isdigit() or \
+       int(data['firstPart']) < 1 or int(data['parts']) < 1 or int(data['firstPart']) + int(data['parts']) - 1 > MULTIPART_MAX_PARTS:
+        return jsonify({'error':'Part numbers must be between 1 and %d' % MULTIPART_MAX_PARTS}), 400
+
+    job_uuid = get_job_uuid()
+    if not job_uuid:
+        return jsonify({'error':'A JWT token is required'}), 400
+
+    backend = ProminenceBackend(app.config)
+    urls = backend.create_multipart_urls('scratch/%s/%s' % (job_uuid, data['name']),
+                                         data['uploadId'],
+                                         int(data['firstPart']),
+                                         int(data['parts']),
+                                         7200)
+    if not urls:
+        return jsonify({'error':'Unable to create URLs for multipart upload'}), 400
+
+    return jsonify({'urls': urls}), 201
+
+@data.route("/prominence/v1/data/output/multipart/complete", methods=['POST'])
+@requires_auth
+def complete_multipart_upload(username, group, email):
+    """
+    Complete a multipart upload of job output data
+    """
+    app.logger.info('%s CompleteMultipartUpload user:%s group:%s' % (get_remote_addr(request), username, group))
+
+    if app.config['ENABLE_DATA'] != 'True':
+        return func_disabled()
+
+    data = request.get_json(silent=True) or {}
+    if 'name' not in data or 'uploadId' not in data:
+        return jsonify({'error':'Name and upload id must be specified'}), 400
 
-    decoded = None
     try:
-        decoded = jwt.decode(token, app.config['JOB_TOKEN_SECRET'], algorithms=["HS256"])
-    except Exception as err:
+        parts = [(int(part['partNumber']), part.get('etag')) for part in data['parts']]
+    except Exception:
+        return jsonify({'error':'A list of parts with part numbers must be specified'}), 400
+
+    job_uuid = get_job_uuid()
+    if not job_uuid:
         return jsonify({'error':'A JWT token is required'}), 400
 
-    job_uuid = None
-    if decoded:
-        if 'job' in decoded:
-            job_uuid = str(decoded['job'])
-            url = backend.create_presigned_url('put', 'scratch/%s/%s' % (job_uuid, name), 7200)
-            return jsonify({'url': url}), 201
+    backend = ProminenceBackend(app.config)
+    if not backend.complete_multipart_upload('scratch/%s/%s' % (job_uuid, data['name']), data['uploadId'], sorted(parts)):
+        return jsonify({'error':'Unable to complete multipart upload'}), 400
+
+    return jsonify({}), 200
+
+@data.route("/prominence/v1/data/output/multipart/abort", methods=['POST'])
+@requires_auth
+def abort_multipart_upload(username, group, email):
+    """
+    Abort a multipart upload of job output data
+    """
+    app.logger.info('%s AbortMultipartUpload user:%s group:%s' % (get_remote_addr(request), username, group))
+
+    if app.config['ENABLE_DATA'] != 'True':
+        return func_disabled()
+
+    data = request.get_json(silent=True) or {}
+    if 'name' not in data or 'uploadId' not in data:
+        return jsonify({'error':'Name and upload id must be specified'}), 400
+
+    job_uuid = get_job_uuid()
+    if not job_uuid:
+        return jsonify({'error':'A JWT token is required'}), 400
+
+    backend = ProminenceBackend(app.config)
+    if not backend.abort_multipart_upload('scratch/%s/%s' % (job_uuid, data['name']), data['uploadId']):
+        return jsonify({'error':'Unable to abort multipart upload'}), 400
 
-    return jsonify({'error':'Unspecified error'}), 400
+    return jsonify({}), 200
 
@@ -135,6 +135,13 @@ def replacement_failed():
     with app.app_context():
         return jsonify({'error':'Atomic replacement not successful'}), 400    
 
+def not_auth_kv():
+    """
+    User is not authorized to use the key-value store
+    """
+    with app.app_context():
+        return jsonify({'error':'Not authorized to access the key-value store'}), 403
+
 def key_not_specified():
     """
     Key not specified
@@ -156,6 +163,13 @@ def value_too_big():
     with app.app_context():
         return jsonify({'error':'Content of value too large'}), 400
 
+def ts_busy():
+    """
+    Time-series buffer is full
+    """
+    with app.app_context():
+        return jsonify({'error':'Too many time-series points are waiting to be written, try again later'}), 503
+
 def auth_failure():
     """
     Authentication failure
@@ -1,8 +1,11 @@
-"""Route for providing health status"""
+"""Routes for providing health status and metrics"""
+import os
+
 from flask import Blueprint, jsonify, request
 from flask import current_app as app
 
 from .backend import ProminenceBackend
+from .backend import metrics as backend_metrics
 from .utilities import get_remote_addr
 
 health = Blueprint('health', __name__)
@@ -20,3 +23,14 @@ def get_health():
         return jsonify(msg), 409
 
     return jsonify(msg), 204
+
+@health.route("/prominence/v1/metrics", methods=['GET'])
+def get_metrics():
+    """
+    Return counters and latency histograms for this API process
+    """
+    app.logger.info('%s GetMetrics' % get_remote_addr(request))
+
+    metrics = backend_metrics.get_metrics()
+    metrics['pid'] = os.getpid()
+    return jsonify(metrics), 200
@@ -11,7 +11,7 @@ from .backend import ProminenceBackend
 from .errors import invalid_constraint, func_disabled, no_such_job, not_auth_job, job_not_running, command_failed, job_clone_error
 from .errors import job_id_required, no_stdout, no_stderr, snapshot_path_required, snapshot_invalid_path, job_removal_failed, invalid_status
 from .validate import validate_job
-from .utilities import get_remote_addr
+from .utilities import get_remote_addr, output_response
 
 jobs = Blueprint('jobs', __name__)
 
@@ -203,10 +203,6 @@ def get_stdout(username, group, email, job_id):
     if 'node' in request.args:
         node = int(request.args.get('node'))
 
-    offset = 0
-    if 'offset' in request.args:
-        offset = int(request.args.get('offset'))
-
     backend = ProminenceBackend(app.config)
     (uid, identity, iwd, out, err, name, _) = backend.get_job_unique_id(job_id)
     if not identity:
@@ -214,11 +210,14 @@ def get_stdout(username, group, email, job_id):
     if username != identity:
         return not_auth_job()
 
-    stdout = backend.get_stdout(uid, iwd, out, err, job_id, name, node=node, offset=offset)
-    if stdout is None:
+    filename = backend.get_stdout_filename(uid, iwd, out, err, job_id, name, node=node)
+    if filename is None:
         return no_stdout()
-    else:
-        return stdout
+
+    return output_response(request,
+                           filename,
+                           lambda: backend.is_job_active(job_id),
+                           int(app.config.get('OUTPUT_FOLLOW_TIMEOUT', 60)))
 
 @jobs.route("/prominence/v1/jobs/<int:job_id>/stderr", methods=['GET'])
 @requires_auth
@@ -232,10 +231,6 @@ def get_stderr(username, group, email, job_id):
     if 'node' in request.args:
         node = int(request.args.get('node'))
 
-    offset = 0
-    if 'offset' in request.args:
-        offset = int(request.args.get('offset'))
-
     backend = ProminenceBackend(app.config)
     (uid, identity, iwd, out, err, name, _) = backend.get_job_unique_id(job_id)
     if not identity:
@@ -243,11 +238,14 @@ def get_stderr(username, group, email, job_id):
     if username != identity:
         return not_auth_job()
 
-    stderr = backend.get_stderr(uid, iwd, out, err, job_id, name, node=node, offset=offset)
-    if stderr is None:
+    filename = backend.get_stderr_filename(uid, iwd, out, err, job_id, name, node=node)
+    if filename is None:
         return no_stderr()
-    else:
-        return stderr
+
+    return output_response(request,
+                           filename,
+                           lambda: backend.is_job_active(job_id),
+                           int(app.config.get('OUTPUT_FOLLOW_TIMEOUT', 60)))
 
 @jobs.route("/prominence/v1/jobs/<int:job_id>/snapshot", methods=['GET'])
 @requires_auth
@@ -5,13 +5,25 @@ import etcd3
 from flask import Blueprint, jsonify, request
 from flask import current_app as app
 
-from .errors import func_disabled, kv_error, key_not_specified, no_value_provided, value_too_big, no_such_key, replacement_failed
+from .errors import func_disabled, kv_error, key_not_specified, no_value_provided, value_too_big, no_such_key, replacement_failed, not_auth_kv
 from .utilities import get_remote_addr
+from .validate import validate_kv_batch
+from . import kv_client
 
-from .auth import requires_auth
+from .auth import requires_auth, USERINFO_SHARED_PREFIX
 
 kv = Blueprint('kv', __name__)
 
+# Names at the top level of the store which are used internally and so are never valid usernames
+KV_RESERVED_NAMES = (USERINFO_SHARED_PREFIX.split('/')[0],)
+
+def valid_kv_user(username):
+    """
+    Check that the keys of a user, which begin with /<username>/, cannot include keys of other users
+    or keys used internally
+    """
+    return bool(username) and '/' not in username and username not in KV_RESERVED_NAMES
+
 @kv.route("/prominence/v1/kv", methods=['GET'])
 @kv.route("/prominence/v1/kv/<path:path>", methods=['GET'])
 @requires_auth
@@ -24,15 +36,18 @@ def get_keys(username, group, email, path=None):
     if app.config['ENABLE_KV'] != 'True':
         return func_disabled()
 
+    if not valid_kv_user(username):
+        return not_auth_kv()
+
     if 'list' in request.args:
         prefix = ''
         if path:
-            prefix = '/%s' % path
+            prefix = path
 
         keys = []
         try:
-            etcd = etcd3.client(host=app.config['ETCD_HOSTNAME'], port=app.config['ETCD_PORT'])
-            for item in etcd.get_prefix('/%s%s' % (username, prefix)):
+            items = kv_client.run(app.config, 'get_prefix', lambda etcd: list(etcd.get_prefix('/%s/%s' % (username, prefix))))
+            for item in items:
                 key = item[1].key.decode('utf-8').replace('/%s' % username, '', 1)
                 if '_internal_' not in key:
                     if 'values' in request.args:
@@ -40,7 +55,6 @@ def get_keys(username, group, email, path=None):
                         keys.append({key: value})
                     else:
                         keys.append(key)
-            etcd.close()
         except Exception as err:
             app.logger.error('Got exception listing kv: %s', err)
             return kv_error()
@@ -50,21 +64,151 @@ def get_keys(username, group, email, path=None):
     if not path:
         return key_not_specified()
 
-    value = None
+    if 'watch' in request.args:
+        return watch(username, path)
+
     try:
-        etcd = etcd3.client(host=app.config['ETCD_HOSTNAME'], port=app.config['ETCD_PORT'])
-        value = etcd.get('/%s/%s' % (username, path))
-        etcd.close()
+        response = kv_client.run(app.config, 'get', lambda etcd: etcd.get_response('/%s/%s' % (username, path)))
     except Exception as err:
         app.logger.error('Got exception getting kv: %s', err)
         return kv_error()
 
-    if not value:
-        return no_such_key()
-    if not value[0]:
-        return no_such_key()
+    # The store revision is returned so that clients can watch for changes made after this read
+    headers = {'X-Prominence-KV-Revision': str(response.header.revision)}
+
+    if not response.kvs or not response.kvs[0].value:
+        (content, code) = no_such_key()
+        return content, code, headers
+
+    return base64.b64decode(response.kvs[0].value).decode('utf-8'), 200, headers
+
+def watch(username, path):
+    """
+    Wait for the first change to a key, or any key with the given prefix, after the specified revision
+    """
+    key = '/%s/%s' % (username, path)
+
+    timeout = app.config.get('KV_WATCH_MAX_TIMEOUT', 60)
+    if 'timeout' in request.args:
+        try:
+            timeout = min(max(int(request.args.get('timeout')), 1), timeout)
+        except ValueError:
+            return jsonify({'error': 'timeout must be an integer'}), 400
+
+    try:
+        if 'revision' in request.args:
+            revision = int(request.args.get('revision'))
+        else:
+            revision = kv_client.run(app.config, 'get', lambda etcd: etcd.get_response(key)).header.revision
+    except ValueError:
+        return jsonify({'error': 'revision must be an integer'}), 400
+    except Exception as err:
+        app.logger.error('Got exception getting kv revision: %s', err)
+        return kv_error()
+
+    headers = {'X-Prominence-KV-Revision': str(revision)}
+
+    try:
+        if 'prefix' in request.args:
+            event = kv_client.run(app.config, 'watch', lambda etcd: etcd.watch_prefix_once(key, timeout, start_revision=revision + 1))
+        else:
+            event = kv_client.run(app.config, 'watch', lambda etcd: etcd.watch_once(key, timeout, start_revision=revision + 1))
+    except etcd3.exceptions.WatchTimedOut:
+        return '', 204, headers
+    except Exception as err:
+        app.logger.error('Got exception watching kv: %s', err)
+        return kv_error()
+
+    data = {'key': event.key.decode('utf-8').replace('/%s' % username, '', 1),
+            'revision': event.mod_revision}
+    if isinstance(event, etcd3.events.DeleteEvent):
+        data['event'] = 'delete'
+        data['value'] = None
+    else:
+        data['event'] = 'put'
+        data['value'] = base64.b64decode(event.value).decode('utf-8')
 
-    return base64.b64decode(value[0]).decode('utf-8')
+    headers['X-Prominence-KV-Revision'] = str(event.mod_revision)
+
+    return jsonify(data), 200, headers
+
+@kv.route("/prominence/v1/kv/_batch", methods=['POST'])
+@requires_auth
+def batch(username, group, email):
+    """
+    Run multiple get, put, delete and compare-and-swap operations in a single transaction
+    """
+    app.logger.info('%s BatchKV user:%s group:%s' % (get_remote_addr(request), username, group))
+
+    if app.config['ENABLE_KV'] != 'True':
+        return func_disabled()
+
+    if not valid_kv_user(username):
+        return not_auth_kv()
+
+    data = request.get_json(silent=True)
+    (status, msg) = validate_kv_batch(data, int(app.config.get('KV_MAX_BATCH_OPERATIONS', 128)))
+    if not status:
+        return jsonify({'error': msg}), 400
+
+    operations = data['operations']
+    for operation in operations:
+        if 'value' in operation and sys.getsizeof(operation['value'].encode('utf-8')) > app.config['KV_MAX_BYTES']:
+            return value_too_big()
+
+    def transaction(etcd):
+        """
+        Build and run the transaction
+        """
+        compare = []
+        success = []
+        for operation in operations:
+            key = '/%s/%s' % (username, operation['key'].strip('/'))
+            range_end = None
+            if operation.get('prefix'):
+                range_end = etcd3.utils.increment_last_byte(etcd3.utils.to_bytes(key))
+
+            if operation['op'] == 'get':
+                success.append(etcd.transactions.get(key, range_end=range_end))
+            elif operation['op'] == 'delete':
+                success.append(etcd.transactions.delete(key, range_end=range_end))
+            else:
+                if operation['op'] == 'cas':
+                    if operation.get('prev') is None:
+                        compare.append(etcd.transactions.version(key) == 0)
+                    else:
+                        compare.append(etcd.transactions.value(key) == base64.b64encode(operation['prev'].encode('utf-8')))
+                success.append(etcd.transactions.put(key, base64.b64encode(operation['value'].encode('utf-8'))))
+
+        return etcd.transaction(compare=compare, success=success, failure=[])
+
+    try:
+        (succeeded, responses) = kv_client.run(app.config, 'transaction', transaction)
+    except Exception as err:
+        app.logger.error('Got exception running kv batch: %s', err)
+        return kv_error()
+
+    if not succeeded:
+        return replacement_failed()
+
+    results = []
+    for operation, response in zip(operations, responses):
+        result = {'op': operation['op'], 'key': operation['key']}
+        if operation['op'] == 'get':
+            values = {}
+            for (value, metadata) in response:
+                key = metadata.key.decode('utf-8').replace('/%s' % username, '', 1)
+                if '_internal_' not in key:
+                    values[key] = base64.b64decode(value).decode('utf-8')
+            if operation.get('prefix'):
+                result['values'] = values
+            else:
+                result['value'] = list(values.values())[0] if values else None
+        elif operation['op'] == 'delete':
+            result['deleted'] = response.response_delete_range.deleted
+        results.append(result)
+
+    return jsonify({'succeeded': True, 'results': results}), 200
 
 @kv.route("/prominence/v1/kv/<path:key>", methods=['POST'])
 @requires_auth
@@ -77,6 +221,9 @@ def set_value(username, group, email, key=None):
     if app.config['ENABLE_KV'] != 'True':
         return func_disabled()
 
+    if not valid_kv_user(username):
+        return not_auth_kv()
+
     if not key:
         return key_not_specified()
 
@@ -90,9 +237,9 @@ def set_value(username, group, email, key=None):
 
     if 'prev' in request.args:
         try:
-            etcd = etcd3.client(host=app.config['ETCD_HOSTNAME'], port=app.config['ETCD_PORT'])
-            status = etcd.replace('/%s/%s' % (username, key), base64.b64encode(request.args.get('prev').encode('utf-8')), base64.b64encode(value))
-            etcd.close()
+            status = kv_client.run(app.config,
+                                   'replace',
+                                   lambda etcd: etcd.replace('/%s/%s' % (username, key), base64.b64encode(request.args.get('prev').encode('utf-8')), base64.b64encode(value)))
         except Exception as err:
             app.logger.error('Got exception replacing kv: %s', err)
             return kv_error()
@@ -101,9 +248,7 @@ def set_value(username, group, email, key=None):
             return replacement_failed()
     else:
         try:
-            etcd = etcd3.client(host=app.config['ETCD_HOSTNAME'], port=app.config['ETCD_PORT'])
-            etcd.put('/%s/%s' % (username, key), base64.b64encode(value))
-            etcd.close()
+            kv_client.run(app.config, 'put', lambda etcd: etcd.put('/%s/%s' % (username, key), base64.b64encode(value)))
         except Exception as err:
             app.logger.error('Got exception setting kv: %s', err)
             return kv_error()
@@ -121,6 +266,9 @@ def delete_key(username, group, email, key=None):
     if app.config['ENABLE_KV'] != 'True':
         return func_disabled()
 
+    if not valid_kv_user(username):
+        return not_auth_kv()
+
     if not key:
         return key_not_specified()
 
@@ -129,12 +277,10 @@ def delete_key(username, group, email, key=None):
         prefix = True
 
     try:
-        etcd = etcd3.client(host=app.config['ETCD_HOSTNAME'], port=app.config['ETCD_PORT'])
         if not prefix:
-            etcd.delete('/%s/%s' % (username, key))
+            kv_client.run(app.config, 'delete', lambda etcd: etcd.delete('/%s/%s' % (username, key)))
         else:
-            etcd.delete_prefix('/%s/%s' % (username, key))
-        etcd.close()
+            kv_client.run(app.config, 'delete_prefix', lambda etcd: etcd.delete_prefix('/%s/%s' % (username, key)))
     except Exception as err:
         app.logger.error('Got exception deleting kv: %s', err)
         return kv_error()
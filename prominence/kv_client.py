@@ -0,0 +1,80 @@
+"""Shared etcd client"""
+import threading
+import time
+import etcd3
+
+from .backend.metrics import increment, observe
+
+# Number of attempts for each operation and the initial delay between attempts
+KV_MAX_ATTEMPTS = 3
+KV_BACKOFF = 0.2
+
+# Minimum time between checks of the health of the connection
+KV_HEALTH_CHECK_INTERVAL = 30
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+_LAST_HEALTH_CHECK = 0
+
+def get_client(config):
+    """
+    Return the etcd client for this process, creating it if necessary. The underlying gRPC channel is
+    thread safe and multiplexes concurrent requests
+    """
+    global _CLIENT, _LAST_HEALTH_CHECK
+    with _CLIENT_LOCK:
+        if _CLIENT is not None and time.time() - _LAST_HEALTH_CHECK > KV_HEALTH_CHECK_INTERVAL:
+            try:
+                _CLIENT.status()
+            except Exception:
+                increment('etcd_health_check_failures')
+                _close()
+            _LAST_HEALTH_CHECK = time.time()
+
+        if _CLIENT is None:
+            _CLIENT = etcd3.client(host=config['ETCD_HOSTNAME'], port=config['ETCD_PORT'])
+            _LAST_HEALTH_CHECK = time.time()
+            increment('etcd_clients_created')
+
+        return _CLIENT
+
+def _close():
+    """
+    Close the client
+    """
+    global _CLIENT
+    if _CLIENT is not None:
+        try:
+            _CLIENT.close()
+        except Exception:
+            pass
+    _CLIENT = None
+
+def reset_client():
+    """
+    Close the client so that a new connection is made when it is next used
+    """
+    with _CLIENT_LOCK:
+        _close()
+
+def run(config, operation, function):
+    """
+    Run function(client), reconnecting with exponential backoff if the connection fails, and record
+    the latency of the operation
+    """
+    delay = KV_BACKOFF
+    for attempt in range(KV_MAX_ATTEMPTS):
+        start_time = time.time()
+        try:
+            result = function(get_client(config))
+        except (etcd3.exceptions.ConnectionFailedError, etcd3.exceptions.ConnectionTimeoutError):
+            increment('etcd_reconnects')
+            reset_client()
+            if attempt == KV_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(delay)
+            delay = delay*2
+            continue
+
+        observe('etcd_%s_seconds' % operation, time.time() - start_time)
+        return result
@@ -7,17 +7,32 @@ from flask import Blueprint, jsonify, request
 from flask import current_app as app
 
 from .backend import ProminenceBackend
-from .errors import func_disabled, no_such_job, not_auth_job
+from .errors import func_disabled, no_such_job, not_auth_job, ts_busy
 from .utilities import get_remote_addr
 from .validate import validate_point
+from . import ts_writer
 
 from .auth import requires_auth, requires_auth_ts
 
 from influxdb_client import InfluxDBClient, WritePrecision, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
 
 ts = Blueprint('ts', __name__)
 
+# Aggregate functions which can be used when downsampling
+TS_AGGREGATE_FUNCTIONS = ('mean', 'median', 'min', 'max', 'sum', 'count', 'first', 'last', 'stddev', 'spread')
+
+def _get_filter(column, names):
+    """
+    Create a Flux filter matching any of the given comma-separated names, or None if any name is invalid
+    """
+    names = [name for name in names.split(',') if name]
+    if not names:
+        return None
+    for name in names:
+        if not re.match(r'^[\w.\-:/]+$', name):
+            return None
+    return ' |> filter(fn: (r) => %s)' % ' or '.join('r["%s"] == "%s"' % (column, name) for name in names)
+
 @ts.route("/prominence/v1/ts/<int:job_id>", methods=['GET'])
 @requires_auth
 def get_points(username, group, email, job_id):
@@ -37,106 +52,280 @@ def get_points(username, group, email, job_id):
     if username != identity:
         return not_auth_job()
 
-    start = int((time.time() - qdate)/60) + 30
-    if 'start' in request.args:
-        start = int(request.args.get('start'))
+    max_points = int(app.config.get('TS_MAX_POINTS_PER_QUERY', 10000))
+    try:
+        start = int((time.time() - qdate)/60) + 30
+        if 'start' in request.args:
+            start = int(request.args.get('start'))
+        stop = None
+        if 'stop' in request.args:
+            stop = int(request.args.get('stop'))
+        if 'max_points' in request.args:
+            max_points = min(max(int(request.args.get('max_points')), 1), max_points)
+    except ValueError:
+        return jsonify({'error': 'start, stop and max_points must be integers'}), 400
 
-    if 'stop' in request.args:
-        stop = int(request.args.get('stop'))
-        range_expr = 'range(start: -%dm, stop: -%dm)' % (start, stop)
+    # The start and stop times relative to now are converted to absolute times, which are included
+    # in the cursor so that later pages use the same window rather than one which has moved on
+    if 'cursor' in request.args:
+        match = re.match(r'^(\d+):(\d+):(\d+)$', request.args.get('cursor'))
+        if not match:
+            return jsonify({'error': 'cursor must be a value returned by a previous request'}), 400
+        (start_time, stop_time, cursor) = (int(value) for value in match.groups())
     else:
-        range_expr = 'range(start: -%dm)' % start
+        now = int(time.time())
+        start_time = max(now - start*60, 0)
+        stop_time = max(now - stop*60 if stop is not None else now + 1, 0)
+        cursor = 0
+
+    range_expr = 'range(start: %s, stop: %s)' % (time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start_time)),
+                                                 time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(stop_time)))
+
+    query = 'from(bucket:"user") |> %s |> filter(fn: (r) => r["jobuid"] == "%s")' % (range_expr, job_uuid)
+
+    for (arg, column) in (('measurement', '_measurement'), ('field', '_field')):
+        if arg in request.args:
+            flux_filter = _get_filter(column, request.args.get(arg))
+            if not flux_filter:
+                return jsonify({'error': 'invalid %s name' % arg}), 400
+            query += flux_filter
 
-    flux_mean = ''
     if 'mean' in request.args:
-        flux_mean = ' |> mean() '
+        query += ' |> mean() '
+    else:
+        if 'every' in request.args:
+            every = request.args.get('every')
+            function = request.args.get('fn', 'mean')
+            if not re.match(r'^([1-9][0-9]*(ms|s|m|h|d|w))+$', every):
+                return jsonify({'error': 'every must be a duration, e.g. 30s, 5m or 1h'}), 400
+            if function not in TS_AGGREGATE_FUNCTIONS:
+                return jsonify({'error': 'fn must be one of %s' % ', '.join(TS_AGGREGATE_FUNCTIONS)}), 400
+            query += ' |> aggregateWindow(every: %s, fn: %s, createEmpty: false)' % (every, function)
+
+        # Return at most max_points points from each series, starting at the offset in the cursor
+        query += ' |> limit(n: %d, offset: %d)' % (max_points, cursor)
+
+    epoch = request.args.get('format') == 'epoch'
 
     output = []
+    next_cursor = None
     try:
         client = InfluxDBClient(url=app.config['INFLUXDB_URL'],
                                 token=app.config['INFLUXDB_TOKEN'],
                                 org=app.config['INFLUXDB_ORG'])
 
         query_api = client.query_api()
-        tables = query_api.query('from(bucket:"user") |> %s |> filter(fn: (r) => r["jobuid"] == "%s") %s' % (range_expr, job_uuid, flux_mean))
+        tables = query_api.query(query)
 
-        have_tags = False
-        tags = {}
         for table in tables:
+            if not table.records:
+                continue
             data = {}
             ts = []
             vals = []
             for record in table.records:
                 if 'mean' not in request.args:
-                    ts.append(record.values['_time'].strftime("%Y-%m-%d %H:%M:%S"))
+                    if epoch:
+                        ts.append(int(record.values['_time'].timestamp()))
+                    else:
+                        ts.append(record.values['_time'].strftime("%Y-%m-%d %H:%M:%S"))
                 vals.append(record.values['_value'])
-                if not have_tags:
-                    have_tags = True
-                    for item in record.values:
-                        if item not in ('_time', '_start', '_stop', '_field', '_measurement', '_value', 'result', 'table', 'jobuid'):
-                            tags[item] = record.values[item]
+
+            tags = {}
+            for item in table.records[0].values:
+                if item not in ('_time', '_start', '_stop', '_field', '_measurement', '_value', 'result', 'table', 'jobuid'):
+                    tags[item] = table.records[0].values[item]
 
             if 'mean' not in request.args:
                 data['times'] = ts
+                if len(ts) == max_points:
+                    next_cursor = cursor + max_points
             data['values'] = vals
-            data['measurement'] = record.values['_measurement']
-            data['field'] = record.values['_field']
+            data['measurement'] = table.records[0].values['_measurement']
+            data['field'] = table.records[0].values['_field']
             data['tags'] = tags
             output.append(data)
     except:
         return jsonify({'error':'Unable to get time-series data'}), 400
 
-    return jsonify(output)
+    headers = {}
+    if next_cursor is not None:
+        headers['X-Prominence-Next-Cursor'] = '%d:%d:%d' % (start_time, stop_time, next_cursor)
+
+    return jsonify(output), 200, headers
+
+def _split_line(line):
+    """
+    Split a line of line protocol into the series (measurement and tags), fields and timestamp
+    """
+    pieces = []
+    start = 0
+    escaped = False
+    quoted = False
+    for index, char in enumerate(line):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"' and len(pieces) == 1:
+            quoted = not quoted
+        elif char == ' ' and not quoted and len(pieces) < 2:
+            pieces.append(line[start:index])
+            start = index + 1
+    pieces.append(line[start:])
+
+    if len(pieces) < 2 or not pieces[0] or not pieces[1] or quoted:
+        return None
+    if len(pieces) == 2:
+        pieces.append('')
+
+    return pieces
+
+# Field values in line protocol: floats, integers, unsigned integers, booleans and strings
+FIELD_VALUE = re.compile(r'^(-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?|-?\d+i|\d+u|t|T|true|True|TRUE|f|F|false|False|FALSE|"(\\.|[^"\\])*")$')
+
+# Largest timestamp accepted, as times are in seconds
+MAX_TIMESTAMP = 10**10
+
+def _valid_fields(fields):
+    """
+    Check that the field set of a line of line protocol is valid
+    """
+    items = []
+    start = 0
+    escaped = False
+    quoted = False
+    for index, char in enumerate(fields):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif char == ',' and not quoted:
+            items.append(fields[start:index])
+            start = index + 1
+    items.append(fields[start:])
+
+    for item in items:
+        match = re.match(r'^((?:\\.|[^=\\])+)=(.*)$', item)
+        if not match or not FIELD_VALUE.match(match.group(2)):
+            return False
+
+    return True
+
+def _add_job_tag(line, job_uuid):
+    """
+    Add the job tag to a line of line protocol, returning None if the line is invalid
+    """
+    pieces = _split_line(line)
+    if not pieces:
+        return None
+    (series, fields, timestamp) = pieces
+
+    for tag in re.split(r'(?<!\\),', series)[1:]:
+        if '=' not in tag or not tag.split('=', 1)[0] or not tag.split('=', 1)[1]:
+            return None
+        if tag.split('=', 1)[0] == 'jobuid':
+            return None
+
+    if not _valid_fields(fields):
+        return None
+
+    timestamp = timestamp.strip()
+    if not timestamp:
+        timestamp = str(int(time.time()))
+    elif not timestamp.isdigit() or int(timestamp) >= MAX_TIMESTAMP:
+        return None
+
+    return '%s,jobuid=%s %s %s' % (series, job_uuid, fields, timestamp)
+
+def _point_to_line(point, job_uuid):
+    """
+    Convert a point in JSON format to line protocol, adding the job tag
+    """
+    dictionary = {}
+    dictionary['name'] = point['measurement']
+    fields = []
+    for field in point['fields']:
+        dictionary[field] = point['fields'][field]
+        fields.append(field)
+    if 'time' in point:
+        dictionary['time'] = int(point['time'])
+    else:
+        dictionary['time'] = int(time.time())
+    tags = ['jobuid']
+    dictionary['jobuid'] = job_uuid
+    if 'tags' in point:
+        for tag in point['tags']:
+            if tag != 'jobuid':
+                dictionary[tag] = point['tags'][tag]
+                tags.append(tag)
+
+    return Point.from_dict(dictionary,
+                           write_precision=WritePrecision.S,
+                           record_measurement_key="name",
+                           record_time_key="time",
+                           record_tag_keys=tags,
+                           record_field_keys=fields).to_line_protocol()
 
 @ts.route("/prominence/v1/ts", methods=['POST'])
 @requires_auth_ts
 def set_point(username, group, email, job_uuid):
     """
-    Set time series data
+    Set time series data, either a single point or a list of points in JSON format or any number
+    of lines of line protocol (with times in seconds)
     """
     app.logger.info('%s SetPoint user:%s group:%s' % (get_remote_addr(request), username, group))
 
     if app.config['ENABLE_TS'] != 'True':
         return func_disabled()
 
-    # Validate the input JSON
-    (status, msg) = validate_point(request.get_json())
-    if not status:
-        return jsonify({'error': msg}), 400
+    if not job_uuid:
+        return jsonify({'error': 'a job token is required'}), 400
 
-    try:
-        client = InfluxDBClient(url=app.config['INFLUXDB_URL'],
-                                token=app.config['INFLUXDB_TOKEN'],
-                                org=app.config['INFLUXDB_ORG'])
+    max_points = int(app.config.get('TS_MAX_POINTS_PER_REQUEST', 10000))
+    lines = []
 
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-
-        dictionary = {}
-        dictionary['name'] = request.get_json()['measurement']
-        fields = []
-        for field in request.get_json()['fields']:
-            dictionary[field] = request.get_json()['fields'][field]
-            fields.append(field)
-        if 'time' in request.get_json():
-            dictionary['time'] = request.get_json()['time']
-        else:
-            dictionary['time'] = int(time.time())
-        tags = ['jobuid']
-        dictionary['jobuid'] = job_uuid
-        if 'tags' in request.get_json():
-            for tag in request.get_json()['tags']:
-                dictionary[tag] = request.get_json()['tags'][tag]
-                tags.append(tag)
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list) or not data:
+            return jsonify({'error': 'a point or list of points must be specified'}), 400
+        if len(data) > max_points:
+            return jsonify({'error': 'a maximum of %d points can be specified' % max_points}), 400
+
+        for point in data:
+            # Validate the input JSON
+            if not isinstance(point, dict):
+                return jsonify({'error': 'each point must be a dict'}), 400
+            (status, msg) = validate_point(point)
+            if not status:
+                return jsonify({'error': msg}), 400
+            try:
+                line = _point_to_line(point, job_uuid)
+            except Exception as err:
+                return jsonify({'error': 'Invalid time-series point: %s' % err}), 400
+            if line:
+                lines.append(line)
+    else:
+        for line in request.get_data(as_text=True).splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            new_line = _add_job_tag(line, job_uuid)
+            if not new_line:
+                return jsonify({'error': 'invalid line protocol: %s' % line[:100]}), 400
+            lines.append(new_line)
+            if len(lines) > max_points:
+                return jsonify({'error': 'a maximum of %d points can be specified' % max_points}), 400
+
+    if not lines:
+        return jsonify({'error': 'no points specified'}), 400
 
-        point = Point.from_dict(dictionary,
-                    write_precision=WritePrecision.S,
-                    record_measurement_key="name",
-                    record_time_key="time",
-                    record_tag_keys=tags,
-                    record_field_keys=fields)
-           
-        write_api.write(bucket=app.config['INFLUXDB_BUCKET'], record=point)
-    except Exception as err:
-        return jsonify({'error':'A JWT token is required: %s' % err}), 400
+    if not ts_writer.submit(app.config, lines):
+        (content, code) = ts_busy()
+        return content, code, {'Retry-After': '5'}
 
     return jsonify({}), 201
@@ -0,0 +1,109 @@
+"""Shared batching writer for the time-series database"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+
+from .backend.metrics import increment, observe
+
+# Default maximum number of points in each write, time between writes and number of buffered points
+TS_BATCH_SIZE = 5000
+TS_FLUSH_INTERVAL = 1.0
+TS_QUEUE_SIZE = 100000
+
+_QUEUE = None
+_THREAD = None
+_LOCK = threading.Lock()
+
+def _start(config):
+    """
+    Create the queue and start the thread which writes points, if this has not already been done
+    """
+    global _QUEUE, _THREAD
+    with _LOCK:
+        if _THREAD is None:
+            _QUEUE = queue.Queue(maxsize=int(config.get('TS_QUEUE_SIZE', TS_QUEUE_SIZE)))
+            _THREAD = threading.Thread(target=_writer, args=(dict(config), _QUEUE), daemon=True)
+            _THREAD.start()
+            atexit.register(_flush_at_exit)
+
+def submit(config, lines):
+    """
+    Queue points, in line protocol with second precision, for writing. Returns False if there is not
+    enough space in the buffer for all of the points, in which case none are queued
+    """
+    _start(config)
+
+    with _LOCK:
+        if _QUEUE.maxsize - _QUEUE.qsize() < len(lines):
+            increment('ts_points_rejected', len(lines))
+            return False
+        for line in lines:
+            _QUEUE.put_nowait(line)
+
+    increment('ts_points_queued', len(lines))
+    return True
+
+def _write(config, write_api, batch):
+    """
+    Write a batch of points. If the database rejects the batch as invalid it is split in half and
+    each half written separately, so that a bad point only causes the points around it to be dropped
+    """
+    start_time = time.time()
+    try:
+        write_api.write(bucket=config['INFLUXDB_BUCKET'], record=batch, write_precision=WritePrecision.S)
+    except ApiException as err:
+        if err.status in (400, 422) and len(batch) > 1:
+            _write(config, write_api, batch[:len(batch)//2])
+            _write(config, write_api, batch[len(batch)//2:])
+            return
+        logging.error('Unable to write %d time-series points due to: %s', len(batch), err)
+        increment('ts_points_failed', len(batch))
+        return
+    except Exception as err:
+        logging.error('Unable to write %d time-series points due to: %s', len(batch), err)
+        increment('ts_points_failed', len(batch))
+        return
+    observe('ts_write_seconds', time.time() - start_time)
+    increment('ts_points_written', len(batch))
+
+def _writer(config, points):
+    """
+    Write queued points, flushing when a batch is full or the flush interval has elapsed
+    """
+    batch_size = int(config.get('TS_BATCH_SIZE', TS_BATCH_SIZE))
+    flush_interval = float(config.get('TS_FLUSH_INTERVAL', TS_FLUSH_INTERVAL))
+
+    client = InfluxDBClient(url=config['INFLUXDB_URL'],
+                            token=config['INFLUXDB_TOKEN'],
+                            org=config['INFLUXDB_ORG'])
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+
+    while True:
+        batch = [points.get()]
+        deadline = time.time() + flush_interval
+        while len(batch) < batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(points.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        _write(config, write_api, batch)
+        for _ in batch:
+            points.task_done()
+
+def _flush_at_exit():
+    """
+    Wait briefly for buffered points to be written when the process exits
+    """
+    deadline = time.time() + 10
+    while _QUEUE is not None and _QUEUE.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.1)
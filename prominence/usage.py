@@ -1,7 +1,86 @@
 """Get resource usage data from ElasticSearch"""
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError
 from elasticsearch_dsl import Search, Q
 
+# Maximum number of users in a group returned by the aggregation
+USAGE_MAX_USERS = 10000
+
+# Id of the document in the rollup index recording the earliest date it covers
+ROLLUP_COVERAGE_ID = 'coverage'
+
+# Wall time of all tasks of a job multiplied by the number of CPUs, using the provisioned CPUs if known
+WALL_TIME_SCRIPT = """
+double cpus = 1;
+if (doc.containsKey('execution.provisionedResources.cpus') && doc['execution.provisionedResources.cpus'].size() > 0) {
+    cpus = doc['execution.provisionedResources.cpus'].value;
+} else if (doc.containsKey('resources.cpus') && doc['resources.cpus'].size() > 0) {
+    cpus = doc['resources.cpus'].value;
+}
+double total = 0;
+if (doc.containsKey('execution.tasks.wallTimeUsage')) {
+    for (value in doc['execution.tasks.wallTimeUsage']) {
+        total += value;
+    }
+}
+return total*cpus;
+"""
+
+# CPU time of all tasks of a job
+CPU_TIME_SCRIPT = """
+double total = 0;
+if (doc.containsKey('execution.tasks.cpuTimeUsage')) {
+    for (value in doc['execution.tasks.cpuTimeUsage']) {
+        total += value;
+    }
+}
+return total;
+"""
+
+def _get_rollup_coverage(client, config):
+    """
+    Return the earliest date covered by the rollup index, or None if it is not in use
+    """
+    if not config.get('ELASTICSEARCH_ROLLUP_INDEX'):
+        return None
+
+    try:
+        coverage = client.get(index=config['ELASTICSEARCH_ROLLUP_INDEX'], id=ROLLUP_COVERAGE_ID)
+    except NotFoundError:
+        return None
+
+    return coverage['_source']['date']
+
+def _job_search(client, config, query, dates):
+    """
+    Create a search summing the usage of individual jobs
+    """
+    search = Search(using=client, index=config['ELASTICSEARCH_INDEX']) \
+             .filter('range', date=dates) \
+             .filter('match', type='job') \
+             .filter('exists', field='execution.tasks') \
+             .query(query) \
+             .extra(size=0)
+    users = search.aggs.bucket('users', 'terms', field='username.keyword', size=USAGE_MAX_USERS)
+    users.metric('wallTime', 'sum', script={'source': WALL_TIME_SCRIPT, 'lang': 'painless'})
+    users.metric('cpuTime', 'sum', script={'source': CPU_TIME_SCRIPT, 'lang': 'painless'})
+    return search
+
+def _rollup_search(client, config, query, dates):
+    """
+    Create a search summing the daily usage of each user recorded in the rollup index. Usage is
+    only known per day, so any day partly within the range is included
+    """
+    search = Search(using=client, index=config['ELASTICSEARCH_ROLLUP_INDEX']) \
+             .filter('range', date=dates) \
+             .filter('match', type='usage') \
+             .query(query) \
+             .extra(size=0)
+    users = search.aggs.bucket('users', 'terms', field='username.keyword', size=USAGE_MAX_USERS)
+    users.metric('wallTime', 'sum', field='wallTime')
+    users.metric('cpuTime', 'sum', field='cpuTime')
+    users.metric('numberOfJobs', 'sum', field='numberOfJobs')
+    return search
+
 def get_usage(username,
               group,
               start_date,
@@ -22,35 +101,33 @@ def get_usage(username,
     else:
         query = Q('match', group__keyword=group)
 
-    search = Search(using=client, index=config['ELASTICSEARCH_INDEX']) \
-             .filter('range', date={'gte':start_date, 'lte':end_date}) \
-             .query(query) \
-             .scan()
-
     wall_time = {}
     cpu_time = {}
     num_jobs = {}
 
-    for hit in search:
-        if 'type' in hit:
-            if hit['type'] == 'job':
-                cpus = 1
-                if 'cpus' in hit.resources:
-                    cpus = hit.resources['cpus']
-                if 'provisionedResources' in hit.execution:
-                    if 'cpus' in hit.execution['provisionedResources']:
-                        cpus = hit.execution['provisionedResources']['cpus']
-                if 'tasks' in hit.execution:
-                    if hit.username not in wall_time:
-                        wall_time[hit.username] = 0
-                        cpu_time[hit.username] = 0
-                        num_jobs[hit.username] = 0
-                    num_jobs[hit.username] += 1
-                    for task in hit.execution['tasks']:
-                        if 'wallTimeUsage' in task:
-                            wall_time[hit.username] += task['wallTimeUsage']*cpus
-                        if 'cpuTimeUsage' in task:
-                            cpu_time[hit.username] += task['cpuTimeUsage']
+    # Sum over the daily usage in the rollup index for the dates it covers, and over the
+    # individual job records for any earlier dates
+    searches = []
+    coverage = _get_rollup_coverage(client, config)
+    if coverage is None:
+        searches.append((_job_search(client, config, query, {'gte':start_date, 'lte':end_date}), False))
+    else:
+        if start_date < coverage:
+            searches.append((_job_search(client, config, query, {'gte':start_date, 'lt':coverage}), False))
+        if end_date >= coverage:
+            searches.append((_rollup_search(client, config, query, {'gte':'%s||/d' % max(start_date, coverage),
+                                                                    'lte':'%s||/d' % end_date}), True))
+
+    for (search, rollup) in searches:
+        response = search.execute()
+
+        for bucket in response.aggregations.users.buckets:
+            wall_time[bucket.key] = wall_time.get(bucket.key, 0) + bucket.wallTime.value
+            cpu_time[bucket.key] = cpu_time.get(bucket.key, 0) + bucket.cpuTime.value
+            if rollup:
+                num_jobs[bucket.key] = num_jobs.get(bucket.key, 0) + int(bucket.numberOfJobs.value)
+            else:
+                num_jobs[bucket.key] = num_jobs.get(bucket.key, 0) + bucket.doc_count
 
     data = {}
     data['usage'] = {}
@@ -1,4 +1,12 @@
 """Miscellaneous utilities"""
+import codecs
+import os
+import re
+
+from flask import Response, jsonify, stream_with_context
+
+from .backend.utilities import readfile_chunks
+
 def get_remote_addr(req):
     """
     Returns the remote IP address of a user
@@ -13,3 +21,75 @@ def object_access_allowed(groups, path):
         if path.startswith(group):
             return True
     return False
+
+def _generate_events(chunks, offset):
+    """
+    Generate Server-Sent Events from chunks of a file, using the offset as the event id
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in chunks:
+        offset += len(chunk)
+        lines = decoder.decode(chunk).split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        if not lines:
+            continue
+        yield 'id: %d\n%s\n\n' % (offset, '\n'.join('data: %s' % line for line in lines))
+
+def output_response(req, filename, is_active, follow_timeout):
+    """
+    Return a response streaming standard output or error. The range to return can be specified using the
+    offset & limit query parameters or a Range header, and if follow is specified the file is followed while
+    is_active() returns True. Server-Sent Events are returned if requested in the Accept header
+    """
+    try:
+        offset = int(req.args.get('offset', 0))
+        limit = None
+        if 'limit' in req.args:
+            limit = int(req.args.get('limit'))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    if offset < 0 or (limit is not None and limit < 0):
+        return jsonify({'error': 'offset and limit must not be negative'}), 400
+
+    partial = False
+    match = re.match(r'bytes=(\d+)-(\d*)$', req.headers.get('Range', ''))
+    if match:
+        partial = True
+        offset = int(match.group(1))
+        if match.group(2):
+            limit = int(match.group(2)) - offset + 1
+            if limit < 1:
+                response = Response(status=416)
+                response.headers['Content-Range'] = 'bytes */%d' % os.path.getsize(filename)
+                return response
+
+    sse = 'text/event-stream' in req.headers.get('Accept', '')
+    if sse and 'Last-Event-ID' in req.headers:
+        if not req.headers['Last-Event-ID'].isdigit():
+            return jsonify({'error': 'Last-Event-ID must be an offset returned in a previous event'}), 400
+        offset = int(req.headers['Last-Event-ID'])
+
+    follow = None
+    if 'follow' in req.args:
+        follow = is_active
+
+    if partial and not follow:
+        size = os.path.getsize(filename)
+        if offset >= size:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */%d' % size
+            return response
+
+    chunks = readfile_chunks(filename, offset, limit, follow, follow_timeout)
+    if sse:
+        return Response(stream_with_context(_generate_events(chunks, offset)), mimetype='text/event-stream')
+
+    response = Response(stream_with_context(chunks), mimetype='text/plain')
+    if partial and not follow:
+        end = size - 1
+        if limit is not None:
+            end = min(end, offset + limit - 1)
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, end, size)
+    return response
@@ -28,6 +28,8 @@ def validate_point(point):
     if 'time' in point:
         if not str(point['time']).isdigit():
             return (False, 'time must be an integer')
+        if int(point['time']) >= 10**10:
+            return (False, 'time must be in seconds')
 
     if 'measurement' not in point:
         return (False, 'a measurement name must be specified')
@@ -38,8 +40,83 @@ def validate_point(point):
     if 'fields' not in point:
         return (False, 'fields are not specified')
 
-    if not isinstance(point['fields'], dict):
-        return (False, 'fields must be a dict')
+    if not isinstance(point['fields'], dict) or not point['fields']:
+        return (False, 'fields must be a non-empty dict')
+
+    for field in point['fields']:
+        if not isinstance(point['fields'][field], (str, int, float, bool)):
+            return (False, 'field values must be strings, numbers or booleans')
+
+    if 'tags' in point:
+        if not isinstance(point['tags'], dict):
+            return (False, 'tags must be a dict')
+        for tag in point['tags']:
+            if not isinstance(point['tags'][tag], str) or not point['tags'][tag]:
+                return (False, 'tag values must be non-empty strings')
+
+    return (True, '')
+
+def validate_kv_batch(batch, max_operations):
+    """
+    Validate a batch of key-value operations
+    """
+    if not isinstance(batch, dict) or 'operations' not in batch:
+        return (False, 'operations must be specified')
+
+    for item in batch:
+        if item != 'operations':
+            return (False, 'invalid item "%s" in batch' % item)
+
+    if not isinstance(batch['operations'], list) or not batch['operations']:
+        return (False, 'operations must be a non-empty list')
+
+    if len(batch['operations']) > max_operations:
+        return (False, 'a maximum of %d operations can be specified' % max_operations)
+
+    written = []
+    for operation in batch['operations']:
+        if not isinstance(operation, dict):
+            return (False, 'each operation must be a dict')
+
+        for item in operation:
+            if item not in ('op', 'key', 'value', 'prev', 'prefix'):
+                return (False, 'invalid item "%s" in operation' % item)
+
+        if operation.get('op') not in ('get', 'put', 'delete', 'cas'):
+            return (False, 'op must be one of get, put, delete or cas')
+
+        if not isinstance(operation.get('key'), str) or not operation['key'].strip('/'):
+            return (False, 'a key must be specified for each operation')
+
+        if operation['op'] in ('put', 'cas'):
+            if not isinstance(operation.get('value'), str) or not operation['value']:
+                return (False, 'a value must be specified for %s operations' % operation['op'])
+        elif 'value' in operation:
+            return (False, 'a value can only be specified for put and cas operations')
+
+        if 'prev' in operation:
+            if operation['op'] != 'cas':
+                return (False, 'prev can only be specified for cas operations')
+            if operation['prev'] is not None and not isinstance(operation['prev'], str):
+                return (False, 'prev must be a string or null')
+
+        if 'prefix' in operation:
+            if operation['op'] not in ('get', 'delete'):
+                return (False, 'prefix can only be specified for get and delete operations')
+            if not isinstance(operation['prefix'], bool):
+                return (False, 'prefix must be a boolean')
+
+        # etcd does not allow a key to be modified more than once in a transaction, including by a
+        # put and a delete of a prefix containing it. Keys are compared in the form used in the store
+        if operation['op'] != 'get':
+            key = operation['key'].strip('/')
+            prefix = bool(operation.get('prefix'))
+            for (other_key, other_prefix) in written:
+                if key == other_key or \
+                   (prefix and other_key.startswith(key)) or \
+                   (other_prefix and key.startswith(other_key)):
+                    return (False, 'key "%s" is modified more than once' % operation['key'])
+            written.append((key, prefix))
 
     return (True, '')
 
@@ -307,6 +384,7 @@ def validate_job(job):
                   'artifacts',
                   'outputFiles',
                   'outputDirs',
+                  'outputDirsCompression',
                   'storage']
 
     task_valids = ['image',
@@ -342,7 +420,9 @@ def validate_job(job):
                        'autoScalingType',
                        'ignoreTaskFailures',
                        'reportJobSuccessOnTaskFailure',
-                       'runSerialTasksOnAllNodes']
+                       'runSerialTasksOnAllNodes',
+                       'maximumConcurrentDownloads',
+                       'streamArtifacts']
 
     valid_events = ['jobFinished']
 
@@ -561,6 +641,10 @@ def validate_job(job):
             if not isinstance(item, str):
                 return (False, 'outputDirs must be a list of strings')
 
+    if 'outputDirsCompression' in job:
+        if job['outputDirsCompression'] not in ('none', 'gzip', 'zstd', 'lz4'):
+            return (False, 'outputDirsCompression must be one of none, gzip, zstd or lz4')
+
     # Inputs
     if 'inputs' in job:
         if not isinstance(job['inputs'], list):
@@ -625,6 +709,10 @@ def validate_job(job):
             if not isinstance(job['policies']['reportJobSuccessOnTaskFailure'], bool):
                 return (False, 'reportJobSuccessOnTaskFailure must be either true or false')
 
+        if 'streamArtifacts' in job['policies']:
+            if not isinstance(job['policies']['streamArtifacts'], bool):
+                return (False, 'streamArtifacts must be either true or false')
+
         if 'priority' in job['policies']:
             if not str(job['policies']['priority']).isdigit():
                 return (False, 'the priority must be an integer')
@@ -643,6 +731,14 @@ def validate_job(job):
             if job['policies']['maximumRetries'] > 6:
                 return (False, 'the number of retries must be less than 6')
 
+        if 'maximumConcurrentDownloads' in job['policies']:
+            if not isinstance(job['policies']['maximumConcurrentDownloads'], int) or \
+               isinstance(job['policies']['maximumConcurrentDownloads'], bool):
+                return (False, 'the maximum number of concurrent downloads must be an integer')
+
+            if job['policies']['maximumConcurrentDownloads'] < 1 or job['policies']['maximumConcurrentDownloads'] > 16:
+                return (False, 'the maximum number of concurrent downloads must be between 1 and 16')
+
         if 'maximumTaskRetries' in job['policies']:
             if not str(job['policies']['maximumTaskRetries']).isdigit():
                 return (False, 'the number of task retries must be an integer')
@@ -9,7 +9,7 @@ from .auth import requires_auth
 from .backend import ProminenceBackend
 from .errors import invalid_constraint, no_such_workflow, no_stdout, no_stderr, not_auth_workflow, workflow_id_required, workflow_removal_failed, workflow_clone_error, invalid_status
 from .validate import validate_workflow
-from .utilities import get_remote_addr
+from .utilities import get_remote_addr, output_response
 
 workflows = Blueprint('workflows', __name__)
 
@@ -101,15 +101,14 @@ def get_stdout_wf(username, group, email, workflow_id, job):
         return no_such_workflow()
     if username != identity:
         return not_auth_workflow()
-    offset = 0
-    if 'offset' in request.args:
-        offset = int(request.args.get('offset'))
-
-    stdout = backend.get_stdout(uid, iwd, None, None, -1, job, -1, offset=offset)
-    if stdout is None:
+    filename = backend.get_stdout_filename(uid, iwd, None, None, -1, job, -1)
+    if filename is None:
         return no_stdout()
-    else:
-        return stdout
+
+    return output_response(request,
+                           filename,
+                           lambda: backend.is_job_active(workflow_id),
+                           int(app.config.get('OUTPUT_FOLLOW_TIMEOUT', 60)))
 
 @workflows.route("/prominence/v1/workflows/<int:workflow_id>/<string:job>/stderr", methods=['GET'])
 @requires_auth
@@ -127,15 +126,14 @@ def get_stderr_wf(username, group, email, workflow_id, job):
         return no_such_workflow()
     if username != identity:
         return not_auth_workflow()
-    offset = 0
-    if 'offset' in request.args:
-        offset = int(request.args.get('offset'))
-
-    stderr = backend.get_stderr(uid, iwd, None, None, -1, job, -1, offset=offset)
-    if stderr is None:
+    filename = backend.get_stderr_filename(uid, iwd, None, None, -1, job, -1)
+    if filename is None:
         return no_stderr()
-    else:
-        return stderr
+
+    return output_response(request,
+                           filename,
+                           lambda: backend.is_job_active(workflow_id),
+                           int(app.config.get('OUTPUT_FOLLOW_TIMEOUT', 60)))
 
 @workflows.route("/prominence/v1/workflows/<int:workflow_id>/<string:job>/<int:instance_id>/stdout", methods=['GET'])
 @requires_auth
@@ -151,15 +149,14 @@ def get_stdout_wf_jf(username, group, email, workflow_id, job, instance_id):
         return no_such_workflow()
     if username != identity:
         return not_auth_workflow()
-    offset = 0
-    if 'offset' in request.args:
-        offset = int(request.args.get('offset'))
-
-    stdout = backend.get_stdout(uid, iwd, None, None, workflow_id, None, instance_id, offset=offset)
-    if stdout is None:
+    filename = backend.get_stdout_filename(uid, iwd, None, None, workflow_id, None, instance_id)
+    if filename is None:
         return no_stdout()
-    else:
-        return stdout
+
+    return output_response(request,
+                           filename,
+                           lambda: backend.is_job_active(workflow_id),
+                           int(app.config.get('OUTPUT_FOLLOW_TIMEOUT', 60)))
 
 @workflows.route("/prominence/v1/workflows/<int:workflow_id>/<string:job>/<int:instance_id>/stderr", methods=['GET'])
 @requires_auth
@@ -175,15 +172,14 @@ def get_stderr_wf_jf(username, group, email, workflow_id, job, instance_id):
         return no_such_workflow()
     if username != identity:
         return not_auth_workflow()
-    offset = 0
-    if 'offset' in request.args:
-        offset = int(request.args.get('offset'))
-
-    stderr = backend.get_stderr(uid, iwd, None, None, workflow_id, None, instance_id, offset=offset)
-    if stderr is None:
+    filename = backend.get_stderr_filename(uid, iwd, None, None, workflow_id, None, instance_id)
+    if filename is None:
         return no_stderr()
-    else:
-        return stderr
+
+    return output_response(request,
+                           filename,
+                           lambda: backend.is_job_active(workflow_id),
+                           int(app.config.get('OUTPUT_FOLLOW_TIMEOUT', 60)))
 
 @workflows.route("/prominence/v1/workflows/<int:workflow_id>", methods=['DELETE'])
 @requires_auth
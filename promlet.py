@@ -1,6 +1,9 @@
 #!/usr/bin/python3
 import argparse
+import calendar
+from contextlib import contextmanager
 import distutils.spawn
+import fcntl
 import getpass
 import glob
 import hashlib
@@ -17,11 +20,12 @@ import signal
 from string import Template
 import sys
 import subprocess
-import tarfile
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import wraps
 from resource import getrusage, RUSAGE_CHILDREN
-from threading import Timer
+from threading import Condition, Event, RLock, Timer
 import requests
 
 from urllib.parse import urlsplit, unquote
@@ -29,10 +33,80 @@ from urllib.parse import urlsplit, unquote
 import urllib3
 
 CURRENT_SUBPROCS = set()
+CURRENT_SUBPROCS_LOCK = RLock()
 FINISH_NOW = False
 DOWNLOAD_CONN_TIMEOUT = 10
 DOWNLOAD_MAX_RETRIES = 2
 DOWNLOAD_BACKOFF = 1
+ARTIFACT_DOWNLOAD_WORKERS = 4
+
+# Maximum number of output files and directories handled at once
+STAGEOUT_WORKERS = 4
+
+# Files at least this size are uploaded in parts, several at once
+MULTIPART_THRESHOLD = 128*1024*1024
+MULTIPART_PART_SIZE = 32*1024*1024
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_WORKERS = 4
+MULTIPART_MAX_RETRIES = 4
+MULTIPART_BACKOFF = 2
+MULTIPART_PART_TIMEOUT = 300
+
+# Maximum amount of task output copied at once when writing stdout to a file
+TEE_CHUNK_SIZE = 64*1024
+
+# Number of part URLs requested at a time when streaming an upload of unknown size
+MULTIPART_URL_BATCH = 64
+
+# Commands for compressing output directory archives, and the resulting file extensions
+ARCHIVE_COMPRESSORS = {'none': (None, 'tar'),
+                       'gzip': (['gzip', '-c'], 'tgz'),
+                       'zstd': (['zstd', '-T0', '-q', '-c'], 'tar.zst'),
+                       'lz4': (['lz4', '-q', '-c'], 'tar.lz4')}
+
+# Archives which are extracted while being downloaded, so that they are never written to disk, if
+# enabled by default or by the streamArtifacts policy of the job. Otherwise archives are downloaded
+# and then extracted, which allows failed downloads to be retried without a partial extraction
+STREAM_ARTIFACTS = False
+STREAM_COMMANDS = (('.tgz', 'tar xzf -'),
+                   ('.tar.gz', 'tar xzf -'),
+                   ('.tar.bz2', 'tar xjf -'),
+                   ('.tar', 'tar xf -'))
+
+# Maximum total size of the worker image cache, and the time for which an image name is assumed
+# to refer to the same image
+IMAGE_CACHE_MAX_SIZE = 50*1024*1024*1024
+IMAGE_CACHE_NAME_TTL = 3600
+
+# Find images in the worker cache by name when no checksum is specified, without checking with the
+# registry. Tags can be moved to a different image, so by default a cached name is only used if the
+# image is pinned to a digest or the registry still has the digest it had when the image was cached
+IMAGE_CACHE_BY_NAME = False
+
+# Media types accepted when getting the digest of an image from a registry
+REGISTRY_MANIFEST_TYPES = ('application/vnd.docker.distribution.manifest.list.v2+json',
+                           'application/vnd.docker.distribution.manifest.v2+json',
+                           'application/vnd.oci.image.index.v1+json',
+                           'application/vnd.oci.image.manifest.v1+json')
+
+# Calculate the checksum of cached images every time they are used, rather than trusting the checksum
+# recorded when they entered the cache if the files have not changed since
+IMAGE_CACHE_PARANOID = False
+
+# Maximum time to wait for an image being prefetched before pulling it directly, the file in the
+# sandbox containing the pid of the prefetch, and the file created once the prefetch holds its locks
+IMAGE_PREFETCH_WAIT = 3600
+PREFETCH_PID_FILE = '.prefetch.pid'
+PREFETCH_READY_FILE = '.prefetch.ready'
+
+# Maximum number of Singularity images pulled at once at the start of a job, and the maximum time to
+# wait for one of these pulls to finish
+IMAGE_PULL_WORKERS = 3
+IMAGE_PULL_MAX_WAIT = 4*3600
+
+KV_WATCH_TIMEOUT = 60
+KV_WATCH_DEADLINE = 300
+KV_WATCH_RETRY_DELAY = 2
 
 MPI_SSH_SCRIPT = \
 """#!/bin/bash
@@ -85,6 +159,279 @@ def get_image_cache():
     
     return None
 
+@contextmanager
+def image_cache_lock():
+    """
+    Hold an exclusive lock on the worker image cache, which is shared by all slots
+    """
+    directory = '%s/images' % get_image_cache()
+    os.makedirs(directory, exist_ok=True)
+    lock_fd = os.open('%s/.lock' % directory, os.O_RDONLY | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield directory
+    finally:
+        os.close(lock_fd)
+
+def read_image_cache_index(directory):
+    """
+    Read the index of the worker image cache, creating it from any cached images if necessary
+    """
+    try:
+        with open('%s/index.json' % directory, 'r') as fd:
+            return json.load(fd)
+    except Exception:
+        pass
+
+    index = {'images': {}, 'names': {}}
+    for done in glob.glob('%s/*.done' % directory):
+        cached = done[:-len('.done')]
+        if os.path.isfile(cached):
+            index['images'][os.path.basename(cached)] = {'size': os.path.getsize(cached),
+                                                         'lastUsed': os.path.getmtime(cached)}
+    return index
+
+def write_image_cache_index(directory, index):
+    """
+    Write the index of the worker image cache
+    """
+    with open('%s/index.json.%d' % (directory, os.getpid()), 'w') as fd:
+        json.dump(index, fd)
+    os.replace('%s/index.json.%d' % (directory, os.getpid()), '%s/index.json' % directory)
+
+def image_cache_key(runtime, image):
+    """
+    Return the name used to find an image in the worker image cache
+    """
+    return '%s:%s' % (runtime, image.split('?')[0])
+
+def is_cached_image(image):
+    """
+    Check if an image is a file in the worker image cache
+    """
+    return get_image_cache() is not None and image.startswith('%s/images/' % get_image_cache())
+
+def link_image(source, destination):
+    """
+    Hard link an image, using a symlink instead if this is not possible
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        os.symlink(source, destination)
+
+def write_image_digest(filename, checksum):
+    """
+    Record the checksum of a cached image together with the attributes of the file it applies to
+    """
+    stat = os.stat(filename)
+    with open('%s.sha256.%d' % (filename, os.getpid()), 'w') as fd:
+        json.dump({'sha256': checksum, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino}, fd)
+    os.replace('%s.sha256.%d' % (filename, os.getpid()), '%s.sha256' % filename)
+
+def get_image_digest(filename):
+    """
+    Return the checksum of a cached image, using the recorded checksum if the file has not changed
+    since it was verified rather than reading the whole file
+    """
+    if not IMAGE_CACHE_PARANOID:
+        try:
+            with open('%s.sha256' % filename, 'r') as fd:
+                digest = json.load(fd)
+            stat = os.stat(filename)
+            if (digest['size'], digest['mtime'], digest['inode']) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                return digest['sha256']
+        except Exception:
+            pass
+
+    checksum = calculate_sha256(filename)
+
+    # Record the checksum of images cached before checksums were recorded
+    if is_cached_image(filename) and checksum == os.path.basename(filename):
+        try:
+            write_image_digest(filename, checksum)
+        except Exception as err:
+            logging.error('Unable to record checksum of cached image: %s', err)
+
+    return checksum
+
+def image_pull_lock_file(runtime, image):
+    """
+    Return the name of the lock file held while an image is being prefetched
+    """
+    key = hashlib.sha256(image_cache_key(runtime, image).encode('utf-8')).hexdigest()
+    return '%s/images/.pull-%s' % (get_image_cache(), key)
+
+def wait_for_prefetch(runtime, image):
+    """
+    Wait for any prefetch of an image to finish, so that the image can be taken from the worker cache
+    rather than being pulled again
+    """
+    if not get_image_cache():
+        return
+
+    try:
+        lock_fd = os.open(image_pull_lock_file(runtime, image), os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        deadline = time.time() + IMAGE_PREFETCH_WAIT
+        while time.time() < deadline:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return
+            except OSError:
+                logging.info('Waiting for image %s to be prefetched', image)
+                time.sleep(5)
+        logging.error('Timed out waiting for image %s to be prefetched', image)
+    finally:
+        os.close(lock_fd)
+
+def get_registry_digest(image, credential=None):
+    """
+    Return the digest of an image in a Docker registry, or None if it cannot be found
+    """
+    if re.match(r'^(shub:|http|/)', image):
+        return None
+
+    # Split the image into registry, repository and tag or digest
+    (name, _, reference) = image.partition('@')
+    pieces = name.split('/')
+    registry = 'registry-1.docker.io'
+    if len(pieces) > 1 and ('.' in pieces[0] or ':' in pieces[0] or pieces[0] == 'localhost'):
+        registry = pieces.pop(0)
+    elif len(pieces) == 1:
+        pieces.insert(0, 'library')
+    repository = '/'.join(pieces)
+    if ':' in pieces[-1]:
+        (repository, tag) = repository.rsplit(':', 1)
+        reference = reference or tag
+    reference = reference or 'latest'
+
+    url = 'https://%s/v2/%s/manifests/%s' % (registry, repository, reference)
+    headers = {'Accept': ', '.join(REGISTRY_MANIFEST_TYPES)}
+    try:
+        response = requests.head(url, headers=headers, timeout=DOWNLOAD_CONN_TIMEOUT)
+
+        # Get a token if necessary, using the credential if one was provided
+        challenge = response.headers.get('WWW-Authenticate', '')
+        if response.status_code == 401 and challenge.startswith('Bearer '):
+            params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+            auth = None
+            if credential and credential.get('username') and credential.get('token'):
+                auth = (credential['username'], credential['token'])
+            token = requests.get(params.pop('realm', ''),
+                                 params=params,
+                                 auth=auth,
+                                 timeout=DOWNLOAD_CONN_TIMEOUT).json()
+            headers['Authorization'] = 'Bearer %s' % token.get('token', token.get('access_token'))
+            response = requests.head(url, headers=headers, timeout=DOWNLOAD_CONN_TIMEOUT)
+    except (requests.exceptions.RequestException, ValueError) as err:
+        logging.info('Unable to get digest of image %s from registry: %s', image, err)
+        return None
+
+    if response.status_code != 200:
+        logging.info('Unable to get digest of image %s from registry, status code is %d', image, response.status_code)
+        return None
+
+    return response.headers.get('Docker-Content-Digest')
+
+def find_in_image_cache(runtime, image, checksum=None, credential=None):
+    """
+    Return the path and checksum of an image in the worker image cache, found by checksum if one
+    is specified or otherwise by name if the name can be trusted
+    """
+    if not get_image_cache():
+        return None, None
+
+    key = image_cache_key(runtime, image)
+    try:
+        if not checksum:
+            with image_cache_lock() as directory:
+                entry = read_image_cache_index(directory)['names'].get(key)
+            if entry and time.time() - entry['time'] < IMAGE_CACHE_NAME_TTL:
+                if IMAGE_CACHE_BY_NAME or '@sha256:' in image:
+                    checksum = entry['sha256']
+                elif entry.get('digest') and entry['digest'] == get_registry_digest(image, credential):
+                    checksum = entry['sha256']
+
+        with image_cache_lock() as directory:
+            index = read_image_cache_index(directory)
+            if not checksum or checksum not in index['images'] or not os.path.isfile('%s/%s' % (directory, checksum)):
+                return None, None
+
+            index['images'][checksum]['lastUsed'] = time.time()
+            write_image_cache_index(directory, index)
+    except Exception as err:
+        logging.error('Unable to check worker image cache: %s', err)
+        return None, None
+
+    logging.info('Found image %s in worker cache with checksum %s', image, checksum)
+    return '%s/%s' % (directory, checksum), checksum
+
+def evict_images(directory, index, keep):
+    """
+    Remove the least recently used images from the worker image cache until it is within its
+    maximum size
+    """
+    total = sum(item['size'] for item in index['images'].values())
+    for checksum in sorted(index['images'], key=lambda item: index['images'][item]['lastUsed']):
+        if total <= IMAGE_CACHE_MAX_SIZE:
+            break
+        if checksum == keep:
+            continue
+        logging.info('Removing image %s from worker cache', checksum)
+        for filename in ('%s/%s' % (directory, checksum),
+                         '%s/%s.done' % (directory, checksum),
+                         '%s/%s.sha256' % (directory, checksum)):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        total -= index['images'].pop(checksum)['size']
+
+    index['names'] = {key: value for key, value in index['names'].items()
+                      if value['sha256'] in index['images'] and time.time() - value['time'] < IMAGE_CACHE_NAME_TTL}
+
+def add_to_image_cache(filename, checksum, runtime, image, digest=None):
+    """
+    Add an image to the worker image cache, hard linking it if possible rather than copying. The
+    digest of the image in the registry it was pulled from is recorded if known
+    """
+    if not checksum or not get_image_cache():
+        return
+
+    cached = '%s/images/%s' % (get_image_cache(), checksum)
+    temp = None
+    try:
+        if not os.path.exists(cached):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            temp = '%s.%d.tmp' % (cached, os.getpid())
+            try:
+                os.link(os.path.realpath(filename), temp)
+            except OSError:
+                logging.info('Copying image to worker cache')
+                shutil.copyfile(filename, temp)
+
+        with image_cache_lock() as directory:
+            index = read_image_cache_index(directory)
+            if temp and not os.path.exists(cached):
+                os.rename(temp, cached)
+                write_image_digest(cached, checksum)
+                open('%s.done' % cached, 'w').close()
+                logging.info('Added image %s to worker cache', image)
+
+            index['images'][checksum] = {'size': os.path.getsize(cached), 'lastUsed': time.time()}
+            index['names'][image_cache_key(runtime, image)] = {'sha256': checksum, 'time': time.time(), 'digest': digest}
+            evict_images(directory, index, checksum)
+            write_image_cache_index(directory, index)
+    except Exception as err:
+        logging.error('Unable to add image to worker cache: %s', err)
+    finally:
+        if temp and os.path.exists(temp):
+            os.remove(temp)
+
 def get_singularity_version():
     """
     Get the version of Singularity
@@ -131,7 +478,7 @@ def calculate_sha256(filename):
     sha256_hash = hashlib.sha256()
     try:
         with open(filename, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096),b""):
+            for byte_block in iter(lambda: f.read(1024*1024),b""):
                 sha256_hash.update(byte_block)
             return sha256_hash.hexdigest()
     except:
@@ -290,10 +637,9 @@ def get_ip():
         s.close()
     return IP
 
-@retry(tries=8, delay=2, backoff=2)
-def get_command(paths, task_count):
+def get_command(path, task_count):
     """
-    Get command from kv store
+    Get command from kv store, waiting for node 0 to write it if necessary
     """
     (token, url) = get_token(path)
     (job_id, _) = get_job_ids(path)
@@ -301,18 +647,37 @@ def get_command(paths, task_count):
     logging.info('Getting command from: %s', url)
     headers = {'Authorization': 'Bearer %s' % token}
 
-    try:
-        response = requests.get(url, headers=headers)
-    except Exception as err:
-        logging.error('Unable to get command from kv store due to: %s', err)
-        return None
+    params = {}
+    deadline = time.time() + KV_WATCH_DEADLINE
+    while time.time() < deadline:
+        try:
+            response = requests.get(url, headers=headers, params=params, timeout=KV_WATCH_TIMEOUT + 30)
+        except Exception as err:
+            logging.error('Unable to get command from kv store due to: %s', err)
+            time.sleep(KV_WATCH_RETRY_DELAY)
+            continue
 
-    if response.status_code == 200:
-        # TODO: can we supply an option to mpirun instead of doing this?
-        cmd = response.text.replace('--daemonize', '')
-        return cmd
+        if response.status_code == 200:
+            if 'watch' in params:
+                cmd = response.json()['value']
+            else:
+                cmd = response.text
+            if cmd:
+                # TODO: can we supply an option to mpirun instead of doing this?
+                return cmd.replace('--daemonize', '')
 
-    logging.error('Got status code %d while trying to get command from kv store', response.status_code)
+        if response.status_code not in (200, 204, 404):
+            logging.error('Got status code %d while trying to get command from kv store', response.status_code)
+            time.sleep(KV_WATCH_RETRY_DELAY)
+            continue
+
+        # Wait for the key to change after the revision at which it was last read
+        if 'X-Prominence-KV-Revision' in response.headers:
+            params = {'watch': '', 'timeout': KV_WATCH_TIMEOUT, 'revision': response.headers['X-Prominence-KV-Revision']}
+        else:
+            time.sleep(KV_WATCH_RETRY_DELAY)
+
+    logging.error('Timed out waiting for command from kv store')
 
     return None
 
@@ -659,13 +1024,97 @@ def download_from_url(url, filename, token=None):
 
     return True
 
-def process_file(filename, cmd):
+def stream_from_url(url, cmd, cwd, token=None):
     """
-    Process a file
+    Download from a URL, piping the content straight into a command rather than writing it to disk.
+    Returns whether the download and the command were successful
     """
+    headers = {}
+    if token:
+        headers['X-Auth-Token'] = token
+
+    stderr = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(cmd,
+                                   cwd=cwd,
+                                   shell=True,
+                                   env=dict(os.environ,
+                                            PATH='/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin'),
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=stderr)
+    except Exception as ex:
+        logging.error('Failed to run "%s" due to: %s', cmd, ex)
+        return True, False
+    with CURRENT_SUBPROCS_LOCK:
+        CURRENT_SUBPROCS.add(process)
+
+    downloaded = False
+    try:
+        response = requests.get(url, allow_redirects=True, stream=True, headers=headers, timeout=DOWNLOAD_CONN_TIMEOUT)
+        if response.status_code == 200:
+            for chunk in response.iter_content(chunk_size=1024*1024):
+                if chunk:
+                    process.stdin.write(chunk)
+            downloaded = True
+        else:
+            logging.error('Unable to download file from URL %s, status code is %d', url, response.status_code)
+    except requests.exceptions.RequestException as exc:
+        logging.error('Unable to download file from URL %s due to: %s', url, exc)
+    except IOError as exc:
+        # The command exited before reading all of its input
+        logging.error('Unable to write to "%s" due to: %s', cmd, exc)
+        downloaded = True
+
+    try:
+        process.stdin.close()
+    except IOError:
+        pass
+
+    # Don't let the command act on a partial download
+    if not downloaded:
+        process.kill()
+
+    return_code = process.wait()
+    with CURRENT_SUBPROCS_LOCK:
+        CURRENT_SUBPROCS.discard(process)
+
+    if downloaded and return_code != 0:
+        stderr.seek(0)
+        logging.error('Failed to run "%s", stderr: %s', cmd, stderr.read())
+    stderr.close()
+
+    if downloaded:
+        logging.info('File downloaded and processed successfully from URL %s', url)
+
+    return downloaded, return_code == 0
+
+def stream_from_url_with_retries(url, cmd, cwd, token=None, max_retries=DOWNLOAD_MAX_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """
+    Download from a URL into a command with retries and backoff
+    """
+    count = 0
+    downloaded = False
+    processed = False
+
+    while count < 1 + max_retries and not downloaded:
+        (downloaded, processed) = stream_from_url(url, cmd, cwd, token)
+        count += 1
+        if not downloaded:
+            time.sleep(count*backoff)
+
+    return downloaded, processed, count
+
+def process_file(filename, cmd, cwd=None):
+    """
+    Process a file, by default in the directory containing it
+    """
+    if not cwd:
+        cwd = os.path.dirname(filename)
+
     try:
-        process = subprocess.Popen('%s %s' % (cmd, filename),
-                                   cwd=os.path.dirname(filename),
+        process = subprocess.Popen('%s %s' % (cmd, shlex.quote(filename)),
+                                   cwd=cwd,
                                    shell=True,
                                    env=dict(os.environ,
                                             PATH='/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin'),
@@ -684,92 +1133,172 @@ def process_file(filename, cmd):
 
     return True
 
-def download_artifacts(job, path):
+def download_artifact(artifact, artifact_path, token, wait_turn=lambda: None, stream=False):
     """
-    Download any artifacts
+    Download and if necessary uncompress a single artifact. Files are downloaded to a unique
+    temporary directory so that concurrent downloads of artifacts with the same name do not clash,
+    and wait_turn is called before anything is written to the artifact directory so that artifacts
+    are unpacked in the order they were specified
     """
-    json_artifacts = []
-    success = True
+    logging.info('Downloading URL %s', artifact['url'])
 
-    (token, base_url, _) = get_base_url(job)
+    # Create filename
+    urlpath = urlsplit(artifact['url']).path
+    basename = posixpath.basename(unquote(urlpath))
+    json_artifact = {'name':basename}
+
+    json_artifact['status'] = 'success'
+    time_begin = time.time()
+
+    # Extract archives while downloading if possible
+    if stream:
+        for (extension, cmd) in STREAM_COMMANDS:
+            if basename.endswith(extension):
+                wait_turn()
+                (downloaded, success, attempts) = stream_from_url_with_retries(artifact['url'], cmd, artifact_path, token)
+                logging.info('Number of attempts to download and extract file %s was %d', basename, attempts)
+                if not downloaded:
+                    json_artifact['status'] = 'failedDownload'
+                elif not success:
+                    json_artifact['status'] = 'failedUncompress'
+                json_artifact['time'] = time.time() - time_begin
+                json_artifact['downloadTime'] = json_artifact['time']
+                json_artifact['uncompressTime'] = 0
+                return json_artifact
+
+    download_path = tempfile.mkdtemp(prefix='.artifact-', dir=artifact_path)
+    try:
+        return process_artifact(artifact, artifact_path, token, download_path, json_artifact, wait_turn)
+    finally:
+        shutil.rmtree(download_path, ignore_errors=True)
 
-    if 'artifacts' in job:
-        for artifact in job['artifacts']:
-            if base_url and not artifact['url'].startswith('http'):
-                artifact['url'] = '%s%s' % (base_url, artifact['url'])
+def process_artifact(artifact, artifact_path, token, download_path, json_artifact, wait_turn):
+    """
+    Download an artifact to a temporary directory, then uncompress it or move it into place
+    """
+    time_begin = time.time()
+    filename = os.path.join(download_path, json_artifact['name'])
 
-            logging.info('Downloading URL %s', artifact['url'])
+    # Download file
+    (success, attempts) = download_from_url_with_retries(artifact['url'], filename, token)
+    logging.info('Number of attempts to download file %s was %d', json_artifact['name'], attempts)
+    if not success:
+        json_artifact['status'] = 'failedDownload'
 
-            artifact_path = os.path.join(path, 'userhome')
+    duration = time.time() - time_begin
+    json_artifact['time'] = duration
+    json_artifact['downloadTime'] = duration
 
-            # Create filename
-            urlpath = urlsplit(artifact['url']).path
-            filename = posixpath.basename(unquote(urlpath))
-            json_artifact = {'name':filename}
-            filename = os.path.join(artifact_path, filename)
+    if json_artifact['status'] != 'success':
+        return json_artifact
 
-            # Download file
-            json_artifact['status'] = 'success'
-            time_begin = time.time()
+    if 'executable' in artifact:
+        if artifact['executable']:
+            try:
+                os.chmod(filename, 0o775)
+            except IOError:
+                pass
 
-            (success, attempts) = download_from_url_with_retries(artifact['url'], filename, token)
-            logging.info('Number of attempts to download file %s was %d', filename, attempts)
-            if not success:
-                json_artifact['status'] = 'failedDownload'
+    wait_turn()
 
-            duration = time.time() - time_begin
-            json_artifact['time'] = duration
+    # Process file. Archives are extracted directly into the artifact directory, while compressed
+    # files are uncompressed in the temporary directory and then moved into place along with
+    # plain files
+    time_uncompress = time.time()
+    success = False
+    if filename.endswith('.tgz') or filename.endswith('.tar.gz'):
+        success = process_file(filename, 'tar xzf', artifact_path)
+    elif filename.endswith('.tar'):
+        success = process_file(filename, 'tar xf', artifact_path)
+    elif filename.endswith('.tar.bz2'):
+        success = process_file(filename, 'tar xjf', artifact_path)
+    elif filename.endswith('.zip'):
+        success = process_file(filename, 'unzip -o', artifact_path)
+    else:
+        success = True
+        if filename.endswith('.gz'):
+            success = process_file(filename, 'gunzip')
+        elif filename.endswith('.bz2'):
+            success = process_file(filename, 'bunzip2')
+
+        if success:
+            for name in os.listdir(download_path):
+                try:
+                    os.replace(os.path.join(download_path, name), os.path.join(artifact_path, name))
+                except OSError as err:
+                    logging.error('Unable to move file %s into place due to: %s', name, err)
+                    success = False
 
-            if json_artifact['status'] != 'success':
-                json_artifacts.append(json_artifact)
-                return False, json_artifacts
+    json_artifact['uncompressTime'] = time.time() - time_uncompress
+    json_artifact['time'] = time.time() - time_begin
 
-            if 'executable' in artifact:
-                if artifact['executable']:
-                    try:
-                        os.chmod(filename, 0o775)
-                    except IOError:
-                        pass
+    if not success:
+        json_artifact['status'] = 'failedUncompress'
 
-            # Process file
-            success = False
-            remove_file = True
-            if filename.endswith('.tgz') or filename.endswith('.tar.gz'):
-                if process_file(filename, 'tar xzf'):
-                    success = True
-            elif filename.endswith('.tar'):
-                if process_file(filename, 'tar xf'):
-                    success = True
-            elif filename.endswith('.gz'):
-                if process_file(filename, 'gunzip'):
-                    success = True
-            elif filename.endswith('.tar.bz2'):
-                if process_file(filename, 'tar xjf'):
-                    success = True
-            elif filename.endswith('.bz2'):
-                if process_file(filename, 'bunzip2'):
-                    success = True
-            elif filename.endswith('.zip'):
-                if process_file(filename, 'unzip'):
-                    success = True
-            else:
-                remove_file = False
-                success = True
+    return json_artifact
 
-            duration = time.time() - time_begin
-            json_artifact['time'] = duration
+def download_artifacts(job, path):
+    """
+    Download any artifacts, several at once. Each artifact is uncompressed as soon as it has been
+    downloaded and all artifacts before it have been uncompressed, while other downloads continue
+    """
+    json_artifacts = []
+    success = True
 
-            if not success:
-                json_artifact['status'] = 'failedUncompress'
+    if 'artifacts' not in job or not job['artifacts']:
+        return success, json_artifacts
 
-            if remove_file:
-                if os.path.exists(filename):
-                    try:
-                        os.remove(filename)
-                    except Exception as err:
-                        logging.critical('Unable to delete file %s due to %s', filename, err)
+    (token, base_url, _) = get_base_url(job)
+    artifact_path = os.path.join(path, 'userhome')
+
+    for artifact in job['artifacts']:
+        if base_url and not artifact['url'].startswith('http'):
+            artifact['url'] = '%s%s' % (base_url, artifact['url'])
+
+    workers = ARTIFACT_DOWNLOAD_WORKERS
+    if 'policies' in job:
+        if 'maximumConcurrentDownloads' in job['policies']:
+            workers = int(job['policies']['maximumConcurrentDownloads'])
+    workers = max(1, min(workers, len(job['artifacts'])))
+    logging.info('Downloading %d artifacts using %d workers', len(job['artifacts']), workers)
+
+    stream = STREAM_ARTIFACTS
+    if 'policies' in job:
+        if 'streamArtifacts' in job['policies']:
+            stream = job['policies']['streamArtifacts']
 
-            json_artifacts.append(json_artifact)
+    # Don't start any more downloads once one has failed
+    failed = Event()
+
+    # Index of the next artifact which can be uncompressed
+    turn = Condition()
+    current = [0]
+
+    def download(index, artifact):
+        def wait_turn():
+            with turn:
+                turn.wait_for(lambda: current[0] == index)
+
+        try:
+            if failed.is_set():
+                return None
+            json_artifact = download_artifact(artifact, artifact_path, token, wait_turn, stream)
+            if json_artifact['status'] == 'failedDownload':
+                failed.set()
+            return json_artifact
+        finally:
+            wait_turn()
+            with turn:
+                current[0] += 1
+                turn.notify_all()
+
+    # Report artifacts in the order they were specified
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for json_artifact in executor.map(download, range(len(job['artifacts'])), job['artifacts']):
+            if json_artifact:
+                if json_artifact['status'] != 'success':
+                    success = False
+                json_artifacts.append(json_artifact)
 
     return success, json_artifacts
 
@@ -797,7 +1326,9 @@ def handle_signal(signum, frame):
     """
     global FINISH_NOW
     FINISH_NOW = True
-    for proc in CURRENT_SUBPROCS:
+    with CURRENT_SUBPROCS_LOCK:
+        procs = list(CURRENT_SUBPROCS)
+    for proc in procs:
         if proc.poll() is None:
             proc.send_signal(signum)
 
@@ -808,43 +1339,251 @@ def kill_proc(proc, timeout):
     timeout["value"] = True
     proc.kill()
 
+def write_all(fd, data):
+    """
+    Write data to a file descriptor, handling partial writes
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def tee_output(stream, filename):
+    """
+    Copy output from a process to both stdout and a file as it becomes available, returning the
+    number of bytes copied. Each read returns whatever is in the pipe, so output is forwarded in
+    large chunks without waiting for a chunk to fill
+    """
+    sys.stdout.flush()
+    fd_in = stream.fileno()
+    fd_out = sys.stdout.fileno()
+    count = 0
+
+    with open(filename, 'ab', buffering=0) as fh:
+        fd_file = fh.fileno()
+        while True:
+            data = os.read(fd_in, TEE_CHUNK_SIZE)
+            if not data:
+                break
+            write_all(fd_out, data)
+            write_all(fd_file, data)
+            count += len(data)
+
+    return count
+
 def run_with_timeout(cmd, env, timeout_sec, capture_std=False, stdout_file=None):
     """
-    Run a process with a timeout
+    Run a process with a timeout. If stdout is written to a file, the number of bytes of output is
+    returned instead of the output stream
     """
     if capture_std or stdout_file:
         proc = subprocess.Popen(shlex.split(cmd), env=env, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     else:
         proc = subprocess.Popen(shlex.split(cmd), env=env, shell=False)
 
-    CURRENT_SUBPROCS.add(proc)
-    timeout = {"value": False}
-    timer = Timer(timeout_sec, kill_proc, [proc, timeout])
-    timer.start()
-    if stdout_file:
-        with open(stdout_file, 'ab') as fh:
-            while True:
-                byte = proc.stdout.read(1)
-                if byte:
-                    sys.stdout.buffer.write(byte)
-                    sys.stdout.flush()
-                    fh.write(byte)
-                    fh.flush()
-                else:
+    with CURRENT_SUBPROCS_LOCK:
+        CURRENT_SUBPROCS.add(proc)
+    timeout = {"value": False}
+    timer = Timer(timeout_sec, kill_proc, [proc, timeout])
+    timer.start()
+    if stdout_file:
+        stdout_bytes = tee_output(proc.stdout, stdout_file)
+    else:
+        proc.wait()
+
+    with CURRENT_SUBPROCS_LOCK:
+        CURRENT_SUBPROCS.remove(proc)
+    timer.cancel()
+
+    if stdout_file:
+        proc.wait()
+        proc.stdout.close()
+        return proc.returncode, timeout["value"], stdout_bytes
+
+    return proc.returncode, timeout["value"], proc.stdout
+
+def upload_part_data(data, url, number, description):
+    """
+    Upload part of a file from memory, with retries and backoff
+    """
+    for attempt in range(1 + MULTIPART_MAX_RETRIES):
+        try:
+            response = requests.put(url, data=data, timeout=MULTIPART_PART_TIMEOUT)
+            if response.status_code in (200, 201):
+                return {'partNumber': number, 'etag': response.headers.get('ETag')}
+            logging.warning('Got status code %d uploading part %d of %s', response.status_code, number, description)
+        except requests.exceptions.RequestException as err:
+            logging.warning('RequestException when trying to upload part %d of %s: %s', number, description, err)
+        time.sleep((attempt + 1)*MULTIPART_BACKOFF)
+
+    return None
+
+def upload_part(filename, url, number, offset, length):
+    """
+    Upload part of a file
+    """
+    try:
+        with open(filename, 'rb') as file_obj:
+            file_obj.seek(offset)
+            data = file_obj.read(length)
+    except IOError as err:
+        logging.warning('IOError when trying to upload part %d of file %s: %s', number, filename, err)
+        return None
+
+    return upload_part_data(data, url, number, 'file %s' % filename)
+
+def multipart_request(path, action, data, timeout=60):
+    """
+    Make a request to the REST API to create, extend, complete or abort a multipart upload
+    """
+    (token, url) = get_token(path)
+    headers = {'Authorization': 'Bearer %s' % token}
+    endpoint = '%s/data/output/multipart' % url
+    if action != 'create':
+        endpoint = '%s/%s' % (endpoint, action)
+    try:
+        return requests.post(endpoint, headers=headers, json=data, timeout=timeout)
+    except Exception as err:
+        logging.error('Got exception when trying to %s multipart upload: %s', action, err)
+
+    return None
+
+def finish_multipart(path, name, upload_id, parts, description):
+    """
+    Complete a multipart upload if all parts were uploaded, otherwise abort it
+    """
+    data = {'name': name, 'uploadId': upload_id}
+    if parts is None or None in parts:
+        logging.error('Unable to upload all parts of %s, aborting multipart upload', description)
+        multipart_request(path, 'abort', data)
+        return False
+
+    data['parts'] = parts
+    resp = multipart_request(path, 'complete', data, timeout=600)
+    if resp is None:
+        return False
+
+    if resp.status_code != 200:
+        logging.error('Unable to complete multipart upload for %s, status code %d', description, resp.status_code)
+        return False
+
+    return True
+
+def upload_multipart(path, filename, name):
+    """
+    Upload a file in parts, several at once. Returns None if a multipart upload could not be started
+    """
+    size = os.path.getsize(filename)
+    part_size = max(MULTIPART_PART_SIZE, -(-size // MULTIPART_MAX_PARTS))
+    num_parts = -(-size // part_size)
+
+    resp = multipart_request(path, 'create', {'name': name, 'parts': num_parts})
+    if resp is None:
+        return None
+
+    if resp.status_code != 201:
+        logging.error('Unable to create multipart upload for file %s, status code %d', filename, resp.status_code)
+        return None
+
+    upload_id = resp.json()['uploadId']
+    urls = resp.json()['urls']
+    logging.info('Uploading file %s in %d parts of %d bytes', filename, num_parts, part_size)
+
+    with ThreadPoolExecutor(max_workers=MULTIPART_WORKERS) as executor:
+        parts = list(executor.map(lambda number: upload_part(filename,
+                                                             urls[number - 1],
+                                                             number,
+                                                             (number - 1)*part_size,
+                                                             min(part_size, size - (number - 1)*part_size)),
+                                  range(1, num_parts + 1)))
+
+    return finish_multipart(path, name, upload_id, parts, 'file %s' % filename)
+
+def upload_stream(stream, url, path, filename, finished):
+    """
+    Upload data read from a stream. Data which fits in a single part is uploaded in one request, otherwise
+    parts are uploaded as they are read, several at once. The function finished is called once the end of
+    the stream has been reached and must return True for the upload to be completed. Returns False if the
+    upload failed or a multipart upload could not be started, in which case the caller should fall back to
+    uploading from a file
+    """
+    data = stream.read(MULTIPART_PART_SIZE)
+    if len(data) < MULTIPART_PART_SIZE:
+        if not finished():
+            return False
+
+        headers = {}
+        if 'windows' in url:
+            headers['x-ms-blob-type'] = 'BlockBlob'
+        logging.info('Uploading to URL: %s', url)
+        try:
+            response = requests.put(url, data=data, timeout=120, headers=headers)
+        except requests.exceptions.RequestException as err:
+            logging.warning('RequestException when trying to upload %s: %s', filename, err)
+            return False
+        if response.status_code in (200, 201, 204):
+            return True
+        logging.warning('Got status code %d uploading %s to url %s', response.status_code, filename, url)
+        return False
+
+    try:
+        name = get_name_from_url(url)
+    except Exception:
+        name = None
+
+    resp = None
+    if name:
+        resp = multipart_request(path, 'create', {'name': name, 'parts': MULTIPART_URL_BATCH})
+    if resp is None or resp.status_code != 201:
+        logging.info('Unable to create multipart upload for %s', filename)
+        return False
+
+    upload_id = resp.json()['uploadId']
+    urls = resp.json()['urls']
+    logging.info('Uploading %s in parts of %d bytes while it is created', filename, MULTIPART_PART_SIZE)
+
+    futures = []
+    success = True
+    with ThreadPoolExecutor(max_workers=MULTIPART_WORKERS) as executor:
+        pending = set()
+        while data:
+            number = len(futures) + 1
+            if number > MULTIPART_MAX_PARTS:
+                logging.error('Unable to upload %s as it has more than %d parts', filename, MULTIPART_MAX_PARTS)
+                success = False
+                break
+
+            if number > len(urls):
+                resp = multipart_request(path, 'urls', {'name': name,
+                                                        'uploadId': upload_id,
+                                                        'firstPart': number,
+                                                        'parts': min(MULTIPART_URL_BATCH, MULTIPART_MAX_PARTS - number + 1)})
+                if resp is None or resp.status_code != 201:
+                    logging.error('Unable to get URLs for further parts of %s', filename)
+                    success = False
+                    break
+                urls.extend(resp.json()['urls'])
+
+            future = executor.submit(upload_part_data, data, urls[number - 1], number, filename)
+            futures.append(future)
+            pending.add(future)
+
+            # Limit the number of parts held in memory
+            if len(pending) >= MULTIPART_WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if any(item.result() is None for item in done):
+                    success = False
                     break
-    else:
-        proc.wait()
 
-    CURRENT_SUBPROCS.remove(proc)
-    timer.cancel()
+            data = stream.read(MULTIPART_PART_SIZE)
 
-    if stdout_file:
-        proc.wait()
+    parts = None
+    if success and finished():
+        parts = [item.result() for item in futures]
 
-    return proc.returncode, timeout["value"], proc.stdout
+    return finish_multipart(path, name, upload_id, parts, filename)
 
 @retry(tries=3, delay=2, backoff=2)
-def upload(filename, url, token=None):
+def upload(filename, url, token=None, path=None):
     """
     Upload a file to a URL
     """
@@ -854,6 +1593,18 @@ def upload(filename, url, token=None):
     elif 'windows' in url:
         headers['x-ms-blob-type'] = 'BlockBlob'
 
+    # Upload large files to object storage in parts
+    if not token and path and os.path.isfile(filename) and os.path.getsize(filename) >= MULTIPART_THRESHOLD:
+        try:
+            name = get_name_from_url(url)
+        except Exception:
+            name = None
+        if name:
+            status = upload_multipart(path, filename, name)
+            if status is not None:
+                return status or None
+            logging.info('Falling back to uploading file %s in a single request', filename)
+
     logging.info('Uploading to URL: %s', url)
 
     try:
@@ -915,9 +1666,16 @@ def check_url(url):
     """
     Check if a presigned URL is valid
     """
-    match = re.search(r'.*Expires=(\d+).*', url)
-    if match:
+    expires = None
+    date = re.search(r'[?&]X-Amz-Date=(\d{8}T\d{6}Z)', url)
+    duration = re.search(r'[?&]X-Amz-Expires=(\d+)', url)
+    match = re.search(r'[?&]Expires=(\d+)', url)
+    if date and duration:
+        expires = calendar.timegm(time.strptime(date.group(1), '%Y%m%dT%H%M%SZ')) + int(duration.group(1))
+    elif match:
         expires = int(match.group(1))
+
+    if expires is not None:
         if expires - time.time() < 3600:
             return False
         else:
@@ -943,111 +1701,221 @@ def get_actual_filename(path):
     
     return path.rsplit('/', 1)[1]
 
-def stageout(job, path):
+def stageout_file(output, path, token, base_url, directory, job_id, workflow_id):
     """
-    Copy any required output files and/or directories to S3 storage
+    Upload an output file
     """
     success = True
 
-    (token, base_url, directory) = get_base_url(job)
-    (job_id, workflow_id) = get_job_ids(path)
+    use_name = output['name']
+    if 'revname' in output:
+        use_name = output['revname']
 
-    # Change directory to the userhome directory
-    os.chdir('%s/userhome' % path)
+    json_out_file = {'name':output['name']}
+    out_files = glob.glob(use_name)
+    if out_files:
+        out_file = out_files[0]
+    else:
+        logging.error('Output file %s does not exist', use_name)
+        json_out_file['status'] = 'failedNoSuchFile'
+        out_file = None
+        success = False
+    if out_file:
+        url = None
+        if 'url' in output:
+            url = output['url']
+            if not check_url(url):
+                url = get_new_url(path, get_name_from_url(url))
+        elif token and base_url and directory:
+            url = create_directories(token, base_url, directory, job_id, workflow_id)
+            if not url:
+                logging.error('Unable to upload file %s to cloud storage with url %s', out_file, url)
+                json_out_file['status'] = 'failedUpload'
+                success = False
+            else:
+                url = '%s/%s' % (url, get_actual_filename(out_file))
 
-    # Upload any output files
-    json_out_files = []
-    if 'outputFiles' in job:
-        for output in job['outputFiles']:
-            use_name = output['name']
-            if 'revname' in output:
-                use_name = output['revname']
-
-            json_out_file = {'name':output['name']}
-            out_files = glob.glob(use_name)
-            if out_files: 
-                out_file = out_files[0]
+        if url:
+            time_begin = time.time()
+            if upload(out_file, url, token, path):
+                logging.info('Successfully uploaded file %s to cloud storage', out_file)
+                json_out_file['status'] = 'success'
+                json_out_file['time'] = time.time() - time_begin
             else:
-                logging.error('Output file %s does not exist', use_name)
-                json_out_file['status'] = 'failedNoSuchFile'
-                out_file = None   
+                logging.error('Unable to upload file %s to cloud storage with url %s', out_file, url)
+                json_out_file['status'] = 'failedUpload'
+                json_out_file['time'] = time.time() - time_begin
                 success = False
-            if out_file:
-                if 'url' in output:
-                    url = output['url']
-                    if not check_url(url):
-                        url = get_new_url(path, get_name_from_url(url))
-                elif token and base_url and directory:
-                    url = create_directories(token, base_url, directory, job_id, workflow_id)
-                    if not url:
-                        logging.error('Unable to upload file %s to cloud storage with url %s', out_file, url)
-                        json_out_file['status'] = 'failedUpload'
-                        success = False
-                    else:
-                        url = '%s/%s' % (url, get_actual_filename(out_file))
 
-                if url:
-                    time_begin = time.time()
-                    if upload(out_file, url, token):
-                        logging.info('Successfully uploaded file %s to cloud storage', out_file)
-                        json_out_file['status'] = 'success'
-                        json_out_file['time'] = time.time() - time_begin
-                    else:
-                        logging.error('Unable to upload file %s to cloud storage with url %s', out_file, url)
-                        json_out_file['status'] = 'failedUpload'
-                        json_out_file['time'] = time.time() - time_begin
-                        success = False
-            json_out_files.append(json_out_file)
+    return success, json_out_file
 
-    # Upload any output directories
-    json_out_dirs = []
-    if 'outputDirs' in job:
-        for output in job['outputDirs']:
-            use_name = output['name']
-            if 'revname' in output:
-                use_name = output['revname']
-
-            tar_file_created = True
-            output_filename = os.path.basename(use_name) + ".tgz"
-            json_out_dir = {'name':output['name']}
+def create_archive(directory, compression, filename=None):
+    """
+    Start creating a tar archive of a directory, compressed if required. The archive is written to the
+    given file, otherwise it can be read from the stdout of the last process returned
+    """
+    command = ARCHIVE_COMPRESSORS[compression][0]
+    if compression == 'gzip' and shutil.which('pigz'):
+        command = ['pigz', '-c']
+
+    output = subprocess.PIPE
+    if filename:
+        output = open(filename, 'wb')
+
+    try:
+        procs = [subprocess.Popen(['tar', 'cf', '-', directory],
+                                  stdout=subprocess.PIPE if command else output)]
+        if command:
             try:
-                with tarfile.open(output_filename, "w:gz") as tar:
-                    tar.add(use_name)
-            except Exception as exc:
-                logging.error('Got exception on tar creation for directory %s: %s', use_name, exc)
-                json_out_dir['status'] = 'failedTarCreation'
-                success = False
-                tar_file_created = False
-            if tar_file_created and os.path.isfile(output_filename):
-                if 'url' in output:
-                    url = output['url']
-                    if not check_url(url):
-                        url = get_new_url(path, get_name_from_url(url))
-                elif token and base_url and directory:
-                    url = create_directories(token, base_url, directory, job_id, workflow_id)
-                    if not url:
-                        logging.error('Unable to upload directory %s to cloud storage with url %s', output['name'], url)
-                        json_out_dir['status'] = 'failedUpload'
-                        success = False
-                    else:
-                        url = '%s/%s.tgz' % (url, output['name'])
+                procs.append(subprocess.Popen(command, stdin=procs[0].stdout, stdout=output))
+            except Exception:
+                procs[0].kill()
+                procs[0].wait()
+                raise
+            procs[0].stdout.close()
+    finally:
+        if filename:
+            output.close()
+
+    return procs
+
+def finish_archive(procs, kill=False):
+    """
+    Wait for the processes creating an archive to exit. Returns True if the archive was created
+    successfully, False if it was not, or None if the processes had to be killed
+    """
+    killed = False
+    if kill:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                killed = True
+
+    for proc in procs:
+        proc.wait()
+    if procs[-1].stdout:
+        procs[-1].stdout.close()
+
+    if killed:
+        return None
+
+    # Tar exits with 1 if files changed while being archived
+    if procs[0].returncode not in (0, 1) or any(proc.returncode != 0 for proc in procs[1:]):
+        return False
+
+    return True
+
+def stageout_dir(output, path, token, base_url, directory, job_id, workflow_id, compression='gzip'):
+    """
+    Create a tarball of an output directory and upload it. Archives uploaded to object storage are
+    streamed to the upload rather than first being written to disk
+    """
+    success = True
+
+    use_name = output['name']
+    if 'revname' in output:
+        use_name = output['revname']
+
+    extension = ARCHIVE_COMPRESSORS[compression][1]
+    output_filename = '%s.%s' % (os.path.basename(use_name), extension)
+    json_out_dir = {'name':output['name']}
 
-                if url:
+    url = None
+    if 'url' in output:
+        url = output['url']
+        if not check_url(url):
+            url = get_new_url(path, get_name_from_url(url))
+    elif token and base_url and directory:
+        url = create_directories(token, base_url, directory, job_id, workflow_id)
+        if not url:
+            logging.error('Unable to upload directory %s to cloud storage with url %s', output['name'], url)
+            json_out_dir['status'] = 'failedUpload'
+            success = False
+        else:
+            url = '%s/%s.%s' % (url, output['name'], extension)
+
+    time_begin = time.time()
+    uploaded = False
+    created = None
+    try:
+        if url and not token:
+            procs = create_archive(use_name, compression)
+            try:
+                uploaded = upload_stream(procs[-1].stdout, url, path, output_filename, lambda: finish_archive(procs))
+            finally:
+                created = finish_archive(procs, kill=not uploaded)
+            if not uploaded and created is not False:
+                logging.info('Unable to stream directory %s to cloud storage, creating archive on disk before uploading', use_name)
+
+        if not uploaded and created is not False:
+            # Use a unique file name as items are staged out concurrently
+            (fd, archive) = tempfile.mkstemp(prefix='.%s.' % output_filename, dir='.')
+            os.close(fd)
+            try:
+                created = finish_archive(create_archive(use_name, compression, archive))
+                if created and url:
                     time_begin = time.time()
-                    if upload(output_filename, url, token):
-                        logging.info('Successfully uploaded directory %s to cloud storage', output['name'])
-                        json_out_dir['status'] = 'success'
-                        json_out_dir['time'] = time.time() - time_begin
+                    uploaded = upload(archive, url, token, path)
+            finally:
+                try:
+                    if url:
+                        os.remove(archive)
                     else:
-                        logging.error('Unable to upload directory %s to cloud storage with url %s', output['name'], url)
-                        json_out_dir['status'] = 'failedUpload'
-                        json_out_dir['time'] = time.time() - time_begin
-                        success = False
-            json_out_dirs.append(json_out_dir)
+                        os.replace(archive, output_filename)
+                except OSError:
+                    pass
+    except Exception as exc:
+        logging.error('Got exception on tar creation for directory %s: %s', use_name, exc)
+        created = False
+
+    if created is False:
+        logging.error('Unable to create tarball for directory %s', use_name)
+        json_out_dir['status'] = 'failedTarCreation'
+        success = False
+    elif url:
+        json_out_dir['time'] = time.time() - time_begin
+        if uploaded:
+            logging.info('Successfully uploaded directory %s to cloud storage', output['name'])
+            json_out_dir['status'] = 'success'
+        else:
+            logging.error('Unable to upload directory %s to cloud storage with url %s', output['name'], url)
+            json_out_dir['status'] = 'failedUpload'
+            success = False
+
+    return success, json_out_dir
+
+def stageout(job, path):
+    """
+    Copy any required output files and/or directories to S3 storage. Items are handled
+    concurrently, so tarballs can be created while other items are being uploaded
+    """
+    (token, base_url, directory) = get_base_url(job)
+    (job_id, workflow_id) = get_job_ids(path)
+
+    # Change directory to the userhome directory
+    os.chdir('%s/userhome' % path)
+
+    compression = job.get('outputDirsCompression', 'gzip')
+
+    items = []
+    if 'outputFiles' in job:
+        items.extend([(stageout_file, output, {}) for output in job['outputFiles']])
+    if 'outputDirs' in job:
+        items.extend([(stageout_dir, output, {'compression': compression}) for output in job['outputDirs']])
+
+    results = []
+    if items:
+        with ThreadPoolExecutor(max_workers=min(STAGEOUT_WORKERS, len(items))) as executor:
+            results = list(executor.map(lambda item: item[0](item[1], path, token, base_url, directory, job_id, workflow_id, **item[2]), items))
 
     # Change directory back to the original
     os.chdir(path)
 
+    # Report items in the order they were specified
+    success = all(result[0] for result in results)
+    json_out_files = [result[1] for (function, _, _), result in zip(items, results) if function == stageout_file]
+    json_out_dirs = [result[1] for (function, _, _), result in zip(items, results) if function == stageout_dir]
+
     return success, {'files': json_out_files, 'directories': json_out_dirs}
 
 def get_usage_from_cgroup():
@@ -1236,8 +2104,12 @@ def download_singularity(image, image_new, location, path, credential, job):
     """
     logging.info('Pulling Singularity image for task')
     checksum = None
+    digest = None
+    converted = False
+    from_cache = is_cached_image(image)
+    original_image = image
 
-    if image.startswith('/'):
+    if image.startswith('/') and not from_cache:
         (token, base_url, _) = get_base_url(job)
         if base_url:
             image = '%s%s' % (base_url, image)
@@ -1268,6 +2140,7 @@ def download_singularity(image, image_new, location, path, credential, job):
 
             if not success:
                 return 1, False, checksum
+            converted = True
 
             # Remove temporary file
             try:
@@ -1287,18 +2160,18 @@ def download_singularity(image, image_new, location, path, credential, job):
 
         logging.info('Singularity image downloaded from URL and written to file %s', image_new)
 
-    elif image.startswith('%s/images' % get_image_cache()):
+    elif from_cache:
         # Handle image cached on worker
         logging.info('Using image cached on worker')
 
         try:
-            os.symlink(image, image_new)
+            link_image(image, image_new)
         except Exception as err:
-            logging.error('Unable to create symlink to container image in worker cache: %s', err)
+            logging.error('Unable to link to container image in worker cache: %s', err)
             return 1, False, checksum
 
-        # Generate checksum
-        checksum = calculate_sha256(image_new)
+        # Get checksum
+        checksum = get_image_digest(image)
         logging.info('Calculated image checksum: %s', checksum)
 
     elif image.startswith('/') and os.path.exists('%s/mounts/%s' % (path, image)):
@@ -1314,6 +2187,7 @@ def download_singularity(image, image_new, location, path, credential, job):
 
             if not success:
                 return 1, False, checksum
+            converted = True
         else:
             logging.info('Creating symlink to Singularity image from source on attached storage')
             try:
@@ -1330,11 +2204,13 @@ def download_singularity(image, image_new, location, path, credential, job):
     else:
         logging.info('Image needs to be pulled from registry')
 
-        # Handle both Singularity Hub & Docker Hub, with Docker Hub the default
+        # Handle both Singularity Hub & Docker Hub, with Docker Hub the default. The digest of the
+        # image is recorded so that other jobs can check the image is still current
         if re.match(r'^shub:', image):
             cmd = 'singularity pull --name "image.simg" %s' % image
         else:
             cmd = 'singularity pull --name "image.simg" docker://%s' % image
+            digest = get_registry_digest(image, credential)
 
         env = dict(os.environ, PATH='/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin')
         if credential['username'] and credential['token']:
@@ -1346,13 +2222,22 @@ def download_singularity(image, image_new, location, path, credential, job):
 
         while count < DOWNLOAD_MAX_RETRIES and not success:
             try:
+                # The pull is run in its own process group so that it can be killed together with the
+                # shell if the process pulling the image in the background is terminated
                 process = subprocess.Popen(cmd,
                                            cwd=os.path.dirname(image_new),
                                            shell=True,
                                            env=env,
                                            stdout=subprocess.PIPE,
-                                           stderr=subprocess.PIPE)
-                stdout, stderr = process.communicate()
+                                           stderr=subprocess.PIPE,
+                                           start_new_session=True)
+                with CURRENT_SUBPROCS_LOCK:
+                    CURRENT_SUBPROCS.add(process)
+                try:
+                    stdout, stderr = process.communicate()
+                finally:
+                    with CURRENT_SUBPROCS_LOCK:
+                        CURRENT_SUBPROCS.discard(process)
                 return_code = process.returncode
             except Exception as exc:
                 logging.error('Unable to pull Singularity image due to %s', exc)
@@ -1379,17 +2264,134 @@ def download_singularity(image, image_new, location, path, credential, job):
     else:
         logging.info('Image file %s does not exist', image_new)
 
-    # Copy to cache if necessary
-    cached = '%s/images/%s' % (get_image_cache(), checksum)
-    if not os.path.exists(cached):
-        logging.info('Copying image to worker cache')
+    # Add to cache if necessary. Images converted from Docker archives are cached using the checksum
+    # of the Singularity image rather than of the archive
+    if not from_cache:
+        if converted:
+            add_to_image_cache(image_new, calculate_sha256(image_new), 'singularity', original_image)
+        else:
+            add_to_image_cache(image_new, checksum, 'singularity', original_image, digest)
+
+    return 0, False, checksum
+
+def prefetch_images(job, path):
+    """
+    Pull the distinct images used by the tasks of a job into the worker cache, so that they are
+    available immediately when the tasks run. This is run in the background before the job starts
+    """
+    if not get_image_cache():
+        logging.info('No worker image cache available, not prefetching images')
+        set_prefetch_ready(path)
+        return
+
+    # Images on attached storage are not available until the job starts, and udocker images are only
+    # cached if they are tarballs
+    (_, base_url, _) = get_base_url(job)
+    images = {}
+    for task in job['tasks']:
+        (image, runtime) = (task['image'], task.get('runtime', 'singularity'))
+        if image.startswith('/') and not base_url:
+            continue
+        if runtime == 'udocker' and not image.startswith('/') and not re.match(r'^http', image):
+            continue
+        images.setdefault(image_cache_key(runtime, image), (image, runtime))
+
+    # Hold a lock for each image until it has been pulled, so that the promlet can wait for it
+    os.makedirs('%s/images' % get_image_cache(), exist_ok=True)
+    locks = {}
+    for (image, runtime) in images.values():
+        lock_fd = os.open(image_pull_lock_file(runtime, image), os.O_RDONLY | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logging.info('Image %s is already being prefetched', image)
+            os.close(lock_fd)
+            continue
+        locks[(image, runtime)] = lock_fd
+
+    # The job prepare hook waits for this before the job starts
+    set_prefetch_ready(path)
+
+    credentials = {task['image']: task['imagePullCredential'] for task in job['tasks']
+                   if 'username' in task.get('imagePullCredential', {}) and 'token' in task.get('imagePullCredential', {})}
+    checksums = {task['image']: task['imageSha256'] for task in job['tasks'] if 'imageSha256' in task}
+
+    for (image, runtime), lock_fd in locks.items():
+        location = '%s/images/.prefetch-%d' % (get_image_cache(), os.getpid())
         try:
-            shutil.copyfile(image_new, cached)
-            open('%s.done' % cached, 'w').close()
+            if FINISH_NOW:
+                continue
+            credential = credentials.get(image, {'username': None, 'token': None})
+            if find_in_image_cache(runtime, image, checksums.get(image), credential)[0]:
+                continue
+
+            logging.info('Prefetching image %s for runtime %s', image, runtime)
+            os.makedirs(location)
+            time_begin = time.time()
+            if runtime == 'singularity':
+                status = download_singularity(image, '%s/image.simg' % location, location, path, credential, job)[0]
+            else:
+                status = prefetch_udocker(image, location, job)
+            logging.info('Prefetching image %s finished with status %d after %d seconds', image, status, time.time() - time_begin)
         except Exception as err:
-            logging.error('Unable to copy image to worker cache: %s', err)
+            logging.error('Unable to prefetch image %s due to: %s', image, err)
+        finally:
+            shutil.rmtree(location, ignore_errors=True)
+            os.close(lock_fd)
 
-    return 0, False, checksum
+def set_prefetch_ready(path):
+    """
+    Record that the prefetch holds the locks on all the images it will pull
+    """
+    try:
+        open('%s/%s' % (path, PREFETCH_READY_FILE), 'w').close()
+    except IOError as err:
+        logging.error('Unable to create file %s due to: %s', PREFETCH_READY_FILE, err)
+
+def stop_prefetch(path):
+    """
+    Stop any prefetch of images started before the job, together with the processes it started,
+    as it is not tracked along with the job
+    """
+    try:
+        with open('%s/%s' % (path, PREFETCH_PID_FILE)) as fh:
+            pid = int(fh.read())
+        os.remove('%s/%s' % (path, PREFETCH_PID_FILE))
+    except (IOError, ValueError):
+        return
+
+    try:
+        os.remove('%s/%s' % (path, PREFETCH_READY_FILE))
+    except OSError:
+        pass
+
+    # Make sure the process is still the prefetch before signalling it
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as fh:
+            if b'--prefetch' not in fh.read().split(b'\0'):
+                return
+        logging.info('Stopping prefetch of images with pid %d', pid)
+        os.killpg(pid, signal.SIGTERM)
+    except (IOError, OSError):
+        pass
+
+def prefetch_udocker(image, location, job):
+    """
+    Download a udocker image tarball into the worker cache
+    """
+    token = None
+    original_image = image
+    if image.startswith('/'):
+        (token, base_url, _) = get_base_url(job)
+        image = '%s%s' % (base_url, image)
+
+    (success, _) = download_from_url_with_retries(image, '%s/image.tar' % location, token)
+    if not success:
+        return 1
+
+    add_to_image_cache('%s/image.tar' % location, calculate_sha256('%s/image.tar' % location), 'udocker', original_image)
+
+    return 0
 
 def get_udocker(path):
     """
@@ -1461,12 +2463,14 @@ def download_udocker(image, location, label, path, credential, job):
     Download an image from a URL and create a udocker container named 'image'
     """
     checksum = None
+    from_cache = is_cached_image(image)
+    original_image = image
     udocker_location = get_udocker(path)
     if not udocker_location:
         logging.error('Unable to install udockertools')
         return 1, False, checksum
 
-    if image.startswith('/'):
+    if image.startswith('/') and not from_cache:
         (token, base_url, _) = get_base_url(job)
         if base_url:
             image = '%s%s' % (base_url, image)
@@ -1487,31 +2491,24 @@ def download_udocker(image, location, label, path, credential, job):
         checksum = calculate_sha256('%s/image.tar' % location)
         logging.info('Calculated image checksum: %s', checksum)
 
-        # Copy to cache if necessary
-        cached = '%s/images/%s' % (get_image_cache(), checksum)
-        if not os.path.exists(cached):
-            logging.info('Copying image to worker cache')
-            try:
-                shutil.copyfile('%s/image.tar' % location, cached)
-                open('%s.done' % cached, 'w').close()
-            except Exception as err:
-                logging.error('Unable to copy image to worker cache: %s', err)
+        # Add to cache if necessary
+        add_to_image_cache('%s/image.tar' % location, checksum, 'udocker', original_image)
             
 
     (udocker_path, additional_envs) = generate_envs()
 
-    if image.startswith('%s/images' % get_image_cache()):
+    if from_cache:
         # Handle image cached on worker
         logging.info('Using image cached on worker')
 
         try:
-            os.symlink(image, '%s/image.tar' % location)
+            link_image(image, '%s/image.tar' % location)
         except Exception as err:
-            logging.error('Unable to create symlink to container image from source location on attached storage due to "%s"', err)
+            logging.error('Unable to link to container image in worker cache due to "%s"', err)
             return 1, False, checksum
 
-        # Generate checksum
-        checksum = calculate_sha256(image)
+        # Get checksum
+        checksum = get_image_digest(image)
         logging.info('Calculated image checksum: %s', checksum)
 
     if image.startswith('/') and image.endswith('.tar'):
@@ -1528,17 +2525,10 @@ def download_udocker(image, location, label, path, credential, job):
         checksum = calculate_sha256('%s/image.tar' % location)
         logging.info('Calculated image checksum: %s', checksum)
 
-        # Copy to cache if necessary
-        cached = '%s/images/%s' % (get_image_cache(), checksum)
-        if not os.path.exists(cached):
-            logging.info('Copying image to worker cache')
-            try:
-                shutil.copyfile('%s/image.tar' % location, cached)
-                open('%s.done' % cached, 'w').close()
-            except Exception as err:
-                logging.error('Unable to copy image to worker cache: %s', err)
+        # Add to cache if necessary
+        add_to_image_cache('%s/image.tar' % location, checksum, 'udocker', original_image)
 
-    if re.match(r'^http', image) or (image.startswith('/') and image.endswith('.tar')) or image.startswith('%s/images' % get_image_cache()):
+    if re.match(r'^http', image) or (image.startswith('/') and image.endswith('.tar')) or from_cache:
         logging.info('Loading udocker image')
         # Load image
         process = subprocess.Popen('udocker load -i %s/image.tar' % location,
@@ -1669,15 +2659,15 @@ def run_udocker(image, cmd, workdir, env, path, mpi, mpi_processes, mpi_procs_pe
     logging.info('Running: "%s"', run_command)
 
     (udocker_path, additional_envs) = generate_envs()
-    return_code, timed_out, _ = run_with_timeout(run_command,
-                                                 dict(PATH=udocker_path,
-                                                      UDOCKER_DIR='%s/.udocker' % udocker_location),
-                                                 walltime_limit,
-                                                 stdout_file=stdout_file)
+    return_code, timed_out, stdout_bytes = run_with_timeout(run_command,
+                                                            dict(PATH=udocker_path,
+                                                                 UDOCKER_DIR='%s/.udocker' % udocker_location),
+                                                            walltime_limit,
+                                                            stdout_file=stdout_file)
 
     logging.info('Task had exit code %d', return_code)
 
-    return return_code, timed_out, None
+    return return_code, timed_out, stdout_bytes
 
 def run_singularity(image, cmd, app, workdir, env, path, mpi, mpi_processes, mpi_procs_per_node, artifacts, walltime_limit, job, stdout_file):
     """
@@ -1748,11 +2738,116 @@ def run_singularity(image, cmd, app, workdir, env, path, mpi, mpi_processes, mpi
         env_vars['I_MPI_JOB_STARTUP_TIMEOUT'] = '120'
         env_vars['I_MPI_HYDRA_BRANCH_COUNT'] = '0'
 
-    return_code, timed_out, _ = run_with_timeout(run_command, env_vars, walltime_limit, stdout_file=stdout_file)
+    return_code, timed_out, stdout_bytes = run_with_timeout(run_command, env_vars, walltime_limit, stdout_file=stdout_file)
 
     logging.info('Task had exit code %d', return_code)
 
-    return return_code, timed_out, None
+    return return_code, timed_out, stdout_bytes
+
+def find_previous_image(job, task, count):
+    """
+    Return the number of a previous task which used the same image with the same container
+    runtime, if there is one
+    """
+    image_count = 0
+    for task_check in job['tasks']:
+        if image_name(task['image']) == image_name(task_check['image']) and image_count < count and task['runtime'] == task_check['runtime']:
+            return image_count
+        image_count += 1
+
+    return None
+
+def get_image_credential(task):
+    """
+    Return the credential for pulling the image for a task
+    """
+    credential = {'username': None, 'token': None}
+    if 'imagePullCredential' in task:
+        if 'username' in task['imagePullCredential'] and 'token' in task['imagePullCredential']:
+            credential = task['imagePullCredential']
+
+    return credential
+
+def find_cached_image(task):
+    """
+    Return the image to use for a task, which is the image in the worker cache if it has been cached
+    by another job. The checksum is used if specified, otherwise the name
+    """
+    wait_for_prefetch(task['runtime'], task['image'])
+    (cached, checksum) = find_in_image_cache(task['runtime'], task['image'], task.get('imageSha256'), get_image_credential(task))
+    if cached:
+        # Check the the checksum of the cached image is correct, just in case
+        if checksum == get_image_digest(cached):
+            return cached
+
+    return task['image']
+
+def kill_pulls(signum, frame):
+    """
+    Kill the process groups of any subprocesses of a process pulling images, then exit
+    """
+    with CURRENT_SUBPROCS_LOCK:
+        procs = list(CURRENT_SUBPROCS)
+    for proc in procs:
+        try:
+            if os.getpgid(proc.pid) == proc.pid:
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            pass
+    os._exit(128 + signum)
+
+def reset_signal_handlers():
+    """
+    Set the signal handlers of processes pulling images, so that they can be terminated together with
+    their subprocesses. Subprocesses of the promlet inherited when the process was created are
+    forgotten, as are any locks held by other threads
+    """
+    global CURRENT_SUBPROCS, CURRENT_SUBPROCS_LOCK
+    CURRENT_SUBPROCS = set()
+    CURRENT_SUBPROCS_LOCK = RLock()
+    signal.signal(signal.SIGINT, kill_pulls)
+    signal.signal(signal.SIGTERM, kill_pulls)
+
+def wait_for_pull(result):
+    """
+    Wait for an image being pulled in the background, giving up if we are told to finish or the pull
+    takes too long, which can happen if the process pulling the image is killed
+    """
+    deadline = time.time() + IMAGE_PULL_MAX_WAIT
+    while not FINISH_NOW and time.time() < deadline:
+        try:
+            return result.get(timeout=1)
+        except multiprocessing.TimeoutError:
+            pass
+
+    logging.error('Gave up waiting for image to be pulled')
+    metrics = ProcessMetrics()
+    metrics.exit_code = 1
+    metrics.time_wall = 0
+    return metrics
+
+def pull_singularity_image(task, location, path, job):
+    """
+    Pull the Singularity image for a task, which is run in a separate process while earlier tasks run
+    """
+    try:
+        os.makedirs(location, exist_ok=True)
+        return monitor(download_singularity,
+                       find_cached_image(task),
+                       '%s/image.simg' % location,
+                       location,
+                       path,
+                       get_image_credential(task),
+                       job)
+    except Exception as err:
+        logging.error('Got exception pulling image %s: %s', task['image'], err)
+
+    metrics = ProcessMetrics()
+    metrics.exit_code = 1
+    metrics.time_wall = 0
+    return metrics
 
 def run_tasks(job, path, node_num, main_node):
     """
@@ -1837,318 +2932,331 @@ def run_tasks(job, path, node_num, main_node):
             if job['policies']['runSerialTasksOnAllNodes']:
                 run_on_all = True
 
-    for task in tasks:
-        logging.info('Working on task %d', count)
+    # Start pulling the distinct Singularity images used by the tasks, several at once, so that later
+    # images are pulled while earlier tasks run. Separate processes are used so that resource usage
+    # of the pulls is not included in the usage of the tasks
+    pulls = {}
+    pull_pool = None
+    for (task_num, task) in enumerate(tasks):
+        if task['runtime'] == 'singularity' and find_previous_image(job, task, task_num) is None:
+            if not pull_pool:
+                pull_pool = multiprocessing.Pool(IMAGE_PULL_WORKERS, initializer=reset_signal_handlers)
+            pulls[task_num] = pull_pool.apply_async(pull_singularity_image,
+                                                    (task, '%s/images/%d' % (path, task_num), path, job))
 
-        mpi = None
-        if 'type' in task:
-            if task['type'] == 'openmpi':
-                mpi = 'openmpi'
-            elif task['type'] == 'mpich':
-                mpi = 'mpich'
-            elif task['type'] == 'intelmpi':
-                mpi = 'intelmpi'
-
-        image = task['image']
-
-        cmd = None
-        if 'cmd' in task:
-            cmd = task['cmd']
-
-        app = None
-        if 'app' in task:
-            app = task['app']
-
-        workdir = None
-        if 'workdir' in task:
-            workdir = task['workdir']
-
-        if workdir is None:
-            workdir = '/home/user'
-        elif not workdir.startswith('/'):
-            workdir = '/home/user/' + workdir
-
-        stdout_file = None
-        if 'stdout' in task:
-            stdout_file = task['stdout']
-            if stdout_file.startswith('/'):
-                for artifact in artifacts:
-                    if stdout_file.startswith(artifacts[artifact]):
-                        stdout_file = stdout_file.replace(artifacts[artifact], artifact)
-                        break
-            stdout_file = '%s/userhome/%s' % (path, stdout_file)
-            logging.info('Writing stdout to file %s', stdout_file)
-
-        (job_id, workflow_id) = get_job_ids(path)
-        if job_id:
-            workdir = Template(workdir).safe_substitute({"PROMINENCE_JOB_ID": job_id})
-            if cmd:
-                cmd = Template(cmd).safe_substitute({"PROMINENCE_JOB_ID": job_id})
-        if workflow_id:
-            workdir = Template(workdir).safe_substitute({"PROMINENCE_WORKFLOW_ID": workflow_id})
-            if cmd:
-                cmd = Template(cmd).safe_substitute({"PROMINENCE_WORKFLOW_ID": workflow_id})
+    try:
+        for task in tasks:
+            logging.info('Working on task %d', count)
+
+            mpi = None
+            if 'type' in task:
+                if task['type'] == 'openmpi':
+                    mpi = 'openmpi'
+                elif task['type'] == 'mpich':
+                    mpi = 'mpich'
+                elif task['type'] == 'intelmpi':
+                    mpi = 'intelmpi'
+
+            image = task['image']
+
+            cmd = None
+            if 'cmd' in task:
+                cmd = task['cmd']
+
+            app = None
+            if 'app' in task:
+                app = task['app']
+
+            workdir = None
+            if 'workdir' in task:
+                workdir = task['workdir']
+
+            if workdir is None:
+                workdir = '/home/user'
+            elif not workdir.startswith('/'):
+                workdir = '/home/user/' + workdir
+
+            stdout_file = None
+            if 'stdout' in task:
+                stdout_file = task['stdout']
+                if stdout_file.startswith('/'):
+                    for artifact in artifacts:
+                        if stdout_file.startswith(artifacts[artifact]):
+                            stdout_file = stdout_file.replace(artifacts[artifact], artifact)
+                            break
+                stdout_file = '%s/userhome/%s' % (path, stdout_file)
+                logging.info('Writing stdout to file %s', stdout_file)
+
+            (job_id, workflow_id) = get_job_ids(path)
+            if job_id:
+                workdir = Template(workdir).safe_substitute({"PROMINENCE_JOB_ID": job_id})
+                if cmd:
+                    cmd = Template(cmd).safe_substitute({"PROMINENCE_JOB_ID": job_id})
+            if workflow_id:
+                workdir = Template(workdir).safe_substitute({"PROMINENCE_WORKFLOW_ID": workflow_id})
+                if cmd:
+                    cmd = Template(cmd).safe_substitute({"PROMINENCE_WORKFLOW_ID": workflow_id})
 
-        env = {}
-        if 'env' in task:
-            for item in task['env']:
-                env[item] = str(task['env'][item])
+            env = {}
+            if 'env' in task:
+                for item in task['env']:
+                    env[item] = str(task['env'][item])
 
-        if token and url:
-            env['PROMINENCE_TOKEN'] = token
-            env['PROMINENCE_URL'] = url
+            if token and url:
+                env['PROMINENCE_TOKEN'] = token
+                env['PROMINENCE_URL'] = url
         
-        env['PROMINENCE_TASK_NUM'] = '%d' % count
-        env['PROMINENCE_NODE_NUM'] = '%d' % node_num
-
-        if args.param:
-            for pair in args.param:
-                key = pair.split('=')[0]
-                value = pair.split('=')[1]
-                env['PROMINENCE_PARAMETER_%s' % key] = value
-                if cmd:
-                    cmd = Template(cmd).safe_substitute({key:value})
-                if 'outputFiles' in job:
-                    for output in job['outputFiles']:
-                        output['revname'] = Template(output['name']).safe_substitute({key:value})
-                if 'outputDirs' in job:
-                    for output in job['outputDirs']:
-                        output['revname'] = Template(output['name']).safe_substitute({key:value})
-
-        location = '%s/images/%d' % (path, count)
-        try:
-            os.makedirs(location)
-        except Exception as err:
-            logging.error('Unable to create directory %s', location)
-            return False, {}
+            env['PROMINENCE_TASK_NUM'] = '%d' % count
+            env['PROMINENCE_NODE_NUM'] = '%d' % node_num
+
+            if args.param:
+                for pair in args.param:
+                    key = pair.split('=')[0]
+                    value = pair.split('=')[1]
+                    env['PROMINENCE_PARAMETER_%s' % key] = value
+                    if cmd:
+                        cmd = Template(cmd).safe_substitute({key:value})
+                    if 'outputFiles' in job:
+                        for output in job['outputFiles']:
+                            output['revname'] = Template(output['name']).safe_substitute({key:value})
+                    if 'outputDirs' in job:
+                        for output in job['outputDirs']:
+                            output['revname'] = Template(output['name']).safe_substitute({key:value})
+
+            location = '%s/images/%d' % (path, count)
+            try:
+                os.makedirs(location, exist_ok=True)
+            except Exception as err:
+                logging.error('Unable to create directory %s', location)
+                return False, {}
 
-        if 'procsPerNode' in task:
-            procs_per_node = task['procsPerNode']
-            procs_per_node_mpi = task['procsPerNode']
-        else:
-            procs_per_node = 0
-            procs_per_node_mpi = num_cpus
+            if 'procsPerNode' in task:
+                procs_per_node = task['procsPerNode']
+                procs_per_node_mpi = task['procsPerNode']
+            else:
+                procs_per_node = 0
+                procs_per_node_mpi = num_cpus
  
-        mpi_processes = procs_per_node_mpi*num_nodes
-
-        metrics_download = ProcessMetrics()
-        metrics_task = ProcessMetrics()
-
-        retry_count = 0
-        task_was_run = False
-        image_pull_status = 'completed'
-
-        credential = {'username': None, 'token': None}
-        if 'imagePullCredential' in task:
-            if 'username' in task['imagePullCredential'] and 'token' in task['imagePullCredential']:
-                credential = task['imagePullCredential']
-
-        # Check if a previous task used the same image: in that case use the previous image if the same container
-        # runtime was used
-        image_count = 0
-        found_image = False
-        for task_check in job['tasks']:
-            if image_name(image) == image_name(task_check['image']) and image_count < count and task['runtime'] == task_check['runtime']:
-                found_image = True
-                logging.info('Will use cached image from task %d for this task', image_count)
-                break
-            image_count += 1
-
-        # Check if image is cached from another job
-        if 'imageSha256' in task and not found_image:
-            cached = '%s/images/%s' % (get_image_cache(), task['imageSha256'])
-            if os.path.exists(cached):
-                if os.path.exists('%s.done' % cached):
-                    # Check the the checksum of the cached image is correct, just in case
-                    if task['imageSha256'] == calculate_sha256(cached):
-                        image = cached
-                        found_image = False
-
-        if task['runtime'] == 'udocker':
-            used_udocker = True
-
-            # Pull image if necessary or use a previously pulled image
-            if found_image:
-                image = 'image%d' % image_count
-                image_pull_status = 'cached'
-            elif not FINISH_NOW:
-                metrics_download = monitor(download_udocker, image, location, count, path, credential, job)
-                if metrics_download.time_wall > 0:
-                    total_pull_time += metrics_download.time_wall
-                if metrics_download.exit_code != 0:
-                    logging.error('Unable to pull image')
-                    image_pull_status = 'failed'
-                else:
-                    image = 'image%d' % count
+            mpi_processes = procs_per_node_mpi*num_nodes
 
-            if main_node or run_on_all or num_nodes == 1 or mpi:
-                pass
-            else:
-                logging.info('Not executing task %d on this node', count)
-                count = count + 1
-                continue
+            metrics_download = ProcessMetrics()
+            metrics_task = ProcessMetrics()
 
-            # Setup for MPI
-            if mpi:
-                logging.info('This is an MPI task, setting up using %d procs per node', procs_per_node_mpi)
-                write_mpi_hosts(path, procs_per_node_mpi, main_node)
-                cmd = setup_mpi(task['runtime'], path, mpi, cmd, env, mpi_processes, procs_per_node, count)
+            retry_count = 0
+            task_was_run = False
+            image_pull_status = 'completed'
 
-                if not cmd:
-                    success = False
-                    break
+            credential = get_image_credential(task)
+
+            # Check if a previous task used the same image: in that case use the previous image if the same container
+            # runtime was used
+            image_count = find_previous_image(job, task, count)
+            found_image = image_count is not None
+            if found_image:
+                logging.info('Will use cached image from task %d for this task', image_count)
+
+            # Check if image is cached from another job, unless it is being pulled in the background
+            if not found_image and count not in pulls:
+                image = find_cached_image(task)
+
+            if task['runtime'] == 'udocker':
+                used_udocker = True
+
+                # Pull image if necessary or use a previously pulled image
+                if found_image:
+                    image = 'image%d' % image_count
+                    image_pull_status = 'cached'
+                elif not FINISH_NOW:
+                    metrics_download = monitor(download_udocker, image, location, count, path, credential, job)
+                    if metrics_download.time_wall > 0:
+                        total_pull_time += metrics_download.time_wall
+                    if metrics_download.exit_code != 0:
+                        logging.error('Unable to pull image')
+                        image_pull_status = 'failed'
+                    else:
+                        image = 'image%d' % count
 
-                cmd = '/bin/bash -c "%s"' % cmd
-
-            # Run task
-            if (found_image or metrics_download.exit_code == 0) and not FINISH_NOW:
-                if task['type'] == 'sidecar':
-                    logging.info('Starting sidecar task')
-                    sidecar = multiprocessing.Process(target=run_udocker,
-                                                      args=(image,
-                                                            cmd,
-                                                            workdir,
-                                                            env,
-                                                            path,
-                                                            mpi,
-                                                            mpi_processes,
-                                                            procs_per_node,
-                                                            artifacts,
-                                                            100*24*60*60,
-                                                            job,
-                                                            stdout_file))
-                    sidecar.daemon = True
-                    sidecar.start()
+                if main_node or run_on_all or num_nodes == 1 or mpi:
+                    pass
+                else:
+                    logging.info('Not executing task %d on this node', count)
                     count = count + 1
                     continue
 
-                task_was_run = True
-                while metrics_task.exit_code != 0 and retry_count < num_retries + 1 and not metrics_task.timed_out and not FINISH_NOW:
-                    logging.info('Running task, attempt %d', retry_count + 1)
-                    task_time_limit = walltime_limit - (time.time() - job_start_time) + total_pull_time
-                    #task_executors.submit()
-                    metrics_task = monitor(run_udocker,
-                                           image,
-                                           cmd,
-                                           workdir,
-                                           env,
-                                           path,
-                                           mpi,
-                                           mpi_processes,
-                                           procs_per_node,
-                                           artifacts,
-                                           task_time_limit,
-                                           job,
-                                           stdout_file)
-                    retry_count += 1
-        else:
-            used_singularity = True
+                # Setup for MPI
+                if mpi:
+                    logging.info('This is an MPI task, setting up using %d procs per node', procs_per_node_mpi)
+                    write_mpi_hosts(path, procs_per_node_mpi, main_node)
+                    cmd = setup_mpi(task['runtime'], path, mpi, cmd, env, mpi_processes, procs_per_node, count)
 
-            # Check if Singularity has been installed
-            if not get_singularity_version():
-                logging.error('Singularity is not installed')
+                    if not cmd:
+                        success = False
+                        break
 
-            # Pull image if necessary or use a previously pulled image
-            if found_image:
-                image_new = '%s/images/%d/image.simg' % (path, image_count)
-                image_pull_status = 'cached'
-            elif not FINISH_NOW:
-                image_new = '%s/image.simg' % location
-                metrics_download = monitor(download_singularity, image, image_new, location, path, credential, job)
-                if metrics_download.time_wall > 0:
-                    total_pull_time += metrics_download.time_wall
-                if metrics_download.exit_code != 0:
-                    logging.error('Unable to pull image')
-                    image_pull_status = 'failed'
-
-            if main_node or run_on_all or num_nodes == 1 or mpi:
-                pass
+                    cmd = '/bin/bash -c "%s"' % cmd
+
+                # Run task
+                if (found_image or metrics_download.exit_code == 0) and not FINISH_NOW:
+                    if task['type'] == 'sidecar':
+                        logging.info('Starting sidecar task')
+                        sidecar = multiprocessing.Process(target=run_udocker,
+                                                          args=(image,
+                                                                cmd,
+                                                                workdir,
+                                                                env,
+                                                                path,
+                                                                mpi,
+                                                                mpi_processes,
+                                                                procs_per_node,
+                                                                artifacts,
+                                                                100*24*60*60,
+                                                                job,
+                                                                stdout_file))
+                        sidecar.daemon = True
+                        sidecar.start()
+                        count = count + 1
+                        continue
+
+                    task_was_run = True
+                    while metrics_task.exit_code != 0 and retry_count < num_retries + 1 and not metrics_task.timed_out and not FINISH_NOW:
+                        logging.info('Running task, attempt %d', retry_count + 1)
+                        task_time_limit = walltime_limit - (time.time() - job_start_time) + total_pull_time
+                        #task_executors.submit()
+                        metrics_task = monitor(run_udocker,
+                                               image,
+                                               cmd,
+                                               workdir,
+                                               env,
+                                               path,
+                                               mpi,
+                                               mpi_processes,
+                                               procs_per_node,
+                                               artifacts,
+                                               task_time_limit,
+                                               job,
+                                               stdout_file)
+                        retry_count += 1
             else:
-                logging.info('Not executing task %d on this node', count)
-                count = count + 1
-                continue
-
-            # Setup for MPI
-            if mpi:
-                logging.info('This is an MPI task, setting up using %d procs per node', procs_per_node_mpi)
-                write_mpi_hosts(path, procs_per_node_mpi, main_node)
-                cmd = setup_mpi(task['runtime'], path, mpi, cmd, env, mpi_processes, procs_per_node, count)
-
-                if not cmd:
-                    success = False
-                    break
-
-                cmd = '/bin/bash -c "%s"' % cmd
-
-            # Run task
-            if (found_image or metrics_download.exit_code == 0) and not FINISH_NOW:
-                if task['type'] == 'sidecar':
-                    logging.info('Starting sidecar task')
-                    sidecar = multiprocessing.Process(target=run_singularity,
-                                                      args=(image_new,
-                                                            cmd,
-                                                            app,
-                                                            workdir,
-                                                            env,
-                                                            path,
-                                                            mpi,
-                                                            mpi_processes,
-                                                            procs_per_node,
-                                                            artifacts,
-                                                            100*24*60*60,
-                                                            job,
-                                                            stdout_file))
-                    sidecar.daemon = True
-                    sidecar.start()
+                used_singularity = True
+
+                # Check if Singularity has been installed
+                if not get_singularity_version():
+                    logging.error('Singularity is not installed')
+
+                # Pull image if necessary or use a previously pulled image
+                if found_image:
+                    image_new = '%s/images/%d/image.simg' % (path, image_count)
+                    image_pull_status = 'cached'
+                elif not FINISH_NOW:
+                    image_new = '%s/image.simg' % location
+                    if count in pulls:
+                        # Only the time spent waiting for the pull is added to the walltime limit
+                        wait_begin = time.time()
+                        metrics_download = wait_for_pull(pulls[count])
+                        total_pull_time += time.time() - wait_begin
+                    else:
+                        metrics_download = monitor(download_singularity, image, image_new, location, path, credential, job)
+                        if metrics_download.time_wall > 0:
+                            total_pull_time += metrics_download.time_wall
+                    if metrics_download.exit_code != 0:
+                        logging.error('Unable to pull image')
+                        image_pull_status = 'failed'
+
+                if main_node or run_on_all or num_nodes == 1 or mpi:
+                    pass
+                else:
+                    logging.info('Not executing task %d on this node', count)
                     count = count + 1
                     continue
 
-                task_was_run = True
-                while metrics_task.exit_code != 0 and retry_count < num_retries + 1 and not metrics_task.timed_out and not FINISH_NOW:
-                    logging.info('Running task, attempt %d', retry_count + 1)
-                    task_time_limit = walltime_limit - (time.time() - job_start_time) + total_pull_time
-                    metrics_task = monitor(run_singularity,
-                                           image_new,
-                                           cmd,
-                                           app,
-                                           workdir,
-                                           env,
-                                           path,
-                                           mpi,
-                                           mpi_processes,
-                                           procs_per_node,
-                                           artifacts,
-                                           task_time_limit,
-                                           job,
-                                           stdout_file)
-                    retry_count += 1
+                # Setup for MPI
+                if mpi:
+                    logging.info('This is an MPI task, setting up using %d procs per node', procs_per_node_mpi)
+                    write_mpi_hosts(path, procs_per_node_mpi, main_node)
+                    cmd = setup_mpi(task['runtime'], path, mpi, cmd, env, mpi_processes, procs_per_node, count)
 
-        task_u = {}
-        task_u['imagePullStatus'] = image_pull_status
-        if metrics_download.data:
-            task_u['imageSha256'] = metrics_download.data
-        if metrics_download.time_wall:
-            task_u['imagePullTime'] = metrics_download.time_wall
-        if task_was_run:
-            task_u['exitCode'] = metrics_task.exit_code
-            task_u['wallTimeUsage'] = metrics_task.time_wall
-            task_u['maxResidentSetSizeKB'] = metrics_task.max_rss
-            task_u['retries'] = retry_count - 1
-            if metrics_task.time_user > -1 and metrics_task.time_sys > -1:
-                task_u['cpuTimeUsage'] = metrics_task.time_user + metrics_task.time_sys
-        tasks_u.append(task_u)
+                    if not cmd:
+                        success = False
+                        break
 
-        count += 1
+                    cmd = '/bin/bash -c "%s"' % cmd
+
+                # Run task
+                if (found_image or metrics_download.exit_code == 0) and not FINISH_NOW:
+                    if task['type'] == 'sidecar':
+                        logging.info('Starting sidecar task')
+                        sidecar = multiprocessing.Process(target=run_singularity,
+                                                          args=(image_new,
+                                                                cmd,
+                                                                app,
+                                                                workdir,
+                                                                env,
+                                                                path,
+                                                                mpi,
+                                                                mpi_processes,
+                                                                procs_per_node,
+                                                                artifacts,
+                                                                100*24*60*60,
+                                                                job,
+                                                                stdout_file))
+                        sidecar.daemon = True
+                        sidecar.start()
+                        count = count + 1
+                        continue
+
+                    task_was_run = True
+                    while metrics_task.exit_code != 0 and retry_count < num_retries + 1 and not metrics_task.timed_out and not FINISH_NOW:
+                        logging.info('Running task, attempt %d', retry_count + 1)
+                        task_time_limit = walltime_limit - (time.time() - job_start_time) + total_pull_time
+                        metrics_task = monitor(run_singularity,
+                                               image_new,
+                                               cmd,
+                                               app,
+                                               workdir,
+                                               env,
+                                               path,
+                                               mpi,
+                                               mpi_processes,
+                                               procs_per_node,
+                                               artifacts,
+                                               task_time_limit,
+                                               job,
+                                               stdout_file)
+                        retry_count += 1
+
+            task_u = {}
+            task_u['imagePullStatus'] = image_pull_status
+            if metrics_download.data:
+                task_u['imageSha256'] = metrics_download.data
+            if metrics_download.time_wall:
+                task_u['imagePullTime'] = metrics_download.time_wall
+            if task_was_run:
+                task_u['exitCode'] = metrics_task.exit_code
+                task_u['wallTimeUsage'] = metrics_task.time_wall
+                task_u['maxResidentSetSizeKB'] = metrics_task.max_rss
+                task_u['retries'] = retry_count - 1
+                if metrics_task.time_user > -1 and metrics_task.time_sys > -1:
+                    task_u['cpuTimeUsage'] = metrics_task.time_user + metrics_task.time_sys
+                if metrics_task.data is not None:
+                    task_u['stdoutBytes'] = metrics_task.data
+            tasks_u.append(task_u)
 
-        # Stop now if task ran for too long or we are told to finish
-        if metrics_task.timed_out or FINISH_NOW:
-            success = False
-            break
+            count += 1
 
-        # Stop now if task had non-zero exit code, but continue if user wants to ignore failures
-        if not ignore_failures and metrics_task.exit_code != 0:
-            success = False
-            break
+            # Stop now if task ran for too long or we are told to finish
+            if metrics_task.timed_out or FINISH_NOW:
+                success = False
+                break
+
+            # Stop now if task had non-zero exit code, but continue if user wants to ignore failures
+            if not ignore_failures and metrics_task.exit_code != 0:
+                success = False
+                break
+    finally:
+        # Stop any image pulls which are no longer needed
+        if pull_pool:
+            pull_pool.terminate()
+            pull_pool.join()
 
     if FINISH_NOW:
         logging.info('Received signal, aborting')
@@ -2199,6 +3307,11 @@ def create_parser():
                         dest='param',
                         action='append',
                         help='Parameters for the job')
+    parser.add_argument('--prefetch',
+                        dest='prefetch',
+                        default=False,
+                        action='store_true',
+                        help='Pull the images used by the job into the worker cache and exit')
 
     return parser.parse_args()
 
@@ -2213,6 +3326,17 @@ if __name__ == "__main__":
     # Initial directory
     path = os.getcwd()
 
+    # Prefetch images only, run in the background before the job starts
+    if args.prefetch:
+        create_logs_dir(path)
+        logging.basicConfig(filename='%s/logs/prefetch.%d.log' % (path, args.id), level=logging.INFO, format='%(asctime)s [prefetch] %(message)s')
+        job = get_job(args.job)
+        if job:
+            prefetch_images(job, path)
+        else:
+            set_prefetch_ready(path)
+        exit(0)
+
     # Get number of nodes & node number
     (num_nodes, node_num) = get_nodes()
     if num_nodes > 1 and node_num > 0:
@@ -2296,6 +3420,9 @@ if __name__ == "__main__":
                 success_tasks = False
                 json_tasks.append({'status': 'failed'})
 
+            # All images have been pulled by now
+            stop_prefetch(path)
+
             if success_tasks:
                 json_tasks.append({'status': 'success'})
             else:
@@ -2308,6 +3435,8 @@ if __name__ == "__main__":
             else:
                 success_stageout = True
 
+    stop_prefetch(path)
+
     # Write json job details
     json_output = {}
     json_output['mounts'] = json_mounts